@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""Benchmarks of the reading, derivation and writing of an IASI level-2 granule.
+
+The benchmarks run on a synthetic granule of real size and are compared to
+the stored baselines (baseline.json), failing on a regression in time or
+memory. Run from the top directory of the repository:
+
+    python benchmarks/benchmark_iasi_lvl2.py            # compare to the baselines
+    python benchmarks/benchmark_iasi_lvl2.py --save     # store new baselines
+
+The times depend on the machine, so store the baselines on the machine the
+benchmarks are compared on. The peak memory (as traced) does not.
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from ears_iasi_lvl2_format_converter.iasi_lvl2 import (
+    IasiLvl2,
+    dew_point_temperature,
+    qair2tdew,
+)
+from ears_iasi_lvl2_format_converter.synthetic import (
+    GRANULE_LINES,
+    synthetic_granule_name,
+    write_synthetic_granule,
+)
+from ears_iasi_lvl2_format_converter.utils import traced_peak_bytes
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def benchmark_cases(workdir, nlines=GRANULE_LINES):
+    """Get the benchmarked functions, by name, set up on a granule in *workdir*"""
+    granule = write_synthetic_granule(
+        os.path.join(
+            workdir, synthetic_granule_name(datetime(2023, 3, 27, 9, 16, 6), nlines)
+        )
+    )
+    nc_prefix = os.path.join(workdir, os.path.basename(granule).replace(".hdf", ".nc"))
+    l2p = IasiLvl2(granule)
+    vprof = l2p.ncwrite(nc_prefix)
+    qair = np.ma.filled(l2p.qspec.data, np.nan)
+    temp = np.ma.filled(l2p.temp.data, np.nan)
+    pres = np.ma.filled(l2p.pres.data, np.nan)
+
+    def reference_dew_point():
+        with np.errstate(all="ignore"):
+            return qair2tdew(qair, temp - 273.15, pres / 100.0)
+
+    return {
+        "load": lambda: IasiLvl2(granule),
+        "qair2tdew": reference_dew_point,
+        "dew_point_temperature": lambda: dew_point_temperature(qair, temp, pres),
+        "make_position_names": l2p.make_position_names,
+        "ncwrite_vprof": lambda: l2p.ncwrite(nc_prefix, vprof=True),
+        "ncwrite_vcross": lambda: l2p.ncwrite(nc_prefix, vprof=False),
+        "ncwrite_products": lambda: l2p.ncwrite_products(nc_prefix),
+        "ncbuild_products": lambda: l2p.ncbuild_products(nc_prefix),
+        "ncbuild_vprof": lambda: l2p.ncbuild_products(nc_prefix, products=("vprof",)),
+        # Compressed, as configured in production:
+        "ncwrite_products_nc4": lambda: l2p.ncwrite_products(
+            nc_prefix, nc_format="NETCDF4_CLASSIC"
+        ),
+        "ncbuild_products_nc4": lambda: l2p.ncbuild_products(
+            nc_prefix, nc_format="NETCDF4_CLASSIC"
+        ),
+        "ncbuild_vprof_nc4": lambda: l2p.ncbuild_products(
+            nc_prefix, products=("vprof",), nc_format="NETCDF4_CLASSIC"
+        ),
+        "loadnc": lambda: IasiLvl2(vprof),
+    }
+
+
+def measure(func, repeat=10):
+    """Get the best wall time (s) of *repeat* runs of func, and its peak traced memory"""
+    times = []
+    for dummy in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    dummy, peak = traced_peak_bytes(func)
+    return {"seconds": min(times), "peak_bytes": peak}
+
+
+def run_benchmarks(names=None, repeat=10, nlines=GRANULE_LINES):
+    """Run the benchmarks (all if *names* is None), and return the results by name"""
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        cases = benchmark_cases(workdir, nlines)
+        for name, func in cases.items():
+            if names and name not in names:
+                continue
+            results[name] = measure(func, repeat)
+            logging.info(
+                "%-22s %9.2f ms %9.1f MB",
+                name,
+                results[name]["seconds"] * 1000,
+                results[name]["peak_bytes"] / 1024.0**2,
+            )
+    return results
+
+
+def compare(results, baseline, time_tolerance=1.0, memory_tolerance=0.1):
+    """Get the regressions of the results with respect to the baselines
+
+    A benchmark regresses if it is slower, or uses more memory, than its
+    baseline by more than the tolerance (a fraction of the baseline).
+
+    """
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            logging.warning("No baseline for %s", name)
+            continue
+        for key, tolerance in (
+            ("seconds", time_tolerance),
+            ("peak_bytes", memory_tolerance),
+        ):
+            limit = baseline[name][key] * (1 + tolerance)
+            if result[key] > limit:
+                regressions.append(
+                    "%s: %s %.4g > %.4g (baseline %.4g)"
+                    % (name, key, result[key], limit, baseline[name][key])
+                )
+    return regressions
+
+
+def get_arguments(argv=None):
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("names", nargs="*", help="Benchmarks to run. Default all")
+    parser.add_argument(
+        "--save", action="store_true", help="Store the results as the new baselines"
+    )
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Baseline file")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per benchmark")
+    parser.add_argument(
+        "--time-tolerance",
+        type=float,
+        default=1.0,
+        help="Allowed slowdown, as a fraction of the baseline",
+    )
+    parser.add_argument(
+        "--memory-tolerance",
+        type=float,
+        default=0.1,
+        help="Allowed memory increase, as a fraction of the baseline",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_arguments(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger("ears_iasi_lvl2_format_converter").setLevel(logging.WARNING)
+
+    results = run_benchmarks(args.names, args.repeat)
+    if args.save:
+        with open(args.baseline, "w") as fpt:
+            json.dump(
+                {
+                    "machine": platform.machine(),
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "granule_lines": GRANULE_LINES,
+                    "benchmarks": results,
+                },
+                fpt,
+                indent=2,
+                sort_keys=True,
+            )
+        logging.info("Stored the baselines in %s", args.baseline)
+        return 0
+
+    with open(args.baseline) as fpt:
+        baseline = json.load(fpt)["benchmarks"]
+    regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance)
+    for regression in regressions:
+        logging.error("Regression: %s", regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
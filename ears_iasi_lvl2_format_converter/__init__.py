@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 """Common definitions."""
 import logging
-from importlib.metadata import version
 
 PACKAGE_NAME = __name__
-__version__ = version(__name__)
 LOG = logging.getLogger(__name__)
+
+
+def __getattr__(name):
+    # The version is looked up on first use, as the metadata is slow to import:
+    if name == "__version__":
+        from importlib.metadata import version
+
+        return version(__name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""Aggregation of the netCDF files of consecutive granules into one file per pass."""
+import logging
+import os
+import time
+
+import numpy as np
+from netCDF4 import Dataset
+
+from .constants import (
+    NC_CHUNK_PROFILES,
+    NC_COMPRESS_LEVEL,
+    NC_COMPRESSION,
+    NODATA,
+    PASS_GAP_SEC,
+)
+from .iasi_lvl2 import variable_encoding
+
+LOG = logging.getLogger(__name__)
+
+# The dimensions along which the granules are appended:
+PASS_DIMENSIONS = ("x", "nvcross")
+# The variables holding an index along x, shifted when appended:
+X_INDEX_VARIABLES = ("x", "vcross_bnds")
+# The attributes of the variables packed into integers:
+PACKING_ATTRIBUTES = ("scale_factor", "add_offset")
+
+
+class GranulePass(object):
+
+    """The netCDF files (one per product) of a pass, built one granule at a time
+
+    The granules are appended along the x and nvcross dimensions, which are
+    unlimited, so the files are written in the (enhanced) NETCDF4 format.
+    While the pass is open the files have the names of the first granule.
+    When closed they are renamed to have the end time of the last granule.
+    The variables packed in the granule files are unpacked in the pass
+    files, as the packing of each granule may differ.
+
+    """
+
+    def __init__(self, platform_name, filenames, start_time, end_time, metadata=None):
+        self.platform_name = platform_name
+        self.filenames = list(filenames)
+        self.start_time = start_time
+        self.end_time = end_time
+        self.metadata = metadata
+        self.ngranules = 0
+        self.updated = time.monotonic()
+        self._first_end_time = end_time
+
+    def create(self, granule_files, encoding):
+        """Create the pass files from the first granule
+
+        The files are written under a temporary name, as they may replace the
+        granule files.
+
+        """
+
+        for filename, granule_file in zip(self.filenames, granule_files):
+            with Dataset(granule_file) as src, Dataset(
+                filename + ".tmp", "w", format="NETCDF4"
+            ) as dst:
+                _create_like(src, dst, encoding)
+                _append(src, dst)
+        for filename in self.filenames:
+            os.rename(filename + ".tmp", filename)
+        self.ngranules = 1
+
+    def append(self, granule_files, start_time, end_time, metadata=None):
+        """Append the netCDF files of a granule to the pass"""
+        for filename, granule_file in zip(self.filenames, granule_files):
+            with Dataset(granule_file) as src, Dataset(filename, "a") as dst:
+                _append(src, dst)
+        self.end_time = max(self.end_time, end_time)
+        self.metadata = metadata
+        self.ngranules += 1
+        self.updated = time.monotonic()
+
+    def close(self):
+        """Rename the files to the end time of the pass"""
+        old_end = self._first_end_time.strftime("%Y%m%d%H%M%SZ")
+        new_end = self.end_time.strftime("%Y%m%d%H%M%SZ")
+        for idx, filename in enumerate(self.filenames):
+            head, sep, tail = os.path.basename(filename).rpartition(old_end)
+            if sep:
+                final = os.path.join(os.path.dirname(filename), head + new_end + tail)
+                os.rename(filename, final)
+                self.filenames[idx] = filename = final
+            with Dataset(filename, "a") as dst:
+                dst.id = filename
+        LOG.info(
+            "Closed pass of %s from %s to %s, %d granules: %s",
+            self.platform_name,
+            self.start_time,
+            self.end_time,
+            self.ngranules,
+            ", ".join(self.filenames),
+        )
+
+
+class PassAggregator(object):
+
+    """Aggregate the netCDF files of consecutive granules into pass files
+
+    A granule continues the open pass of its platform if it starts at most
+    *gap* seconds after the end of the pass. Otherwise the open pass is
+    closed and a new pass started. A granule older than the open pass (late)
+    is left as it is. The granule files are removed once appended. The pass
+    files are compressed with *compression* at *complevel* and chunked in
+    blocks of *chunk_profiles* along x and nvcross.
+
+    """
+
+    def __init__(
+        self,
+        output_path,
+        gap=PASS_GAP_SEC,
+        compression=NC_COMPRESSION,
+        complevel=NC_COMPRESS_LEVEL,
+        chunk_profiles=NC_CHUNK_PROFILES,
+    ):
+        self.output_path = output_path
+        self.gap = gap
+        self.compression = compression
+        self.complevel = complevel
+        self.chunk_profiles = chunk_profiles
+        self._passes = {}
+
+    def __len__(self):
+        return len(self._passes)
+
+    def add(self, granule_files, platform_name, start_time, end_time, metadata=None):
+        """Add the netCDF files (one per product) of a granule
+
+        Return the list of passes closed. A late granule is returned as a
+        closed pass of its own, with its files as they are.
+
+        """
+
+        closed = []
+        current = self._passes.get(platform_name)
+        if current is not None:
+            if start_time < current.end_time:
+                LOG.info("Granule at %s is late. Not aggregated", start_time)
+                late = GranulePass(
+                    platform_name, granule_files, start_time, end_time, metadata
+                )
+                late.ngranules = 1
+                return [late]
+            if (start_time - current.end_time).total_seconds() <= self.gap:
+                current.append(granule_files, start_time, end_time, metadata)
+                _remove(granule_files)
+                return closed
+            closed.append(self.close(platform_name))
+
+        filenames = [
+            os.path.join(self.output_path, os.path.basename(fname))
+            for fname in granule_files
+        ]
+        new = GranulePass(platform_name, filenames, start_time, end_time, metadata)
+        new.create(granule_files, self._chunked_encoding)
+        _remove(set(granule_files) - set(filenames))
+        self._passes[platform_name] = new
+        LOG.debug("Started pass of %s at %s", platform_name, start_time)
+        return closed
+
+    def close(self, platform_name):
+        """Close the open pass of the platform, and return it"""
+        current = self._passes.pop(platform_name)
+        current.close()
+        return current
+
+    def close_idle(self, max_idle):
+        """Close the passes not appended to for *max_idle* seconds, and return them"""
+        now = time.monotonic()
+        return [
+            self.close(platform_name)
+            for platform_name, current in list(self._passes.items())
+            if now - current.updated > max_idle
+        ]
+
+    def close_all(self):
+        """Close all open passes, and return them"""
+        return [self.close(platform_name) for platform_name in list(self._passes)]
+
+    def _chunked_encoding(self, dimensions, shape):
+        """Get the storage of a variable, chunked in blocks along x and nvcross"""
+        chunks = tuple(
+            self.chunk_profiles if name in PASS_DIMENSIONS else max(size, 1)
+            for name, size in zip(dimensions, shape)
+        )
+        return variable_encoding(
+            "NETCDF4", self.compression, self.complevel, chunks or None
+        )
+
+
+def _create_like(src, dst, encoding):
+    """Create the dimensions and variables of src in dst, x and nvcross unlimited
+
+    The variables packed in src are created unpacked, in the type of their
+    scale factor. The variables not along x or nvcross are copied.
+
+    """
+
+    for name, dim in src.dimensions.items():
+        dst.createDimension(name, None if name in PASS_DIMENSIONS else len(dim))
+    dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+    for name, var in src.variables.items():
+        skipped = ["_FillValue"]
+        fill_value = (
+            var.getncattr("_FillValue") if "_FillValue" in var.ncattrs() else None
+        )
+        dtype = var.dtype
+        if "scale_factor" in var.ncattrs():
+            skipped += PACKING_ATTRIBUTES
+            dtype = np.asarray(var.getncattr("scale_factor")).dtype
+            fill_value = NODATA
+        new = dst.createVariable(
+            name,
+            dtype,
+            var.dimensions,
+            fill_value=fill_value,
+            **encoding(var.dimensions, var.shape),
+        )
+        new.setncatts(
+            {attr: var.getncattr(attr) for attr in var.ncattrs() if attr not in skipped}
+        )
+        if not set(var.dimensions) & set(PASS_DIMENSIONS):
+            new[:] = var[:]
+
+
+def _append(src, dst):
+    """Append the variables of src along x and nvcross to those of dst
+
+    The time bounds of dst are extended to the end time of src.
+
+    """
+
+    offsets = {name: len(dst.dimensions[name]) for name in PASS_DIMENSIONS}
+    for name, var in src.variables.items():
+        dims = [dim for dim in var.dimensions if dim in PASS_DIMENSIONS]
+        if not dims:
+            continue
+        axis = var.dimensions.index(dims[0])
+        data = var[:]
+        if name in X_INDEX_VARIABLES:
+            data = data + offsets["x"]
+        index = [slice(None)] * var.ndim
+        index[axis] = slice(offsets[dims[0]], offsets[dims[0]] + data.shape[axis])
+        dst.variables[name][tuple(index)] = data
+
+    if offsets["x"] and "time_bnds" in src.variables:
+        start_sec = dst["time_bnds"][0, 0]
+        end_sec = max(dst["time_bnds"][0, 1], src["time_bnds"][0, 1])
+        dst["time_bnds"][0, 1] = end_sec
+        dst["time"][0] = (start_sec + end_sec) / 2
+
+
+def _remove(filenames):
+    for filename in filenames:
+        os.remove(filename)
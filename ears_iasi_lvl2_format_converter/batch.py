@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""Convert archived ears-iasi level-2 hdf5 files to netCDF in parallel (backfill)."""
+
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from configparser import RawConfigParser
+
+from .constants import (
+    DEFAULT_LOG_FORMAT,
+    DEFAULT_TIME_FORMAT,
+    IASI_FILE_GLOB,
+    MODE,
+    NC_PRODUCTS,
+)
+from .conversion import conversion_options, convert_granule, output_filenames
+from .filenames import granule_info
+from .profile_index import ProfileIndex
+from .utils import AreaRegistry, convert_to_path
+from .workers import WorkerPool
+
+LOG = logging.getLogger(__name__)
+
+
+def find_granules(inputs, pattern=IASI_FILE_GLOB):
+    """Get the granule files from filenames, directories and glob patterns
+
+    Directories are searched (not recursively) for files matching *pattern*.
+    Return the filenames sorted on the basename, which is in time order.
+
+    """
+
+    filenames = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            filenames.update(glob.glob(os.path.join(item, pattern)))
+        elif os.path.isfile(item):
+            filenames.add(item)
+        else:
+            filenames.update(fname for fname in glob.glob(item) if os.path.isfile(fname))
+    return sorted(filenames, key=os.path.basename)
+
+
+def is_converted(filename, output_path, products=NC_PRODUCTS):
+    """Tell if all the netCDF products of the granule exist and are newer"""
+    mtime = os.path.getmtime(filename)
+    for result_file in output_filenames(filename, output_path, products):
+        try:
+            if os.path.getmtime(result_file) < mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def _convert(filename, output_path, area_def, options):
+    """Convert one granule. Return the netCDF files and the time it took"""
+    started = time.monotonic()
+    platform_name, start_time, end_time = granule_info(filename)
+    result_files = convert_granule(
+        filename,
+        output_path,
+        area_def=area_def,
+        platform_name=platform_name,
+        start_time=start_time,
+        end_time=end_time,
+        **options,
+    )
+    return result_files, time.monotonic() - started
+
+
+def run_batch(
+    filenames,
+    output_path,
+    area_def=None,
+    workers=1,
+    force=False,
+    index_path=None,
+    **options,
+):
+    """Convert the granules with a pool of workers
+
+    Granules with all products already converted (and newer than the granule)
+    are skipped unless *force* is set, so an interrupted batch is resumed by
+    running it again. The files are written under a temporary name and
+    renamed when complete. The *options* are passed on to convert_granule.
+    With *index_path* the profiles converted are added to the profile index.
+    Return the counts of the granules converted, outside the area, skipped
+    and failed, and the bytes and seconds it took.
+
+    """
+
+    products = options.get("products", NC_PRODUCTS)
+    stats = dict(converted=0, outside=0, skipped=0, failed=0, bytes=0, seconds=0.0)
+    todo = []
+    for filename in filenames:
+        if not force and is_converted(filename, output_path, products):
+            LOG.debug("Already converted: %s", filename)
+            stats["skipped"] += 1
+        else:
+            todo.append(filename)
+    LOG.info("%d granules to convert, %d already converted", len(todo), stats["skipped"])
+
+    profile_index = ProfileIndex(index_path) if index_path else None
+    started = time.monotonic()
+    pool = WorkerPool(workers)
+    pending = {}
+    interrupted = True
+    try:
+        todo.reverse()
+        while todo or pending:
+            # Keep the workers busy, but no more jobs queued than needed:
+            while todo and len(pending) < 2 * workers:
+                filename = todo.pop()
+                future = pool.submit(_convert, filename, output_path, area_def, options)
+                pending[future] = filename
+            done, dummy = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                _report(pending.pop(future), future, stats, profile_index)
+        interrupted = False
+    finally:
+        if interrupted:
+            LOG.warning("Batch interrupted. Run it again to resume")
+        pool.shutdown(wait=not interrupted)
+        if profile_index is not None:
+            profile_index.compact()
+
+    stats["seconds"] = time.monotonic() - started
+    megabytes = stats["bytes"] / 1024.0**2
+    LOG.info(
+        "Converted %d granules (%.1f MB) in %.1f s: %.2f granules/s, %.1f MB/s. "
+        "%d outside the area, %d already converted, %d failed",
+        stats["converted"],
+        megabytes,
+        stats["seconds"],
+        stats["converted"] / max(stats["seconds"], 1e-9),
+        megabytes / max(stats["seconds"], 1e-9),
+        stats["outside"],
+        stats["skipped"],
+        stats["failed"],
+    )
+    return stats
+
+
+def _report(filename, future, stats, profile_index=None):
+    """Log the outcome of the conversion of one granule, count and index it"""
+    try:
+        result_files, elapsed = future.result()
+    except Exception:
+        LOG.exception("Failed to convert %s", filename)
+        stats["failed"] += 1
+        return
+
+    if not result_files:
+        stats["outside"] += 1
+        return
+    if profile_index is not None:
+        platform_name, start_time, end_time = granule_info(filename)
+        for result_file in result_files:
+            if result_file.endswith("_vprof.nc"):
+                profile_index.add(result_file, start_time, end_time)
+    size = os.path.getsize(filename)
+    stats["converted"] += 1
+    stats["bytes"] += size
+    LOG.info(
+        "Converted %s in %.2f s (%.1f MB/s)",
+        os.path.basename(filename),
+        elapsed,
+        size / 1024.0**2 / max(elapsed, 1e-9),
+    )
+
+
+def get_arguments(argv=None):
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Batch conversion of archived ears-iasi level-2 hdf5 data to netCDF."
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="Granule files, directories or (quoted) glob patterns",
+    )
+    parser.add_argument(
+        "-c",
+        "--config-file",
+        help="Config file",
+        default="configs/iasi_level2_config.cfg",
+        type=convert_to_path,
+    )
+    parser.add_argument(
+        "-a",
+        "--areas-file",
+        help="File containing definition of areas.",
+        default="configs/areas.def",
+    )
+    parser.add_argument(
+        "-o", "--output-dir", help="Output directory. Default from the config file"
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        help="Number of workers. Default from the config file",
+    )
+    parser.add_argument(
+        "--area", help="Area of interest. Default from the config file (area_of_interest)"
+    )
+    parser.add_argument(
+        "--no-area-check",
+        action="store_true",
+        help="Convert all granules, without checking the area of interest",
+    )
+    parser.add_argument(
+        "--pattern",
+        default=IASI_FILE_GLOB,
+        help="Filename pattern of the granules in the input directories",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Convert the granules again, even if already converted",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_arguments(argv)
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(
+        logging.Formatter(fmt=DEFAULT_LOG_FORMAT, datefmt=DEFAULT_TIME_FORMAT)
+    )
+    logging.getLogger("").addHandler(handler)
+    logging.getLogger("").setLevel(logging.INFO)
+
+    config = RawConfigParser()
+    config.read(args.config_file)
+    options = dict(config.items("DEFAULT") + config.items(MODE))
+
+    area_def = None
+    if not args.no_area_check:
+        area_id = args.area or options["area_of_interest"]
+        area_def = AreaRegistry(convert_to_path(args.areas_file)).get(area_id)
+
+    filenames = find_granules(args.inputs, args.pattern)
+    if not filenames:
+        LOG.warning("No granules found in %s", ", ".join(args.inputs))
+        return 1
+
+    stats = run_batch(
+        filenames,
+        args.output_dir or options["output_path"],
+        area_def=area_def,
+        workers=args.workers or int(options.get("workers", 6)),
+        force=args.force,
+        index_path=options.get("profile_index_path") or None,
+        **conversion_options(options),
+    )
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
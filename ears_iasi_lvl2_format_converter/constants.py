@@ -3,6 +3,39 @@
 import os
 
 NC_COMPRESS_LEVEL = 6
+# The netCDF output format, the compression used with the netCDF-4 formats,
+# and the number of profiles in each chunk of the netCDF-4 variables:
+NC_FORMAT = "NETCDF3_CLASSIC"
+NC_COMPRESSION = "zlib"
+NC_CHUNK_PROFILES = 512
+
+# Packing of the parameters into 16-bit integers: (scale_factor, add_offset)
+# covering the physical range of each parameter, and the fill value. The
+# pressure, humidity and ozone span orders of magnitude over the levels (e.g.
+# 0.5 - 105000 Pa), so a linear packing loses the upper levels. They are kept
+# as floats:
+NC_PACKED_FILL = -32768
+NC_PACKED_MAX = 32767
+NC_PACKING = {
+    "temp": (0.005, 250.0),  # 86 - 413 K
+    "tdew": (0.005, 250.0),
+    "skin_temp": (0.005, 250.0),
+    "topo": (0.25, 4000.0),  # -4192 - 12192 m
+}
+
+# The working precision of the data, from the reading through the derivation:
+DTYPE = "float32"
+
+# The netCDF output products: Single profiles or vertical cross sections
+NC_PRODUCTS = ("vprof", "vcross")
+
+# Where the netCDF files are built before written to the output directory in one go:
+# "memory", or a (local) scratch directory. The default temporary directory if empty:
+NC_SCRATCH_PATH = "memory"
+
+# Consecutive granules of a platform at most this far apart (seconds) are
+# aggregated into the same pass:
+PASS_GAP_SEC = 120
 
 # EPSILON = 0.1
 # NODATA = 3.4028235E38 - EPSILON
@@ -18,8 +51,27 @@ NODATA = -9.0
 # W_XX-EUMETSAT-kan,iasi,metopb+kan_C_EUMS_20170419171127_IASI_PW3_02_M01_20170419164952Z_20170419170214Z.hdf
 IASI_FILE_PATTERN = "W_XX-EUMETSAT-{ears_station:3s},iasi,{platform_name2:6s}+{ears_station2:3s}_C_EUMS_{processing_time:%Y%m%d%H%M%S}_IASI_PW3_02_{platform_name:3s}_{start_time:%Y%m%d%H%M%S}Z_{end_time:%Y%m%d%H%M%S}Z"
 
+# The EARS granules, when searching archive directories:
+IASI_FILE_GLOB = "W_XX-EUMETSAT-*,iasi,*.hdf"
+
 # IASI_PW3_02_M01_20160309180258Z_20160309180554Z_N_O_20160309184345Z.h5
-IASI_H5_FILE_PATTERN = "IASI_PW3_02_{platform_name:3s}_{start_time:%Y%m%d%H%M%S}Z_{end_time:%Y%m%d%H%M%S}Z_N_O_{creation_time:%Y%m%d%H%M%S}Z.h5"
+IASI_EUMETSAT_FILE_PATTERN = "IASI_PW3_02_{platform_name:3s}_{start_time:%Y%m%d%H%M%S}Z_{end_time:%Y%m%d%H%M%S}Z_N_O_{creation_time:%Y%m%d%H%M%S}Z"
+IASI_H5_FILE_PATTERN = IASI_EUMETSAT_FILE_PATTERN + ".h5"
+# W_XX-EUMETSAT-mos,IASI,DBNet+metopb+mos_C_EUMS_20161110084055_IASI_PW3_02
+IASI_DBNET_FILE_PATTERN = "W_XX-EUMETSAT-{ears_station:3s},IASI,DBNet+{platform_name:6s}+{ears_station2:3s}_C_EUMS_{start_time:%Y%m%d%H%M%S}_IASI_PW3_02"
+
+# The naming conventions of the granules (without the extension), tried in turn.
+# The netCDF files converted are named alike, with "_" for "+" and ",":
+IASI_FILE_PATTERNS = (
+    IASI_FILE_PATTERN,
+    IASI_EUMETSAT_FILE_PATTERN,
+    IASI_DBNET_FILE_PATTERN,
+)
+
+# Datasets read from the EUMETSAT hdf5 file. Each group is read once and
+# reordered along the FOV dimension in one go:
+PROFILE_DATASETS = ("PWLR/T", "PWLR/P", "PWLR/W", "PWLR/O")
+SURFACE_DATASETS = ("L1C/Latitude", "L1C/Longitude", "PWLR/Ts", "Maps/Height")
 
 VAR_NAMES_AND_TYPES = {
     "temp": ("air_temperature_ml", "f"),
@@ -46,6 +98,15 @@ ATTRIBUTE_NAMES = {
     "intercept": ("add_offset"),
 }
 
+# Half the width of the IASI swath (scan angle +-48.3 deg) at the surface:
+IASI_HALF_SWATH_KM = 1100.0
+# Sampling of the ground track when checking the granule coverage:
+GRANULE_TRACK_STEP_SEC = 30
+# Re-read the TLE's when the cached ones are older than this, relative to the
+# time of the granule:
+TLE_MAX_AGE_DAYS = 2
+TLE_RELOAD_INTERVAL_SEC = 3600
+
 PLATFORMS = {
     "M01": "Metop-B",
     "M02": "Metop-A",
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""The conversion of one IASI level-2 granule to netCDF, shared by the runners."""
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import ExitStack, contextmanager, suppress
+
+from .constants import (
+    DTYPE,
+    NC_CHUNK_PROFILES,
+    NC_COMPRESS_LEVEL,
+    NC_COMPRESSION,
+    NC_FORMAT,
+    NC_PRODUCTS,
+    NC_SCRATCH_PATH,
+    PLATFORMS,
+)
+from .iasi_lvl2 import IasiLvl2
+from .metrics import measure_stage
+from .utils import granule_inside_area, profiles_inside_area
+
+LOG = logging.getLogger(__name__)
+
+# The block size of the copy of the netCDF files from the scratch directory:
+COPY_BUFSIZE = 16 * 1024**2
+
+
+def conversion_options(options):
+    """Get the keyword arguments of convert_granule from the config options"""
+    return {
+        "crop_to_area": options.get("crop_to_area", "false").lower()
+        in ("true", "yes", "1"),
+        "crop_margin": float(options.get("crop_margin_km", 0)) * 1000.0,
+        "dtype": options.get("dtype", DTYPE),
+        "nc_format": options.get("nc_format", NC_FORMAT),
+        "compression": options.get("nc_compression", NC_COMPRESSION),
+        "complevel": int(options.get("nc_compress_level", NC_COMPRESS_LEVEL)),
+        "chunk_profiles": int(options.get("nc_chunk_profiles", NC_CHUNK_PROFILES)),
+        "packing": options.get("nc_packing", "none"),
+        "scratch_path": options.get("nc_scratch_path", NC_SCRATCH_PATH),
+    }
+
+
+def output_prefix(filename, output_path):
+    """Get the path and name (without product and extension) of the netCDF files"""
+    prefix = os.path.basename(filename).split(".")[0]
+    prefix = prefix.replace("+", "_").replace(",", "_")
+    return os.path.join(output_path, prefix)
+
+
+def output_filenames(filename, output_path, products=NC_PRODUCTS):
+    """Get the netCDF filenames of the products converted from a granule"""
+    local_path_prefix = output_prefix(filename, output_path)
+    return [f"{local_path_prefix}_{product}.nc" for product in products]
+
+
+@contextmanager
+def atomic_output(filename):
+    """Open a temporary file next to *filename*, to be renamed to it when closed
+
+    Readers of *filename* never see a partial file, and the rename within the
+    directory is atomic. The temporary file is removed on failure.
+
+    """
+
+    dirname, basename = os.path.split(filename)
+    tmpname = os.path.join(dirname, ".%s.%d.tmp" % (basename, os.getpid()))
+    fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        with os.fdopen(fd, "wb") as fpt:
+            yield fpt
+        os.replace(tmpname, filename)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(tmpname)
+        raise
+
+
+def flush_output(contents, filename):
+    """Write the *contents* (bytes, or the name of a file) to *filename*
+
+    The file is written in one sequential write, under a temporary name, and
+    then renamed.
+
+    """
+
+    with atomic_output(filename) as fpt:
+        if isinstance(contents, str):
+            with open(contents, "rb") as src:
+                shutil.copyfileobj(src, fpt, COPY_BUFSIZE)
+        else:
+            fpt.write(contents)
+
+
+def convert_granule(
+    filename,
+    output_path,
+    area_def=None,
+    platform_name=None,
+    start_time=None,
+    end_time=None,
+    crop_to_area=False,
+    crop_margin=0.0,
+    dtype=DTYPE,
+    products=NC_PRODUCTS,
+    scratch_path=NC_SCRATCH_PATH,
+    metrics=None,
+    **nc_write_options,
+):
+    """Convert a granule to netCDF, if it is inside the area of interest
+
+    The granule swath is first checked against *area_def* (no check if None),
+    and with *crop_to_area* only the scanlines with profiles inside the area
+    plus *crop_margin* (m) are kept. The files are built in memory (with
+    *scratch_path* "memory") or in a local scratch directory (the default
+    temporary directory if empty), where the content shared by the products
+    is written once, and then written to *output_path* in one go and renamed.
+    Return the netCDF filenames, or an empty list if the granule is outside
+    the area. Each step is measured as a stage of the *metrics* given (see
+    metrics.JobMetrics).
+
+    """
+
+    if area_def is not None:
+        platform_name = PLATFORMS.get(platform_name, platform_name)
+        with measure_stage(metrics, "granule_inside_area"):
+            inside = granule_inside_area(start_time, end_time, platform_name, area_def)
+        if not inside:
+            LOG.info("Data outside area of interest. Ignore...")
+            return []
+
+    LOG.info("Read the IASI hdf5 file %s", filename)
+    crop = crop_to_area and area_def is not None
+    with IasiLvl2(filename, lazy=crop, dtype=dtype, metrics=metrics) as l2p:
+        if crop:
+            with measure_stage(metrics, "crop"):
+                inside = profiles_inside_area(
+                    l2p.longitudes, l2p.latitudes, area_def, margin=crop_margin
+                )
+                nprofiles = l2p.crop(inside)
+            if nprofiles == 0:
+                LOG.info("No profiles inside area of interest. Ignore...")
+                return []
+
+        result_files = output_filenames(filename, output_path, products)
+        with ExitStack() as stack:
+            # With lazy loading the data are read and derived while written:
+            with measure_stage(metrics, "ncwrite"):
+                if scratch_path == "memory":
+                    contents = l2p.ncbuild_products(
+                        output_prefix(filename, output_path) + ".nc",
+                        products=products,
+                        **nc_write_options,
+                    )
+                    contents = [content for dummy, content in contents]
+                else:
+                    build_path = stack.enter_context(
+                        tempfile.TemporaryDirectory(dir=scratch_path or None)
+                    )
+                    contents = l2p.ncwrite_products(
+                        output_prefix(filename, build_path) + ".nc",
+                        products=products,
+                        final_path=output_path,
+                        **nc_write_options,
+                    )
+            LOG.debug("Data of the granule held %.1f MB", l2p.nbytes / 1024.0**2)
+
+            with measure_stage(metrics, "flush"):
+                for content, result_file in zip(contents, result_files):
+                    LOG.info("Write netCDF file %s", result_file)
+                    flush_output(content, result_file)
+    return result_files
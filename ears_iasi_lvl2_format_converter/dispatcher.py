@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""An asyncio dispatcher of the conversion jobs, from the messages received to results."""
+import asyncio
+import logging
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+LOG = logging.getLogger(__name__)
+
+
+class Dispatcher(object):
+
+    """Run the conversion jobs of the messages received, on an asyncio event loop
+
+    The messages are taken from the (blocking) *messages* iterator in a
+    thread, and handed to *schedule* on the loop, which registers and queues
+    the jobs in the *scheduler* (see jobs.JobScheduler). No more than
+    *workers* jobs are submitted to the *pool* at a time, so the scheduler
+    decides which granule goes next. A job runs convert(*job.args,
+    job.registered) in a worker, and finish(job) is called when it is done
+    (e.g. to publish the files). *tick* is called every *tick_interval*
+    seconds. The finishes and ticks are run in order in one thread off the
+    loop, so they may block on I/O and share state without locking.
+
+    On stop() (or SIGINT/SIGTERM) no more messages are taken, the jobs still
+    queued are dropped and the jobs running are waited for. When the messages
+    run out, the jobs queued are all run before returning. The thread taking
+    the messages is joined before returning, so *messages* should yield (e.g.
+    None on a receive timeout) now and then.
+
+    """
+
+    def __init__(
+        self,
+        pool,
+        scheduler,
+        jobs,
+        schedule,
+        convert,
+        finish,
+        workers,
+        tick=None,
+        tick_interval=1.0,
+    ):
+        self.pool = pool
+        self.scheduler = scheduler
+        self.jobs = jobs
+        self.schedule = schedule
+        self.convert = convert
+        self.finish = finish
+        self.workers = workers
+        self.tick = tick
+        self.tick_interval = tick_interval
+        self._loop = None
+        self._stopping = None
+        self._wakeup = None
+        self._exhausted = False
+        self._running = set()
+        self._converting = 0
+        self._finisher = None
+
+    @property
+    def running(self):
+        """The number of jobs submitted to the pool and not yet finished"""
+        return len(self._running)
+
+    def stop(self):
+        """Stop receiving messages, and return from run() once the jobs running are done
+
+        Safe to call from any thread.
+
+        """
+
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    async def run(self, messages):
+        """Dispatch the messages until stopped, or the messages run out and are done"""
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._exhausted = False
+        self._add_signal_handlers()
+
+        self._finisher = ThreadPoolExecutor(1, thread_name_prefix="finisher")
+        receiver = ThreadPoolExecutor(1, thread_name_prefix="receiver")
+        receiving = asyncio.ensure_future(self._receive(messages, receiver))
+        ticking = None
+        try:
+            while not self._stopping.is_set():
+                self._dispatch()
+                if self._exhausted and not self._running and not len(self.scheduler):
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.tick_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                if self.tick is not None and (ticking is None or ticking.done()):
+                    ticking = asyncio.ensure_future(self._tick())
+        finally:
+            self._stopping.set()
+            receiving.cancel()
+            # Don't leave the thread inside next(messages), e.g. while the
+            # subscriber is closed:
+            await self._loop.run_in_executor(None, receiver.shutdown, True)
+            LOG.info(
+                "Stopping: Wait for %d jobs running. Drop %d jobs queued",
+                len(self._running),
+                len(self.scheduler),
+            )
+            await asyncio.gather(*self._running, return_exceptions=True)
+            if ticking is not None:
+                await ticking
+            await self._loop.run_in_executor(None, self._finisher.shutdown, True)
+            self._remove_signal_handlers()
+
+    async def _receive(self, messages, receiver):
+        """Take the messages, and schedule their jobs"""
+        while not self._stopping.is_set():
+            msg = await self._loop.run_in_executor(
+                receiver, next, messages, StopIteration
+            )
+            if msg is StopIteration:
+                LOG.info("No more messages")
+                self._exhausted = True
+                self._wakeup.set()
+                return
+            elif msg is not None:
+                self.schedule(msg)
+                self._wakeup.set()
+
+    def _dispatch(self):
+        """Submit the jobs queued, up to the number of workers"""
+        while len(self.scheduler) and self._converting < self.workers:
+            job, dropped = self.scheduler.pop()
+            for stale_job in dropped:
+                self.jobs.release(stale_job.key)
+            if job is None:
+                break
+            job.future = self.pool.submit(self.convert, *job.args, job.registered)
+            self._converting += 1
+            task = asyncio.ensure_future(self._wait_for(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _wait_for(self, job):
+        """Wait for the job to be done, and finish it"""
+        try:
+            await asyncio.wrap_future(job.future)
+        except Exception as err:
+            LOG.warning("Job %s failed: %s", job.key, err)
+        # The worker is free for the next job while this one is finished:
+        self._converting -= 1
+        self._wakeup.set()
+        try:
+            await self._loop.run_in_executor(self._finisher, self.finish, job)
+        except Exception:
+            LOG.exception("Failed to finish job %s", job.key)
+        self._wakeup.set()
+
+    async def _tick(self):
+        try:
+            await self._loop.run_in_executor(self._finisher, self.tick)
+        except Exception:
+            LOG.exception("Failed to run the tick")
+
+    def _add_signal_handlers(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self._loop.add_signal_handler(signum, self._stopping.set)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Not the main thread, or not supported (Windows)
+                return
+
+    def _remove_signal_handlers(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self._loop.remove_signal_handler(signum)
+            except (NotImplementedError, RuntimeError, ValueError):
+                return
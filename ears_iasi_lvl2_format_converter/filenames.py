@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""The parsing of the IASI level-2 filenames, for all known naming conventions."""
+import logging
+import os
+import re
+from collections import namedtuple
+from datetime import timedelta
+from functools import lru_cache
+
+from trollsift import parser
+
+from .constants import IASI_FILE_PATTERNS, NC_PRODUCTS
+
+LOG = logging.getLogger(__name__)
+
+# The granule extensions, and the product suffixes of the netCDF files converted:
+GRANULE_EXTENSIONS = (".h5", ".hdf", ".nc")
+PRODUCT_SUFFIXES = tuple("_" + product for product in NC_PRODUCTS)
+# The nominal length of a granule, when its name has no end time:
+GRANULE_LENGTH = timedelta(minutes=15)
+
+GranuleName = namedtuple(
+    "GranuleName", ["platform_name", "start_time", "end_time", "items"]
+)
+
+
+class FilenameParser(object):
+
+    """Parse filenames with the first of the *patterns* (trollsift) matching
+
+    Each pattern is compiled once to a regular expression, so the patterns
+    not matching are skipped without parsing. The patterns of the netCDF
+    files converted (see conversion.output_prefix) are added. The results
+    are kept per basename.
+
+    """
+
+    def __init__(self, patterns=IASI_FILE_PATTERNS, cache_size=4096):
+        patterns = list(patterns)
+        patterns += [
+            converted
+            for converted in (_converted_pattern(pattern) for pattern in patterns)
+            if converted not in patterns
+        ]
+        self.patterns = patterns
+        self._parsers = [
+            (re.compile(parser.regex_format(pattern)), parser.Parser(pattern))
+            for pattern in patterns
+        ]
+        self.parse = lru_cache(maxsize=cache_size)(self._parse)
+
+    def _parse(self, basename):
+        """Get the GranuleName of the basename. Raise a ValueError if unknown"""
+        stem = granule_stem(basename)
+        for regex, pattern_parser in self._parsers:
+            if regex.fullmatch(stem):
+                items = pattern_parser.parse(stem)
+                end_time = items.get("end_time", items["start_time"] + GRANULE_LENGTH)
+                return GranuleName(
+                    items["platform_name"], items["start_time"], end_time, items
+                )
+        raise ValueError("Unknown IASI level-2 filename: %s" % basename)
+
+
+def granule_stem(basename):
+    """Get the basename without its extension, and netCDF product suffix"""
+    for extension in GRANULE_EXTENSIONS:
+        if basename.endswith(extension):
+            basename = basename[: -len(extension)]
+            break
+    for suffix in PRODUCT_SUFFIXES:
+        if basename.endswith(suffix):
+            return basename[: -len(suffix)]
+    return basename
+
+
+def _converted_pattern(pattern):
+    """Get the pattern of the netCDF files converted from granules of *pattern*"""
+    literals = re.split(r"(\{[^}]*\})", pattern)
+    return "".join(
+        part if part.startswith("{") else part.replace("+", "_").replace(",", "_")
+        for part in literals
+    )
+
+
+# The parser shared by all users in the process:
+FILENAMES = FilenameParser()
+
+
+def parse_filename(filename):
+    """Get the GranuleName (platform name, start and end time) of a file, by its name"""
+    return FILENAMES.parse(os.path.basename(filename))
+
+
+def granule_info(filename):
+    """Get the platform name, start and end time of a granule from its filename"""
+    return parse_filename(filename)[0:3]
@@ -2,155 +2,137 @@
 """A posttroll runner that takes ears-iasi level-2 hdf5 files and convert to netCDF."""
 
 import argparse
+import importlib
 import logging
 import os
 import socket
 import sys
-import tempfile
-import threading
+import time
 from configparser import RawConfigParser
 from datetime import datetime, timedelta
-from multiprocessing import Manager, Pool
-from queue import Empty
+from functools import partial
 from urllib.parse import urlparse
 
-import netifaces
-import posttroll.subscriber
-from posttroll.message import Message
-from posttroll.publisher import Publish
-from pyresample import utils as pr_utils
+# Only the light modules are imported here, so importing the runner (for --help,
+# or in the tests) is fast. The heavy ones are imported when needed:
+from .constants import (
+    DEFAULT_LOG_FORMAT,
+    DEFAULT_TIME_FORMAT,
+    MODE,
+    NC_PRODUCTS,
+    PASS_GAP_SEC,
+)
+from .filenames import parse_filename
+from .jobs import JobRegistry, JobScheduler
+from .metrics import JobMetrics, MetricsFile
 
-from .constants import DEFAULT_LOG_FORMAT, DEFAULT_TIME_FORMAT, MODE, PLATFORMS
-from .iasi_lvl2 import IasiLvl2
-from .utils import convert_to_path, granule_inside_area
+logger = logging.getLogger(__name__)
 
-parser = argparse.ArgumentParser(
-    description="Conversion from ears-iasi level-2 hdf5 data to netCDF."
-)
-parser.add_argument(
-    "-c",
-    "--config-file",
-    help="Config file",
-    default="configs/iasi_level2_config.cfg",
-    type=convert_to_path,
+WORKER_PRELOAD_MODULES = (
+    "h5py",
+    "netCDF4",
+    "pyorbital.orbital",
+    "pyresample",
+    "trollsift",
+    "ears_iasi_lvl2_format_converter.conversion",
 )
-parser.add_argument(
-    "-a",
-    "--areas-file",
-    help="File containing definition of areas.",
-    default="configs/areas.def",
-    type=convert_to_path,
-)
-args = parser.parse_args()
 
-logger = logging.getLogger(__name__)
+# The area definitions of each areas file, parsed once per process (and inherited
+# by the forked workers):
+_AREA_REGISTRIES = {}
 
-logger.debug(f"Reading configs from file {args.config_file}")
-config = RawConfigParser()
-config.read(args.config_file)
 
-OPTIONS = dict(config.items("DEFAULT") + config.items(MODE))
-OUTPUT_PATH = OPTIONS["output_path"]
+class RunnerSettings(object):
 
+    """The settings of the runner, from the config options
 
-def get_local_ips():
-    inet_addrs = [
-        netifaces.ifaddresses(iface).get(netifaces.AF_INET)
-        for iface in netifaces.interfaces()
-    ]
-    return [ip["addr"] for addrs in inet_addrs for ip in addrs if addrs is not None]
+    Built in main() and passed on to the workers with each job, so nothing
+    is read from the command line or the config file on import.
 
+    """
 
-def reset_job_registry(objdict, key):
-    """Remove job key from registry"""
-    logger.debug("Release/reset job-key '%s' from job registry", key)
-    try:
-        objdict.pop(key)
-    except KeyError:
-        logger.warning(
-            "Nothing to reset/release: Register didn't contain any entry matching '%s' ",
-            key,
+    def __init__(self, options, areas_file):
+        from .conversion import conversion_options
+
+        self.options = options
+        self.areas_file = str(areas_file)
+        self.area_of_interest = options["area_of_interest"]
+        self.output_path = options["output_path"]
+        self.servername = options.get("servername", socket.gethostname())
+        # Cropping to the area of interest, working precision, and format,
+        # compression, chunking and packing of the netCDF output:
+        self.conversion_options = conversion_options(options)
+
+        # The worker pool. Zero disables the recycling after a number of jobs or
+        # on memory use:
+        self.workers = int(options.get("workers", 6))
+        self.max_jobs_per_worker = int(options.get("max_jobs_per_worker", 0))
+        self.max_worker_rss_mb = float(options.get("max_worker_rss_mb", 0))
+        # Requests for the same granule within this time (seconds) are not
+        # converted again:
+        self.job_registry_ttl = float(options.get("job_registry_ttl", 300))
+
+        # Bound and scheduling of the jobs waiting for a worker:
+        self.job_queue_size = int(options.get("job_queue_size", 50))
+        self.job_scheduling = options.get("job_scheduling", "newest")
+        self.job_max_age = float(options.get("job_max_age", 0)) or None
+        self.stale_jobs = options.get("stale_jobs", "defer")
+        self.queue_report_interval = float(options.get("queue_report_interval", 60))
+
+        # Aggregation of consecutive granules into one file per pass:
+        self.aggregate_passes = options.get("aggregate_passes", "false").lower() in (
+            "true",
+            "yes",
+            "1",
         )
+        self.pass_gap = float(options.get("pass_gap_sec", PASS_GAP_SEC))
+        self.pass_idle_close = float(options.get("pass_idle_close_sec", 900))
 
+        # The metrics of the jobs, summed up for scraping. No file if empty:
+        self.metrics_file = options.get("metrics_file", "")
 
-class FilePublisher(threading.Thread):
+        # The index of the profiles converted, for nearest profile queries. None
+        # if empty:
+        self.profile_index_path = options.get("profile_index_path", "")
+        self.profile_index_compact = int(options.get("profile_index_compact", 100))
 
-    """A publisher for the iasi level2 netCDF files. Picks up the return value from
-    the format_conversion when ready, and publishes the files via posttroll
+    @classmethod
+    def from_config(cls, config_file, areas_file, mode=MODE):
+        """Read the settings of the *mode* from the config file"""
+        logger.debug("Reading configs from file %s", config_file)
+        config = RawConfigParser()
+        config.read(config_file)
+        return cls(dict(config.items("DEFAULT") + config.items(mode)), areas_file)
 
-    """
+    def area_def(self):
+        """Get the area of interest, the areas file being parsed once per process"""
+        from .utils import AreaRegistry
+
+        if self.areas_file not in _AREA_REGISTRIES:
+            _AREA_REGISTRIES[self.areas_file] = AreaRegistry(self.areas_file)
+        return _AREA_REGISTRIES[self.areas_file].get(self.area_of_interest)
 
-    def __init__(self, queue):
-        super().__init__()
-        self.loop = True
-        self.queue = queue
-        self.jobs = {}
-
-    def stop(self):
-        """Stops the file publisher"""
-        self.loop = False
-        self.queue.put(None)
-
-    def run(self):
-        with Publish("ears_iasi_lvl2_converter", 0, ["netCDF/3"]) as publisher:
-            while self.loop:
-                retv = self.queue.get()
-                if retv is not None:
-                    logger.info("Publish the IASI level-2 netcdf file")
-                    publisher.send(retv)
-
-
-class FileListener(threading.Thread):
-    """A file listener class, to listen for incoming messages with a
-    relevant file for further processing"""
-
-    def __init__(self, queue):
-        super().__init__()
-        self.loop = True
-        self.queue = queue
-
-    def stop(self):
-        """Stops the file listener"""
-        self.loop = False
-        self.queue.put(None)
-
-    def run(self):
-        with posttroll.subscriber.Subscribe(
-            "", [OPTIONS["posttroll_topic"]], True
-        ) as subscr:
-            for msg in subscr.recv(timeout=90):
-                if not self.loop:
-                    break
-
-                if self.check_message(msg):
-                    logger.debug("Relevant msg detected. Put it in the queue.")
-                    self.queue.put(msg)
-
-    def check_message(self, msg):
-        if not msg:
-            return False
-
-        urlobj = urlparse(msg.data["uri"])
-        server = urlobj.netloc
-        url_ip = socket.gethostbyname(urlobj.netloc)
-        if urlobj.netloc and (url_ip not in get_local_ips()):
-            logger.warning(
-                "Server %s not the current one: %s", server, socket.gethostname()
-            )
-            return False
 
-        if "platform_name" not in msg.data or "start_time" not in msg.data:
-            logger.warning("Message is lacking crucial fields...")
-            return False
+def receive_messages(subscriber, message_filter, timeout=1):
+    """Get the relevant messages received, and None every *timeout* seconds idle"""
+    for msg in subscriber.recv(timeout=timeout):
+        if msg is None or message_filter(msg):
+            yield msg
 
-        logger.debug("Ok: message = %s", str(msg))
-        return True
 
+def warm_up_worker(settings):
+    """Prepare a conversion worker: Load the heavy modules and the caches once"""
+    for module in WORKER_PRELOAD_MODULES:
+        importlib.import_module(module)
+    settings.area_def()
+    logger.debug("Worker %d ready", os.getpid())
 
-def create_message(resultfile, mda):
+
+def create_message(resultfile, mda, servername=None):
     """Create the posttroll message"""
+    from posttroll.message import Message
 
-    servername = OPTIONS.get("servername", socket.gethostname())
+    servername = servername or socket.gethostname()
     to_send = mda.copy()
     to_send["uri"] = f"ssh://{servername}/{resultfile}"
     to_send["uid"] = resultfile
@@ -170,52 +152,48 @@ def create_message(resultfile, mda):
     ).encode()
 
 
-def format_conversion(mda, scene, job_id, publish_q):
-    """Read the hdf5 file and add parameters and convert to netCDF"""
-    try:
-        logger.debug("IASI L2 format converter: Start...")
+def format_conversion(settings, mda, scene, job_id):
+    """Read the hdf5 file and add parameters and convert to netCDF
 
-        dummy, fname = os.path.split(scene["filename"])
-        tempfile.tempdir = OUTPUT_PATH
+    Return the netCDF files and the metrics of the job (logged as one line).
+    The time waited in the queues is counted from the registration *job_id*.
 
-        area_def = pr_utils.load_area(args.areas_file, OPTIONS["area_of_interest"])
+    """
+    from .conversion import convert_granule
+
+    metrics = JobMetrics(
+        os.path.basename(scene["filename"]),
+        received=job_id if isinstance(job_id, datetime) else None,
+    )
+    try:
+        logger.debug("IASI L2 format converter: Start...")
         logger.debug("Platform name = %s", scene["platform_name"])
 
-        # Check if the granule is inside the area of interest:
-        inside = granule_inside_area(
-            scene["starttime"],
-            scene["endtime"],
-            PLATFORMS.get(scene["platform_name"], scene["platform_name"]),
-            area_def,
+        with metrics.stage("load_area"):
+            area_def = settings.area_def()
+        result_files = convert_granule(
+            scene["filename"],
+            settings.output_path,
+            area_def=area_def,
+            platform_name=scene["platform_name"],
+            start_time=scene["starttime"],
+            end_time=scene["endtime"],
+            products=NC_PRODUCTS,
+            metrics=metrics,
+            **settings.conversion_options,
         )
-
-        if not inside:
-            logger.info("Data outside area of interest. Ignore...")
-            return
-
-        # File conversion hdf5 -> nc:
-        logger.info("Read the IASI hdf5 file %s", scene["filename"])
-        l2p = IasiLvl2(scene["filename"])
-        nctmpfilename = tempfile.mktemp()
-        l2p.ncwrite(nctmpfilename)
-        _tmp_nc_filename = fname.split(".")[0]
-        _tmp_nc_filename_r1 = _tmp_nc_filename.replace("+", "_")
-        _tmp_nc_filename = _tmp_nc_filename_r1.replace(",", "_")
-
-        local_path_prefix = os.path.join(OUTPUT_PATH, _tmp_nc_filename)
-        result_file = f"{local_path_prefix}_vprof.nc"
-        logger.info("Rename netCDF file %s to %s", l2p.nc_filename, result_file)
-        os.rename(l2p.nc_filename, result_file)
-
-        nctmpfilename = tempfile.mktemp()
-        result_file = f"{local_path_prefix}_vcross.nc"
-        l2p.ncwrite(nctmpfilename, vprof=False)
-        logger.info("Rename netCDF file %s to %s", l2p.nc_filename, result_file)
-        os.rename(l2p.nc_filename, result_file)
-
-        pubmsg = create_message(result_file, mda)
-        logger.info("Sending: %s", pubmsg)
-        publish_q.put(pubmsg)
+        if not result_files:
+            metrics.status = "outside"
+            return result_files, metrics.log()
+
+        if not settings.aggregate_passes and settings.profile_index_path:
+            with metrics.stage("index"):
+                index_profiles(
+                    settings.profile_index_path,
+                    result_files,
+                    scene["starttime"],
+                    scene["endtime"],
+                )
 
         if isinstance(job_id, datetime):
             dt_ = datetime.utcnow() - job_id
@@ -227,96 +205,262 @@ def format_conversion(mda, scene, job_id, publish_q):
             )
         else:
             logger.warning("Job entry is not a datetime instance: %s", job_id)
+        metrics.status = "converted"
+        return result_files, metrics.log()
 
     except:
         logger.exception("Failed in IASI L2 format converter...")
+        metrics.status = "failed"
+        metrics.log()
         raise
 
 
-def iasi_level2_runner():
-    """Listens and triggers processing"""
+def index_profiles(index_path, result_files, start_time, end_time):
+    """Add the profiles of the vprof file to the profile index"""
+    from .profile_index import ProfileIndex
 
-    logger.info("*** Start the extraction and conversion of ears iasi level2 profiles")
+    for result_file in result_files:
+        if result_file.endswith("_vprof.nc"):
+            ProfileIndex(index_path).add(result_file, start_time, end_time)
 
-    pool = Pool(processes=6, maxtasksperchild=1)
-    manager = Manager()
-    listener_q = manager.Queue()
-    publisher_q = manager.Queue()
-
-    pub_thread = FilePublisher(publisher_q)
-    pub_thread.start()
-    listen_thread = FileListener(listener_q)
-    listen_thread.start()
-
-    jobs_dict = {}
-    while True:
-        try:
-            msg = listener_q.get()
-        except Empty:
-            logger.debug("Empty listener queue...")
-            continue
-
-        logger.debug("Number of threads currently alive: %d", threading.active_count())
-
-        if "start_time" in msg.data:
-            start_time = msg.data["start_time"]
-        elif "nominal_time" in msg.data:
-            start_time = msg.data["nominal_time"]
-        else:
-            logger.warning("Neither start_time nor nominal_time in message!")
-            start_time = None
 
-        if "end_time" in msg.data:
-            end_time = msg.data["end_time"]
-        else:
-            logger.warning("No end_time in message!")
-            end_time = start_time + timedelta(seconds=60 * 15) if start_time else None
-        if not start_time or not end_time:
-            logger.warning("Missing either start_time or end_time or both!")
-            logger.warning("Ignore message and continue...")
-            continue
-
-        sensor = str(msg.data["sensor"])
-        platform_name = msg.data["platform_name"]
-
-        keyname = f"{platform_name}_{start_time.strftime('%Y%m%d%H%M')}"
-
-        jobs_dict[keyname] = datetime.now()
-
-        urlobj = urlparse(msg.data["uri"])
-        path, fname = os.path.split(urlobj.path)
-        logger.debug("path %s, filename = %s", path, fname)
-
-        scene = {
-            "platform_name": platform_name,
-            "starttime": start_time,
-            "endtime": end_time,
-            "sensor": sensor,
-            "filename": urlobj.path,
-        }
-
-        # if keyname not in jobs_dict:
-        #    LOG.warning("Scene-run seems unregistered! Forget it...")
-        #    continue
-        pool.apply_async(
-            format_conversion, (msg.data, scene, jobs_dict[keyname], publisher_q)
+def make_scene(msg):
+    """Get the scene to convert from the message. Return None if it is incomplete
+
+    The times missing in the message are taken from the filename.
+
+    """
+
+    urlobj = urlparse(msg.data["uri"])
+    path, fname = os.path.split(urlobj.path)
+    logger.debug("path %s, filename = %s", path, fname)
+    try:
+        granule = parse_filename(fname)
+    except ValueError:
+        granule = None
+
+    if "start_time" in msg.data:
+        start_time = msg.data["start_time"]
+    elif "nominal_time" in msg.data:
+        start_time = msg.data["nominal_time"]
+    elif granule is not None:
+        start_time = granule.start_time
+    else:
+        logger.warning("Neither start_time nor nominal_time in message!")
+        start_time = None
+
+    if "end_time" in msg.data:
+        end_time = msg.data["end_time"]
+    elif granule is not None:
+        end_time = granule.end_time
+    else:
+        logger.warning("No end_time in message!")
+        end_time = start_time + timedelta(seconds=60 * 15) if start_time else None
+    if not start_time or not end_time:
+        logger.warning("Missing either start_time or end_time or both!")
+        logger.warning("Ignore message and continue...")
+        return None
+
+    return {
+        "platform_name": msg.data["platform_name"],
+        "starttime": start_time,
+        "endtime": end_time,
+        "sensor": str(msg.data["sensor"]),
+        "filename": urlobj.path,
+    }
+
+
+def schedule_message(msg, jobs, scheduler):
+    """Register a conversion job for the message and queue it, unless a duplicate"""
+
+    scene = make_scene(msg)
+    if scene is None:
+        return
+
+    keyname = f"{scene['platform_name']}_{scene['starttime'].strftime('%Y%m%d%H%M')}"
+    job, is_new = jobs.register(keyname)
+    if not is_new:
+        logger.info(
+            "Granule %s already %s. Ignore duplicate...",
+            keyname,
+            "being converted" if job.in_flight else "converted",
         )
+        return
+
+    job.args = (msg.data, scene)
+    for dropped in scheduler.put(job, scene["starttime"], scene["platform_name"]):
+        jobs.release(dropped.key)
+
+
+def finish_job(job, settings, aggregator, metrics_file, profile_index, publish):
+    """Publish the netCDF files of a finished job, and add its metrics
+
+    With the aggregation the files are added to the pass instead, and the
+    passes closed by the granule are published.
 
-        # Block any future run on this scene for x minutes from now
-        # x = 5
-        thread_job_registry = threading.Timer(
-            5 * 60.0, reset_job_registry, args=(jobs_dict, keyname)
+    """
+    if job.duplicates:
+        logger.info("Job %s got %d duplicate requests", job.key, job.duplicates)
+    if job.failed:
+        if metrics_file is not None:
+            metrics_file.add_failed()
+            metrics_file.write()
+        return
+    result_files, metrics = job.future.result()
+    if metrics_file is not None:
+        metrics_file.add(metrics)
+        metrics_file.write()
+    if profile_index is not None:
+        if len(profile_index.pending()) >= settings.profile_index_compact:
+            profile_index.compact()
+    if not result_files:
+        return
+    mda, scene = job.args
+    if aggregator is None:
+        pubmsg = create_message(result_files[-1], mda, settings.servername)
+        logger.info("Sending: %s", pubmsg)
+        publish(pubmsg)
+        return
+    for granule_pass in aggregator.add(
+        result_files, scene["platform_name"], scene["starttime"], scene["endtime"], mda
+    ):
+        publish_pass(granule_pass, settings, publish)
+
+
+def publish_pass(granule_pass, settings, publish):
+    """Publish the netCDF files of a closed pass"""
+    if settings.profile_index_path:
+        index_profiles(
+            settings.profile_index_path,
+            granule_pass.filenames,
+            granule_pass.start_time,
+            granule_pass.end_time,
         )
-        thread_job_registry.start()
+    mda = dict(
+        granule_pass.metadata,
+        start_time=granule_pass.start_time,
+        end_time=granule_pass.end_time,
+    )
+    pubmsg = create_message(granule_pass.filenames[-1], mda, settings.servername)
+    logger.info("Sending: %s", pubmsg)
+    publish(pubmsg)
+
 
-    pool.close()
-    pool.join()
+def iasi_level2_runner(settings):
+    """Listens and triggers processing"""
+    import asyncio
+
+    import posttroll.subscriber
+    from posttroll.publisher import Publish
 
-    pub_thread.stop()
-    listen_thread.stop()
+    from .aggregation import PassAggregator
+    from .dispatcher import Dispatcher
+    from .message_filter import MessageFilter
+    from .profile_index import ProfileIndex
+    from .workers import WorkerPool
 
+    logger.info("*** Start the extraction and conversion of ears iasi level2 profiles")
+
+    # Parse the areas before the workers are forked:
+    settings.area_def()
+    pool = WorkerPool(
+        settings.workers,
+        initializer=warm_up_worker,
+        initargs=(settings,),
+        max_jobs_per_worker=settings.max_jobs_per_worker,
+        max_rss_mb=settings.max_worker_rss_mb,
+    )
+    jobs = JobRegistry(ttl=settings.job_registry_ttl)
+    scheduler = JobScheduler(
+        maxsize=settings.job_queue_size,
+        policy=settings.job_scheduling,
+        max_age=settings.job_max_age,
+        stale=settings.stale_jobs,
+    )
+    aggregator = None
+    if settings.aggregate_passes:
+        aggregator = PassAggregator(
+            settings.output_path,
+            gap=settings.pass_gap,
+            compression=settings.conversion_options["compression"],
+            complevel=settings.conversion_options["complevel"],
+            chunk_profiles=settings.conversion_options["chunk_profiles"],
+        )
+    metrics_file = MetricsFile(settings.metrics_file) if settings.metrics_file else None
+    profile_index = None
+    if settings.profile_index_path:
+        profile_index = ProfileIndex(settings.profile_index_path)
+    message_filter = MessageFilter.from_options(settings.options)
+
+    with Publish("ears_iasi_lvl2_converter", 0, ["netCDF/3"]) as publisher:
+        last_report = time.monotonic()
+
+        def tick():
+            nonlocal last_report
+            # Keep the lookups of the hosts and local addresses out of the message
+            # reception:
+            message_filter.resolver.refresh()
+            if aggregator is not None:
+                for granule_pass in aggregator.close_idle(settings.pass_idle_close):
+                    publish_pass(granule_pass, settings, publisher.send)
+            if time.monotonic() - last_report > settings.queue_report_interval:
+                last_report = time.monotonic()
+                logger.info(
+                    "Queue depths: scheduler=%s, running=%d",
+                    scheduler.stats(),
+                    dispatcher.running,
+                )
+
+        # The granules are appended to the passes in the order they finish:
+        dispatcher = Dispatcher(
+            pool,
+            scheduler,
+            jobs,
+            schedule=lambda msg: schedule_message(msg, jobs, scheduler),
+            convert=partial(format_conversion, settings),
+            finish=lambda job: finish_job(
+                job, settings, aggregator, metrics_file, profile_index, publisher.send
+            ),
+            workers=settings.workers,
+            tick=tick,
+        )
+        with posttroll.subscriber.Subscribe(
+            "", [settings.options["posttroll_topic"]], True
+        ) as subscr:
+            asyncio.run(dispatcher.run(receive_messages(subscr, message_filter)))
+
+        pool.shutdown()
+        if aggregator is not None:
+            for granule_pass in aggregator.close_all():
+                publish_pass(granule_pass, settings, publisher.send)
+    if profile_index is not None:
+        profile_index.compact()
+
+
+def get_arguments(argv=None):
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Conversion from ears-iasi level-2 hdf5 data to netCDF."
+    )
+    parser.add_argument(
+        "-c",
+        "--config-file",
+        help="Config file",
+        default="configs/iasi_level2_config.cfg",
+    )
+    parser.add_argument(
+        "-a",
+        "--areas-file",
+        help="File containing definition of areas.",
+        default="configs/areas.def",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_arguments(argv)
+    from .utils import convert_to_path
 
-def main():
     handler = logging.StreamHandler(sys.stderr)
     handler.setLevel(logging.DEBUG)
     formatter = logging.Formatter(fmt=DEFAULT_LOG_FORMAT, datefmt=DEFAULT_TIME_FORMAT)
@@ -325,4 +469,7 @@ def main():
     logging.getLogger("").setLevel(logging.DEBUG)
     logging.getLogger("posttroll").setLevel(logging.INFO)
 
-    iasi_level2_runner()
+    settings = RunnerSettings.from_config(
+        convert_to_path(args.config_file), convert_to_path(args.areas_file)
+    )
+    iasi_level2_runner(settings)
@@ -5,23 +5,35 @@ Reads hdf5 file and derives some quantities and outputs a netCDF file.
 """
 import logging
 import os
-from datetime import datetime, timedelta
+import shutil
+from datetime import datetime
+from functools import lru_cache, partial
 
 import h5py
 import numpy as np
 from netCDF4 import Dataset
-from trollsift import parser
 
 from .constants import (
     ATTRIBUTE_NAMES,
     DATA_UPPER_LIMIT,
-    IASI_FILE_PATTERN,
+    DTYPE,
+    NC_CHUNK_PROFILES,
     NC_COMPRESS_LEVEL,
+    NC_COMPRESSION,
+    NC_FORMAT,
+    NC_PACKED_FILL,
+    NC_PACKED_MAX,
+    NC_PACKING,
+    NC_PRODUCTS,
     NODATA,
     PLATFORMS,
+    PROFILE_DATASETS,
+    SURFACE_DATASETS,
     SURFACE_VAR_NAMES_AND_TYPES,
     VAR_NAMES_AND_TYPES,
 )
+from .filenames import granule_info
+from .metrics import measure_stage
 
 LOG = logging.getLogger(__name__)
 
@@ -81,9 +93,118 @@ def qair2tdew(q__, t__, p__):
     return rhel2tdew(t__, rhel)
 
 
+def dew_point_temperature(qair, temp, press, out=None, dtype=np.float32):
+    """Get the dew point temperature (K) from the specific humidity
+
+    The same as qair2tdew, fused and computed in place in *dtype*. *temp*
+    is the temperature in K and *press* the pressure in Pa. The relative
+    humidity is clipped at 100% by taking the minimum of log(e/6.112) and
+    log(es/6.112), so no exp and only one log is needed. Values above
+    DATA_UPPER_LIMIT, masked input values, and a non-positive vapour pressure
+    are masked in the result. Return a masked array, using *out* for the data
+    if given.
+
+    """
+
+    q__ = np.ma.getdata(qair)
+    t__ = np.ma.getdata(temp)
+    p__ = np.ma.getdata(press)
+    shape = np.broadcast_shapes(q__.shape, t__.shape, p__.shape)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    work = np.empty(shape, dtype=out.dtype)
+
+    valid = np.ones(shape, dtype=bool)
+    for arr in (qair, temp, press):
+        np.logical_and(valid, np.ma.getdata(arr) <= DATA_UPPER_LIMIT, out=valid)
+        mask = np.ma.getmask(arr)
+        if mask is not np.ma.nomask:
+            np.logical_and(valid, ~mask, out=valid)
+
+    with np.errstate(all="ignore"):
+        # log(es/6.112) = 17.67 * (T - 273.15) / (T - 273.15 + 243.5):
+        np.subtract(t__, 29.65, out=work)
+        np.subtract(t__, 273.15, out=out)
+        np.multiply(out, 17.67, out=out)
+        np.divide(out, work, out=out)
+        # log(e/6.112), with e = q * p / (0.378 * q + 0.622) and p in hPa:
+        np.multiply(q__, 0.378 * 611.2, out=work)
+        np.add(work, 0.622 * 611.2, out=work)
+        np.divide(p__, work, out=work)
+        np.multiply(work, q__, out=work)
+        np.log(work, out=work)
+        np.minimum(work, out, out=out)
+        # Td = x * 243.5 / (17.67 - x), x = log(e/6.112):
+        np.subtract(17.67, out, out=work)
+        np.multiply(out, 243.5, out=out)
+        np.divide(out, work, out=out)
+        np.add(out, 273.15, out=out)
+    np.logical_and(valid, np.isfinite(out), out=valid)
+
+    return np.ma.masked_array(out, mask=~valid)
+
+
+@lru_cache(maxsize=8)
+def fov_reorder_index(nlines, nfov):
+    """Get the permutation reordering the (nlines, nfov) FOV's into profiles.
+
+    The layout of the IASI lvl2 data is kind of special: The 4 FOV dwells are
+    split and treated as four independent pixels. So, one 'scanline' is thus
+    actually only considering two of the four FOV's in each dwell. The index is
+    the same for all granules of the same shape, so it is cached. The returned
+    array is read-only.
+
+    """
+    dwell = np.arange(0, nlines * nfov, 4).reshape(nlines, nfov // 4)
+    idx = np.empty((nlines, 2, nfov // 4, 2), dtype=dwell.dtype)
+    idx[:, 0, :, 0] = dwell + 3
+    idx[:, 0, :, 1] = dwell
+    idx[:, 1, :, 0] = dwell + 2
+    idx[:, 1, :, 1] = dwell + 1
+    idx = idx.ravel()
+    idx.flags.writeable = False
+    return idx
+
+
+def read_reordered(h5f, names, idx, dtype=None):
+    """Read the hdf5 datasets and reorder them all along the FOV's.
+
+    All datasets must share the leading (nlines, nfov) dimensions. Each dataset
+    is read only once, into a buffer reused for all datasets, and gathered with
+    *idx* into its slot of an array of shape (len(names), ..., len(idx)). The
+    data are converted to *dtype* (if given) by HDF5 while reading.
+
+    """
+    dsets = [h5f[name] for name in names]
+    if dtype is None:
+        dtype = np.result_type(*[dset.dtype for dset in dsets])
+    nlines, nfov = dsets[0].shape[0:2]
+    rest = dsets[0].shape[2:]
+
+    buffer = np.empty((nlines, nfov) + rest, dtype=dtype)
+    fovs_last = np.moveaxis(buffer.reshape((nlines * nfov,) + rest), 0, -1)
+    result = np.empty((len(dsets),) + rest + (idx.size,), dtype=dtype)
+    for dset, out in zip(dsets, result):
+        dset.read_direct(buffer)
+        np.take(fovs_last, idx, axis=-1, out=out)
+    return result
+
+
+def _as_profile_cube(data):
+    """Add the y-dimension, and for surface fields the level dimension, to the data"""
+    if data.ndim == 1:
+        return data[np.newaxis, np.newaxis, :]
+    return data[:, np.newaxis, :]
+
+
 class geophys_parameter(object):
 
-    """Container for the geophysical parameter"""
+    """Container for the geophysical parameter
+
+    The data may be given as a callable returning the data, in which case it
+    is only loaded when first accessed, and then kept.
+
+    """
 
     def __init__(self, data, unit, longname, standardname):
         self.data = data
@@ -92,26 +213,71 @@ class geophys_parameter(object):
         self.standardname = standardname
         # self.validrange = None
 
+    @property
+    def data(self):
+        """The data, loaded on first access if deferred"""
+        if callable(self._data):
+            self._data = self._data()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    @property
+    def loaded(self):
+        """Tell if the data have been loaded"""
+        return not callable(self._data)
+
+
+class _NcVariableLoader(object):
+
+    """Deferred read of the first time step of a netCDF variable"""
+
+    def __init__(self, ncvar, dtype):
+        self.ncvar = ncvar
+        self.dtype = dtype
+
+    def __call__(self):
+        return self.ncvar[0, :].astype(self.dtype, copy=False)
+
+
+class _CroppedLoader(object):
+
+    """Deferred load of data, keeping only the selected profiles"""
+
+    def __init__(self, loader, keep):
+        self.loader = loader
+        self.keep = keep
+
+    def __call__(self):
+        return self.loader()[..., self.keep]
+
 
 class IasiLvl2(object):
 
-    """Extracting the IASI level-2 information from hdf5 files"""
+    """Extracting the IASI level-2 information from hdf5 files
+
+    With *lazy* set the file is kept open and only the geolocation is read up
+    front. Each parameter is read, reordered and derived when its data are
+    first accessed. Call close() (or use the instance as a context manager)
+    when done. The data are read and derived in the working precision *dtype*.
+    The reading and derivation are measured as stages of the *metrics* given.
 
-    def __init__(self, filename):
+    """
+
+    def __init__(self, filename, lazy=False, dtype=DTYPE, metrics=None):
         self.latitudes = None
         self.longitudes = None
         if filename.endswith(".h5"):
-            prefix = filename.strip(".h5")
             self.h5_filename = filename
             self.nc_filename = os.path.basename(filename).replace(".h5", ".nc")
         elif filename.endswith(".hdf"):
-            prefix = filename.strip(".hdf")
             self.h5_filename = filename
             self.nc_filename = os.path.basename(filename).replace(".hdf", ".nc")
         else:
             self.h5_filename = None
             self.nc_filename = filename
-            prefix = filename.strip(".nc").strip("_vcross").strip("_vprof")
 
         self.temp = None
         self.skin_temp = None
@@ -126,198 +292,354 @@ class IasiLvl2(object):
 
         # Location of profile as a string e.g. as in 'N1578;W04600'
         self.locations = None
-        piasi = parser.Parser(IASI_FILE_PATTERN)
-        items = piasi.parse(os.path.basename(prefix))
-        self.start_time = items["start_time"]
-        if "end_time" in items:
-            self.end_time = items["end_time"]
-        else:
-            self.end_time = self.start_time + timedelta(seconds=15 * 60)
-
-        self.platform_name = PLATFORMS.get(items["platform_name"], items["platform_name"])
+        platform_name, self.start_time, self.end_time = granule_info(filename)
+        self.platform_name = PLATFORMS.get(platform_name, platform_name)
         self.time_origo = datetime(2000, 1, 1)
 
+        self.lazy = lazy
+        self.dtype = np.dtype(dtype)
+        self._h5f = None
+        self._ncf = None
+        self._read = None
+        self._metrics = metrics
         if self.h5_filename:
             self._load()
         else:
             self._loadnc()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the file(s) kept open for lazy loading"""
+        if self._h5f is not None:
+            self._h5f.close()
+            self._h5f = None
+        if self._ncf is not None:
+            self._ncf.close()
+            self._ncf = None
+
     def _loadnc(self):
         rootgrp = Dataset(self.nc_filename, "r")
-        self.pres = geophys_parameter(
-            rootgrp.variables["air_pressure"][0, :],
-            rootgrp.variables["air_pressure"].units,
-            rootgrp.variables["air_pressure"].long_name,
-            rootgrp.variables["air_pressure"].standard_name,
-        )
+        try:
+            for key in ("pres", "temp", "tdew", "qspec", "ozone"):
+                ncvar = rootgrp.variables[VAR_NAMES_AND_TYPES[key][0]]
+                setattr(
+                    self,
+                    key,
+                    geophys_parameter(
+                        _NcVariableLoader(ncvar, self.dtype),
+                        ncvar.units,
+                        ncvar.long_name,
+                        ncvar.standard_name,
+                    ),
+                )
+                if not self.lazy:
+                    getattr(self, key).data
+
+            self.locations = decode_names(rootgrp.variables["vcross_name"][:])
+            self.latitudes = rootgrp.variables["latitude"][:]
+            self.longitudes = rootgrp.variables["longitude"][:]
+        except BaseException:
+            rootgrp.close()
+            raise
+
+        if self.lazy:
+            self._ncf = rootgrp
+        else:
+            rootgrp.close()
+
+    def _load(self):
+        """Load the original EUMETSAT hdf5 data"""
+
+        with measure_stage(self._metrics, "read"):
+            h5f = h5py.File(self.h5_filename, "r")
+            try:
+                nlines, nfov, nlevels = h5f[PROFILE_DATASETS[0]].shape
+                self._idx = fov_reorder_index(nlines, nfov)
+                if self.lazy:
+                    lats, lons = read_reordered(
+                        h5f, SURFACE_DATASETS[0:2], self._idx, dtype=self.dtype
+                    )
+            except BaseException:
+                h5f.close()
+                raise
+
+            if self.lazy:
+                self._h5f = h5f
+                self._read = self._read_h5_dataset
+            else:
+                with h5f:
+                    profiles = read_reordered(
+                        h5f, PROFILE_DATASETS, self._idx, dtype=self.dtype
+                    )
+                    surface = read_reordered(
+                        h5f, SURFACE_DATASETS, self._idx, dtype=self.dtype
+                    )
+                lats, lons = surface[0:2]
+                datasets = dict(zip(PROFILE_DATASETS, profiles))
+                datasets.update(zip(SURFACE_DATASETS, surface))
+                self._read = lambda name: _as_profile_cube(datasets[name])
+
+        self.latitudes = lats[np.newaxis, :]
+        self.longitudes = lons[np.newaxis, :]
+
+        self.shape = (nlevels, 1, self._idx.size)
         self.temp = geophys_parameter(
-            rootgrp.variables["air_temperature_ml"][0, :],
-            rootgrp.variables["air_temperature_ml"].units,
-            rootgrp.variables["air_temperature_ml"].long_name,
-            rootgrp.variables["air_temperature_ml"].standard_name,
+            lambda: self._read("PWLR/T"), "K", "Air temperature", "air_temperature_ml"
+        )
+        self.pres = geophys_parameter(
+            self._load_pressure, "Pa", "Air Pressure", "air_pressure"
         )
         self.tdew = geophys_parameter(
-            rootgrp.variables["dew_point_temperature"][0, :],
-            rootgrp.variables["dew_point_temperature"].units,
-            rootgrp.variables["dew_point_temperature"].long_name,
-            rootgrp.variables["dew_point_temperature"].standard_name,
+            self._load_dew_point,
+            "K",
+            "Dew Point Temperature",
+            "dew_point_temperature",
         )
+        # Water vapour mixing ratio:
         self.qspec = geophys_parameter(
-            rootgrp.variables["specific_humidity_ml"][0, :],
-            rootgrp.variables["specific_humidity_ml"].units,
-            rootgrp.variables["specific_humidity_ml"].long_name,
-            rootgrp.variables["specific_humidity_ml"].standard_name,
+            lambda: self._load_masked("PWLR/W"),
+            #'kg/kg',
+            "1",
+            "Specific Humidity",
+            "specific_humidity_ml",
         )
         self.ozone = geophys_parameter(
-            rootgrp.variables["mass_fraction_of_ozone_in_air"][0, :],
-            rootgrp.variables["mass_fraction_of_ozone_in_air"].units,
-            rootgrp.variables["mass_fraction_of_ozone_in_air"].long_name,
-            rootgrp.variables["mass_fraction_of_ozone_in_air"].standard_name,
+            lambda: self._load_masked("PWLR/O"),
+            "1",
+            "Ozone mixing ratio vertical profile",
+            "fraction_of_ozone_in_air",
         )
 
-        locs = rootgrp.variables["vcross_name"][:]
-        locations = []
-        for idx in range(locs.shape[0]):
-            locations.append(locs[idx].tobytes().decode("utf-8"))
+        # Surface 2d variables:
+        self.skin_temp = geophys_parameter(
+            lambda: self._load_masked("PWLR/Ts"),
+            "K",
+            "Surface skin temperature",
+            "surface_temperature",
+        )
+        self.topo = geophys_parameter(
+            lambda: self._load_masked("Maps/Height"),
+            "m",
+            "Topography",
+            "surface_elevation",
+        )
 
-        self.locations = np.array(locations)
-        self.latitudes = rootgrp.variables["latitude"][:]
-        self.longitudes = rootgrp.variables["longitude"][:]
+        if not self.lazy:
+            with measure_stage(self._metrics, "derive"):
+                for param in (self.temp, self.pres, self.tdew, self.qspec, self.ozone):
+                    param.data
+                self.skin_temp.data
+                self.topo.data
+            self._read = None
+
+        # stime_day = h5f['L1C']['SensingTime_day'][:]
+        # msec = h5f['L1C']['SensingTime_msec'][:]
+        # dtobj_arr = np.array([(self.time_origo +
+        #                        timedelta(days=int(stime_day[idx])) +
+        #                        timedelta(microseconds=int(msec[idx])))
+        #                       for idx in range(stime_day.shape[0])])
+        # self.start_time = dtobj_arr.min()
+        # self.end_time = dtobj_arr.max()
+        self.shape_2d = self.latitudes.shape
+        # self.time_shape = stime_day.shape
+        self.time_shape = (1,)
+
+    def _read_h5_dataset(self, name):
+        """Read one dataset from the open hdf5 file and reorder the FOV's"""
+        return _as_profile_cube(
+            read_reordered(self._h5f, (name,), self._idx, dtype=self.dtype)[0]
+        )
 
-        rootgrp.close()
+    def _load_masked(self, name):
+        """Load a dataset masking the data above the data upper limit
 
-    def _load(self):
-        """Load the original EUMETSAT hdf5 data"""
+        The data read are not used elsewhere, so they are masked (and
+        converted) in place, without a copy.
 
-        with h5py.File(self.h5_filename, "r") as h5f:
-            data = h5f["PWLR/T"][:]
-            oshape = data.shape
-
-            # The layout of the IASI lvl2 data is kind of special:
-            # I am splitting the 4 FOV dewlls and treat them as four independent
-            # pixels. So, one 'scanline' is thus actually only considering two of the
-            # four FOV's in each dwell.
-            # index1 = np.arange(3, 120, 4)
-            # index2 = np.arange(0, 120, 4)
-            index1 = np.arange(3, oshape[1] * oshape[0], 4)
-            index2 = np.arange(0, oshape[1] * oshape[0], 4)
-            index3 = np.arange(2, oshape[1] * oshape[0], 4)
-            index4 = np.arange(1, oshape[1] * oshape[0], 4)
-            idx_a = np.empty((index1.size + index2.size,), dtype=index1.dtype)
-            idx_b = np.empty((index3.size + index4.size,), dtype=index3.dtype)
-            idx_a[0::2] = index1
-            idx_a[1::2] = index2
-            idx_b[0::2] = index3
-            idx_b[1::2] = index4
-            idx = np.empty(
-                (index1.size + index2.size + index3.size + index4.size,),
-                dtype=index1.dtype,
-            )
-            idx = idx.reshape((oshape[0] * 2, oshape[1] // 2))
-            idx_a = idx_a.reshape((oshape[0], oshape[1] // 2))
-            idx_b = idx_b.reshape((oshape[0], oshape[1] // 2))
-            idx[0::2, :] = idx_a
-            idx[1::2, :] = idx_b
-            idx = idx.ravel()
-
-            self.latitudes = h5f["L1C/Latitude"][:].ravel()[idx]
-            self.latitudes = self.latitudes[np.newaxis, :]
-            self.longitudes = h5f["L1C/Longitude"][:].ravel()[idx]
-            self.longitudes = self.longitudes[np.newaxis, :]
-
-            data = h5f["PWLR/T"][:]
-            oshape = data.shape
-            data = data.reshape(oshape[0] * oshape[1], oshape[2]).transpose()
-            data = data[:, idx]
-            data = data[:, np.newaxis, :]
-            self.shape = data.shape
-            self.temp = geophys_parameter(
-                data, "K", "Air temperature", "air_temperature_ml"
-            )
+        """
+        data = np.ma.masked_greater(self._read(name), DATA_UPPER_LIMIT, copy=False)
+        data.fillvalue = NODATA
+        return data
+
+    def _load_pressure(self):
+        """Load the pressure and convert to Pa"""
+        pressure = self._load_masked("PWLR/P")
+        np.multiply(
+            pressure.data, 100, out=pressure.data, where=~np.ma.getmaskarray(pressure)
+        )
+        return pressure
 
-            data = h5f["PWLR/P"][:]
-            data = data.reshape(oshape[0] * oshape[1], oshape[2]).transpose()
-            data = data[:, idx]
-            data = data[:, np.newaxis, :]
-            pressure = np.ma.masked_greater(data, DATA_UPPER_LIMIT)
-            pressure = pressure * 100
-            pressure.fillvalue = NODATA
-            self.pres = geophys_parameter(pressure, "Pa", "Air Pressure", "air_pressure")
-            # Water vapour mixing ratio:
-            data = h5f["PWLR/W"][:]
-            data = data.reshape(oshape[0] * oshape[1], oshape[2]).transpose()
-            data = data[:, idx]
-            data = data[:, np.newaxis, :]
-            wvmix = np.ma.masked_greater(data, DATA_UPPER_LIMIT)
-            self.tdew = geophys_parameter(
-                qair2tdew(wvmix, self.temp.data - 273.15, pressure / 100.0) + 273.15,
-                "K",
-                "Dew Point Temperature",
-                "dew_point_temperature",
-            )
-            self.qspec = geophys_parameter(
-                wvmix,
-                #'kg/kg',
-                "1",
-                "Specific Humidity",
-                "specific_humidity_ml",
-            )
+    def _load_dew_point(self):
+        """Derive the dew point temperature from the specific humidity"""
+        tdew = dew_point_temperature(
+            self.qspec.data, self.temp.data, self.pres.data, dtype=self.dtype
+        )
+        tdew.fillvalue = NODATA
+        return tdew
+
+    @property
+    def nbytes(self):
+        """The number of bytes held by the loaded data (and masks)"""
+        nbytes = self.latitudes.nbytes + self.longitudes.nbytes
+        for key in list(VAR_NAMES_AND_TYPES) + list(SURFACE_VAR_NAMES_AND_TYPES):
+            param = getattr(self, key)
+            if param is None or not param.loaded:
+                continue
+            nbytes += np.ma.getdata(param.data).nbytes
+            if np.ma.getmask(param.data) is not np.ma.nomask:
+                nbytes += param.data.mask.nbytes
+        return nbytes
+
+    def crop(self, inside, rowlen=60):
+        """Crop the granule to the scanlines having any profile flagged *inside*
+
+        Whole (pseudo) scanlines of *rowlen* profiles are kept, so that the
+        vertical cross sections stay complete. Parameters not yet loaded will
+        only be read and derived for the profiles kept. Return the number of
+        profiles kept.
 
-            data = h5f["PWLR/O"][:]
-            data = data.reshape(oshape[0] * oshape[1], oshape[2]).transpose()
-            data = data[:, idx]
-            data = data[:, np.newaxis, :]
-            ozone = np.ma.masked_greater(data, DATA_UPPER_LIMIT)
-            ozone.fillvalue = NODATA
-            self.ozone = geophys_parameter(
-                ozone,
-                "1",
-                "Ozone mixing ratio vertical profile",
-                "fraction_of_ozone_in_air",
-            )
+        """
 
-            # Surface 2d variables:
-            # data = h5f['PWLR/Ts'][:].ravel()
-            data = h5f["PWLR/Ts"][:].ravel()[idx]
-            tskin = np.ma.masked_greater(
-                data[np.newaxis, np.newaxis, :], DATA_UPPER_LIMIT
-            )
-            tskin.fillvalue = NODATA
-            self.skin_temp = geophys_parameter(
-                tskin, "K", "Surface skin temperature", "surface_temperature"
-            )
-            data = h5f["Maps/Height"][:].ravel()[idx]
-            topo = np.ma.masked_greater(data[np.newaxis, np.newaxis, :], DATA_UPPER_LIMIT)
-            topo.fillvalue = NODATA
-            self.topo = geophys_parameter(topo, "m", "Topography", "surface_elevation")
-
-            # stime_day = h5f['L1C']['SensingTime_day'][:]
-            stime_day = h5f["L1C"]["SensingTime_day"][:][0]
-            # msec = h5f['L1C']['SensingTime_msec'][:]
-            # dtobj_arr = np.array([(self.time_origo +
-            #                        timedelta(days=int(stime_day[idx])) +
-            #                        timedelta(microseconds=int(msec[idx])))
-            #                       for idx in range(stime_day.shape[0])])
-            # self.start_time = dtobj_arr.min()
-            # self.end_time = dtobj_arr.max()
+        rows = np.asarray(inside).reshape(-1, rowlen).any(axis=1)
+        keep = np.repeat(rows, rowlen)
+
+        self.latitudes = self.latitudes[:, keep]
+        self.longitudes = self.longitudes[:, keep]
+        if self.locations is not None:
+            self.locations = self.locations[keep]
+        if self._read is not None:
+            self._idx = self._idx[keep]
+
+        for key in list(VAR_NAMES_AND_TYPES) + list(SURFACE_VAR_NAMES_AND_TYPES):
+            param = getattr(self, key)
+            if param is None:
+                continue
+            if param.loaded:
+                param.data = param.data[..., keep]
+            elif self._read is None:
+                param.data = _CroppedLoader(param._data, keep)
+
+        if self.h5_filename:
+            self.shape = self.shape[0:2] + (self.latitudes.shape[1],)
             self.shape_2d = self.latitudes.shape
-            # self.time_shape = stime_day.shape
-            self.time_shape = (1,)
+        nprofiles = self.latitudes.shape[1]
+        LOG.debug("Cropped granule to %d profiles", nprofiles)
+        return nprofiles
 
-    def ncwrite(self, filename=None, vprof=True):
+    def ncwrite(self, filename=None, vprof=True, **kwargs):
         """Write the data to a netCDF file"""
 
+        product = "vprof" if vprof else "vcross"
+        return self.ncwrite_products(filename, products=(product,), **kwargs)[0]
+
+    def ncwrite_products(
+        self,
+        filename=None,
+        products=NC_PRODUCTS,
+        nc_format=NC_FORMAT,
+        compression=NC_COMPRESSION,
+        complevel=NC_COMPRESS_LEVEL,
+        chunk_profiles=NC_CHUNK_PROFILES,
+        packing=None,
+        final_path=None,
+    ):
+        """Write the data to one netCDF file per product (vprof and/or vcross)
+
+        The products only differ in the vertical cross section naming and
+        bounds. So, everything else is written once, to the first file, which
+        is then copied for the other products. Return the list of filenames.
+
+        With a netCDF-4 *nc_format* the variables are compressed with
+        *compression* at *complevel*, and the profiles are stored in chunks of
+        whole profiles for blocks of *chunk_profiles* positions.
+
+        With *packing* ("fixed" or "auto", see packing_parameters) the
+        parameters are stored as 16-bit integers with a scale factor and offset.
+        Files written to a scratch directory first are identified (id) by their
+        name in the directory *final_path*.
+
+        """
+
+        filenames = self._product_filenames(filename, products)
+        encoding = partial(variable_encoding, nc_format, compression, complevel)
+        root = Dataset(filenames[0], "w", format=nc_format)
+        self._write_shared_content(
+            root, encoding, chunk_profiles, self.packing_parameters(packing)
+        )
+        root.close()
+        for other in filenames[1:]:
+            shutil.copyfile(filenames[0], other)
+
+        locnames = encode_position_names(self.latitudes, self.longitudes)
+        for product, fname in zip(products, filenames):
+            LOG.info("Generate netCDF file %s", fname)
+            root = Dataset(fname, "a")
+            self._write_product_content(root, product, locnames, encoding)
+            if final_path is not None:
+                fname = os.path.join(final_path, os.path.basename(fname))
+            _set_global_attributes(root, filename=fname, platform_name=self.platform_name)
+            root.close()
+
+        return filenames
+
+    def ncbuild_products(
+        self,
+        filename=None,
+        products=NC_PRODUCTS,
+        nc_format=NC_FORMAT,
+        compression=NC_COMPRESSION,
+        complevel=NC_COMPRESS_LEVEL,
+        chunk_profiles=NC_CHUNK_PROFILES,
+        packing=None,
+    ):
+        """Build the netCDF files of ncwrite_products in memory
+
+        Nothing is written to disk. Return the list of (filename, contents) of
+        the products, with the contents as a memoryview of the bytes of the
+        file. A dataset in memory can't be reopened, so the content shared by
+        the products is written for each of them.
+
+        """
+
+        filenames = self._product_filenames(filename, products)
+        encoding = partial(variable_encoding, nc_format, compression, complevel)
+        packing = self.packing_parameters(packing)
+        locnames = encode_position_names(self.latitudes, self.longitudes)
+        contents = []
+        for product, fname in zip(products, filenames):
+            LOG.info("Generate netCDF file %s in memory", fname)
+            root = Dataset(fname, "w", format=nc_format, memory=max(self.nbytes, 1))
+            self._write_shared_content(root, encoding, chunk_profiles, packing)
+            self._write_product_content(root, product, locnames, encoding)
+            _set_global_attributes(root, filename=fname, platform_name=self.platform_name)
+            contents.append((fname, root.close()))
+        return contents
+
+    def _product_filenames(self, filename, products):
+        """Get the filenames of the products, named after *filename* (.nc)"""
+        unknown = set(products) - set(NC_PRODUCTS)
+        if unknown:
+            raise ValueError("Unknown netCDF product(s): %s" % ", ".join(sorted(unknown)))
+
         if not filename:
             filename = self.nc_filename
         # Add extention (vprof/vcross)
         prfx = filename.split(".nc")[0]
-        if vprof:
-            filename = prfx + "_vprof.nc"
-        else:
-            filename = prfx + "_vcross.nc"
+        return ["%s_%s.nc" % (prfx, product) for product in products]
 
-        LOG.info("Generate netCDF file %s", filename)
-        root = Dataset(filename, "w", format="NETCDF3_CLASSIC")
+    def _write_shared_content(self, root, encoding, chunk_profiles, packing):
+        """Write the dimensions and variables common to all products
+
+        *encoding* gives the storage keyword arguments of a variable for a
+        given chunk shape, and *packing* the scale factor and offset of the
+        parameters to store as 16-bit integers.
+
+        """
 
         # Add time as a dimension
         new_shape = (1, self.shape[0], self.shape[1], self.shape[2])
@@ -335,32 +657,38 @@ class IasiLvl2(object):
         root.createDimension("nv", 2)
         # For place naming
         root.createDimension("nvcross_strlen", 80)
-        if vprof:
-            root.createDimension("nvcross", shape[3] * shape[2])
-        else:
-            root.createDimension("nvcross", shape[3] * shape[2] / 60)
-
         root.createDimension("two", 2)
 
-        create_time_coordinate(root, self.start_time, self.end_time, shape[0])
+        create_time_coordinate(
+            root, self.start_time, self.end_time, shape[0], encoding=encoding()
+        )
+
+        # Whole profiles, for a block of positions, in each chunk:
+        block = max(1, min(chunk_profiles, shape[3]))
+        profile_chunks = (1, shape[1], 1, block)
+        surface_chunks = (1, 1, 1, block)
 
         # Don't yet know what the nodata value is for lats&lons
         # FIXME!
-        create_latlon_var(root, self.latitudes, self.longitudes, -999)
+        create_latlon_var(
+            root,
+            self.latitudes,
+            self.longitudes,
+            -999,
+            encoding=encoding((1, block)),
+        )
 
         # Find and write one variable at the time
         for key in vars(self).keys():
             if key in VAR_NAMES_AND_TYPES.keys():
-                fillval = NODATA
-                var = root.createVariable(
-                    VAR_NAMES_AND_TYPES[key][0],
-                    VAR_NAMES_AND_TYPES[key][1],
+                var = self._write_variable(
+                    root,
+                    key,
+                    VAR_NAMES_AND_TYPES[key],
                     ("time", "l", "y", "x"),
-                    fill_value=fillval,
-                    zlib=True,
-                    complevel=NC_COMPRESS_LEVEL,
+                    encoding(profile_chunks),
+                    packing.get(key),
                 )
-                var[:] = getattr(self, key).data
 
                 # Add attributes to the variable
                 setattr(var, "coordinates", "longitude latitude")
@@ -373,16 +701,14 @@ class IasiLvl2(object):
                         )
 
             elif key in SURFACE_VAR_NAMES_AND_TYPES.keys():
-                fillval = NODATA
-                var = root.createVariable(
-                    SURFACE_VAR_NAMES_AND_TYPES[key][0],
-                    SURFACE_VAR_NAMES_AND_TYPES[key][1],
+                var = self._write_variable(
+                    root,
+                    key,
+                    SURFACE_VAR_NAMES_AND_TYPES[key],
                     ("time", "height0", "y", "x"),
-                    fill_value=fillval,
-                    zlib=True,
-                    complevel=NC_COMPRESS_LEVEL,
+                    encoding(surface_chunks),
+                    packing.get(key),
                 )
-                var[:] = getattr(self, key).data
 
                 # Add attributes to the variable
                 setattr(var, "coordinates", "longitude latitude")
@@ -394,9 +720,7 @@ class IasiLvl2(object):
                             getattr(getattr(self, key), subkey),
                         )
 
-        var = root.createVariable(
-            "l", "f", ("l"), fill_value=0, zlib=True, complevel=NC_COMPRESS_LEVEL
-        )
+        var = root.createVariable("l", "f", ("l"), fill_value=0, **encoding())
         var[:] = np.arange(1, shape[1] + 1)
         setattr(var, "long_name", "atmosphere_sigma_coordinate")
         setattr(var, "standard_name", "atmosphere_sigma_coordinate")
@@ -416,62 +740,88 @@ class IasiLvl2(object):
             "f4",
             ("sigma"),
             fill_value=-1,
-            zlib=True,
-            complevel=NC_COMPRESS_LEVEL,
+            **encoding(),
         )
         var[:] = 999
         setattr(var, "long_name", "atmosphere_sigma_coordinate")
         setattr(var, "standard_name", "atmosphere_sigma_coordinate")
         setattr(var, "positive", "down")
 
-        nyvar = root.createVariable(
-            "y", "f", ("y",), fill_value=-1, zlib=True, complevel=NC_COMPRESS_LEVEL
-        )
+        nyvar = root.createVariable("y", "f", ("y",), fill_value=-1, **encoding())
         nyvar[:] = np.arange(shape[2])
         setattr(nyvar, "units", "1")
         setattr(nyvar, "standard_name", "projection_y_coordinate")
         setattr(nyvar, "long_name", "y coordinate of projection")
 
-        nxvar = root.createVariable(
-            "x", "f", ("x",), fill_value=-1, zlib=True, complevel=NC_COMPRESS_LEVEL
-        )
+        nxvar = root.createVariable("x", "f", ("x",), fill_value=-1, **encoding())
         nxvar[:] = np.arange(shape[3])
         setattr(nxvar, "units", "1")
         setattr(nxvar, "standard_name", "projection_x_coordinate")
         setattr(nxvar, "long_name", "x coordinate of projection")
 
+    def _write_variable(self, root, key, name_and_type, dimensions, encoding, packing):
+        """Create and write the variable of parameter *key*
+
+        With *packing*, a (scale_factor, add_offset) pair, the data are stored
+        packed as 16-bit integers.
+
+        """
+
+        data = getattr(self, key).data
+        if packing is None:
+            var = root.createVariable(
+                name_and_type[0],
+                name_and_type[1],
+                dimensions,
+                fill_value=NODATA,
+                **encoding,
+            )
+            var[:] = data
+            return var
+
+        scale_factor, add_offset = packing
+        var = root.createVariable(
+            name_and_type[0], "i2", dimensions, fill_value=NC_PACKED_FILL, **encoding
+        )
+        var.set_auto_maskandscale(False)
+        var[:] = pack_data(data, scale_factor, add_offset)
+        setattr(var, ATTRIBUTE_NAMES["gain"], scale_factor)
+        setattr(var, ATTRIBUTE_NAMES["intercept"], add_offset)
+        return var
+
+    def _write_product_content(self, root, product, locnames, encoding):
+        """Write the vertical cross section naming and bounds of one product"""
+
+        nprofiles = self.shape[2]
+        if product == "vprof":
+            root.createDimension("nvcross", nprofiles * self.shape[1])
+        else:
+            root.createDimension("nvcross", nprofiles * self.shape[1] // 60)
+
         vcrossnamevar = root.createVariable(
             "vcross_name",
             "c",
             ("nvcross", "nvcross_strlen"),
-            zlib=True,
-            complevel=NC_COMPRESS_LEVEL,
+            **encoding(),
         )
         setattr(vcrossnamevar, "bounds", "vcross_bnds")
         # Example:  "N7330;E00500",
-        locnames = self.make_position_names()
-        # locnames = ['one scanline']
-        # vcrossnamevar[0, 0:len("N7330;E00500")] = "N7330;E00500"
-        idx = 0
-        if vprof:
-            for lname in locnames:
-                vcrossnamevar[idx, 0 : len(lname)] = lname
-                idx = idx + 1
-        else:
-            for start_name, end_name in zip(
-                np.array(locnames)[0 : shape[3] : 60],
-                np.array(locnames)[59 : shape[3] : 60],
-            ):
-                lname = start_name + " " + end_name
-                vcrossnamevar[idx, 0 : len(lname)] = lname
-                idx = idx + 1
+        # For the cross sections: "N7330;E00500 N7012;E01020"
+        if product == "vcross":
+            start_names = locnames[0:nprofiles:60]
+            end_names = locnames[59:nprofiles:60]
+            start_names = start_names[0 : end_names.shape[0]]
+            space = np.full((end_names.shape[0], 1), ord(" "), dtype=np.uint8)
+            locnames = np.hstack((start_names, space, end_names))
+        vcrossnamevar[:] = pad_char_array(
+            locnames, root.dimensions["nvcross_strlen"].size
+        )
 
         vcrossboundvar = root.createVariable(
             "vcross_bnds",
             "i4",
             ("nvcross", "two"),
-            zlib=True,
-            complevel=NC_COMPRESS_LEVEL,
+            **encoding(),
         )
         setattr(
             vcrossboundvar,
@@ -479,15 +829,76 @@ class IasiLvl2(object):
             "Start- and end-position (included) in lat- and lon-dimensions"
             + " for each IASI profile",
         )
-        if vprof:
-            vcrossboundvar[:, 0] = np.arange(shape[3])
-            vcrossboundvar[:, 1] = np.arange(shape[3])
+        if product == "vprof":
+            vcrossboundvar[:, 0] = np.arange(nprofiles)
+            vcrossboundvar[:, 1] = np.arange(nprofiles)
         else:
-            vcrossboundvar[:, 0] = np.arange(0, shape[3], 60)
-            vcrossboundvar[:, 1] = np.arange(59, shape[3], 60)
+            vcrossboundvar[:, 0] = np.arange(0, nprofiles, 60)
+            vcrossboundvar[:, 1] = np.arange(59, nprofiles, 60)
 
-        _set_global_attributes(root, filename=filename, platform_name=self.platform_name)
-        root.close()
+    def packing_parameters(self, packing="fixed"):
+        """Get the (scale_factor, add_offset) of each parameter to pack
+
+        With "fixed" the packing covers the physical range of each parameter
+        (see NC_PACKING). With "auto" it is derived from the range of the data
+        in the granule, giving a better precision. None (or "none") means no
+        packing.
+
+        """
+
+        if not packing or packing == "none":
+            return {}
+        if packing == "fixed":
+            params = NC_PACKING
+        elif packing == "auto":
+            params = {
+                key: packing_from_range(getattr(self, key).data) for key in NC_PACKING
+            }
+        else:
+            raise ValueError("Unknown packing: %s" % packing)
+        return {
+            key: (np.float32(scale_factor), np.float32(add_offset))
+            for key, (scale_factor, add_offset) in params.items()
+        }
+
+    def packing_report(self, packing="fixed"):
+        """Get the round-trip accuracy of packing each parameter
+
+        Return a dictionary with, per parameter, the scale factor and offset,
+        the maximum and rms absolute error of the unpacked data, the maximum
+        error relative to the (nonzero) values, and the number of values
+        outside the packed range (clipped).
+
+        """
+
+        report = {}
+        for key, (scale_factor, add_offset) in self.packing_parameters(packing).items():
+            data = np.ma.masked_equal(getattr(self, key).data, NODATA)
+            unpacked = unpack_data(
+                pack_data(data, scale_factor, add_offset), scale_factor, add_offset
+            )
+            error = np.ma.abs(unpacked - data)
+            nonzero = np.ma.masked_equal(np.ma.abs(data), 0)
+            rel_error = (error / nonzero).compressed()
+            error = error.compressed()
+            clipped = np.ma.abs(data - add_offset) > NC_PACKED_MAX * scale_factor
+            report[key] = {
+                "scale_factor": float(scale_factor),
+                "add_offset": float(add_offset),
+                "max_abs_error": float(error.max(initial=0.0)),
+                "rms_error": float(np.sqrt(np.mean(error**2))) if error.size else 0.0,
+                "max_rel_error": float(rel_error.max(initial=0.0)),
+                "clipped": int(clipped.sum()),
+            }
+            LOG.debug(
+                "Packing %s: max error %g (relative %g), rms error %g, %d values clipped",
+                key,
+                report[key]["max_abs_error"],
+                report[key]["max_rel_error"],
+                report[key]["rms_error"],
+                report[key]["clipped"],
+            )
+        return report
 
     def make_position_names(self):
         """From the longitude latitude positions make location names in the form of:
@@ -495,41 +906,130 @@ class IasiLvl2(object):
 
         """
 
-        retv = []
-        for lon, lat in zip(self.longitudes.ravel(), self.latitudes.ravel()):
-            if lat > 0:
-                latname = "N%.4d" % int(lat * 100)
-            else:
-                latname = "S%.4d" % int(abs(lat * 100))
+        names = encode_position_names(self.latitudes, self.longitudes)
+        return [
+            name.decode("ascii") for name in names.view("S%d" % names.shape[1]).ravel()
+        ]
 
-            if lon > 0:
-                lonname = "E%.5d" % int(lon * 100)
-            else:
-                lonname = "W%.5d" % int(abs(lon * 100))
 
-            retv.append("%s;%s" % (latname, lonname))
+def encode_position_names(latitudes, longitudes):
+    """Encode the positions as location names in the form of N7330;E00500
+
+    Latitude and longitude are given in hundredths of degrees, truncated
+    towards zero. Positions on the equator or the Greenwich meridian get S and
+    W respectively. Return an uint8 array of character codes with one name per
+    row, shape (nprofiles, 12).
+
+    """
+
+    lats = np.asarray(latitudes).ravel()
+    lons = np.asarray(longitudes).ravel()
+
+    names = np.empty((lats.size, 12), dtype=np.uint8)
+    names[:, 0] = np.where(lats > 0, ord("N"), ord("S"))
+    names[:, 1:5] = _encode_digits(lats * 100, 4)
+    names[:, 5] = ord(";")
+    names[:, 6] = np.where(lons > 0, ord("E"), ord("W"))
+    names[:, 7:12] = _encode_digits(lons * 100, 5)
+    return names
+
+
+def _encode_digits(values, ndigits):
+    """Get the character codes of the zero padded integer part of abs(values)"""
+    values = np.trunc(np.abs(values)).astype(np.int64)
+    powers = 10 ** np.arange(ndigits - 1, -1, -1, dtype=np.int64)
+    return (values[:, np.newaxis] // powers) % 10 + ord("0")
+
+
+def variable_encoding(
+    nc_format=NC_FORMAT,
+    compression=NC_COMPRESSION,
+    complevel=NC_COMPRESS_LEVEL,
+    chunksizes=None,
+):
+    """Get the createVariable keyword arguments for the storage of a variable
+
+    The classic (netCDF-3) formats are written uncompressed and contiguous.
+    For the netCDF-4 formats the variable is compressed with *compression*
+    ("zlib", "zstd", ... or None) at *complevel*, with the shuffle filter,
+    and stored in chunks of *chunksizes* if given.
+
+    """
+
+    if nc_format.startswith("NETCDF3"):
+        return {}
+    encoding = {}
+    if chunksizes is not None:
+        encoding["chunksizes"] = chunksizes
+    if compression and compression != "none":
+        encoding.update(compression=compression, complevel=complevel, shuffle=True)
+    return encoding
+
+
+def packing_from_range(data):
+    """Get the (scale_factor, add_offset) packing the range of the data into int16"""
+    data = np.ma.masked_invalid(np.ma.masked_equal(data, NODATA))
+    if not data.count():
+        return 1.0, 0.0
+    vmin, vmax = float(data.min()), float(data.max())
+    add_offset = (vmax + vmin) / 2.0
+    if vmax == vmin:
+        return 1.0, add_offset
+    # Leave some margin for the rounding of the scale factor to float32:
+    return (vmax - vmin) / (2.0 * NC_PACKED_MAX - 2), add_offset
+
 
-        return retv
+def pack_data(data, scale_factor, add_offset):
+    """Pack the data into int16, the masked and NODATA values as NC_PACKED_FILL
 
+    Values outside the packed range are clipped.
 
-def create_latlon_var(root, latitude, longitude, nodata):
+    """
+
+    values = np.ma.getdata(data)
+    values = values.astype(np.result_type(values.dtype, np.float32), copy=False)
+    missing = np.ma.getmaskarray(data) | (values == NODATA) | ~np.isfinite(values)
+    values = np.where(missing, add_offset, values)
+    packed = np.rint((values - add_offset) / scale_factor)
+    np.clip(packed, -NC_PACKED_MAX, NC_PACKED_MAX, out=packed)
+    packed = packed.astype(np.int16)
+    packed[missing] = NC_PACKED_FILL
+    return packed
+
+
+def unpack_data(packed, scale_factor, add_offset):
+    """Unpack int16 data, masking the NC_PACKED_FILL values"""
+    return np.ma.masked_equal(packed, NC_PACKED_FILL) * scale_factor + add_offset
+
+
+def pad_char_array(names, strlen):
+    """Pad rows of character codes with NUL into a (nnames, strlen) 'S1' array"""
+    chars = np.zeros((names.shape[0], strlen), dtype=np.uint8)
+    chars[:, 0 : names.shape[1]] = names
+    return chars.view("S1")
+
+
+def decode_names(chars):
+    """Decode a (nnames, strlen) character array into an array of names
+
+    The inverse of pad_char_array: The NUL padding is dropped.
+
+    """
+
+    chars = np.ma.getdata(chars)
+    strlen = chars.shape[-1]
+    names = np.ascontiguousarray(chars).view("S%d" % strlen).reshape(chars.shape[:-1])
+    return np.char.decode(names, "utf-8")
+
+
+def create_latlon_var(root, latitude, longitude, nodata, encoding=None):
     """Create latitude and longitude variables"""
 
-    lat = root.createVariable(
-        "latitude",
-        "f4",
-        ("y", "x"),
-        fill_value=nodata,
-        zlib=True,
-        complevel=NC_COMPRESS_LEVEL,
-    )
+    if encoding is None:
+        encoding = {"zlib": True, "complevel": NC_COMPRESS_LEVEL}
+    lat = root.createVariable("latitude", "f4", ("y", "x"), fill_value=nodata, **encoding)
     lon = root.createVariable(
-        "longitude",
-        "f4",
-        ("y", "x"),
-        fill_value=nodata,
-        zlib=True,
-        complevel=NC_COMPRESS_LEVEL,
+        "longitude", "f4", ("y", "x"), fill_value=nodata, **encoding
     )
     lat[:] = latitude
     lon[:] = longitude
@@ -549,9 +1049,12 @@ def create_latlon_var(root, latitude, longitude, nodata):
     return 0
 
 
-def create_time_coordinate(root, start_time, end_time, timesize=1):
+def create_time_coordinate(root, start_time, end_time, timesize=1, encoding=None):
     """Create the time coordinate"""
 
+    if encoding is None:
+        encoding = {"zlib": True, "complevel": NC_COMPRESS_LEVEL}
+
     # Find the time bounds and the middle time
     dtobj_1970 = datetime(1970, 1, 1)
 
@@ -564,17 +1067,13 @@ def create_time_coordinate(root, start_time, end_time, timesize=1):
     time_origo = dtobj_1970.strftime("%Y-%m-%d %H:%M:%S.%f")[0:-4]
 
     # Create the variable and set attributes
-    timevar = root.createVariable(
-        "time", "f4", ("time",), zlib=True, complevel=NC_COMPRESS_LEVEL
-    )
+    timevar = root.createVariable("time", "f4", ("time",), **encoding)
     timevar[:] = np.zeros(timesize, dtype=np.float64)
     timevar[0] = mid_sec
     setattr(timevar, "long_name", "time")
     setattr(timevar, "units", "seconds since %s +00:00" % (time_origo))
     setattr(timevar, "bounds", "time_bnds")
-    timeboundvar = root.createVariable(
-        "time_bnds", "f4", ("time", "nv"), zlib=True, complevel=NC_COMPRESS_LEVEL
-    )
+    timeboundvar = root.createVariable("time_bnds", "f4", ("time", "nv"), **encoding)
     timeboundvar[0, :] = np.zeros(2, dtype=np.float64)
     timeboundvar[0, 0] = start_sec
     timeboundvar[0, 1] = end_sec
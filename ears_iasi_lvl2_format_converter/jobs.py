@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""Book keeping of the conversion jobs."""
+import heapq
+import logging
+import time
+from datetime import datetime
+from itertools import count
+
+LOG = logging.getLogger(__name__)
+
+
+class Job(object):
+
+    """A registered conversion job
+
+    The arguments of the conversion are kept in *args* while the job waits
+    for a worker, and the *future* of the running conversion is set when the
+    job is submitted. Duplicate requests for the same granule are only
+    counted.
+
+    """
+
+    def __init__(self, key, expires):
+        self.key = key
+        self.registered = datetime.utcnow()
+        self.expires = expires
+        self.args = ()
+        self.future = None
+        self.duplicates = 0
+
+    @property
+    def in_flight(self):
+        """Tell if the job is submitted (or about to be) but not yet done"""
+        return self.future is None or not self.future.done()
+
+    @property
+    def failed(self):
+        """Tell if the job is done but raised an exception"""
+        return (
+            self.future is not None
+            and self.future.done()
+            and (self.future.cancelled() or self.future.exception() is not None)
+        )
+
+
+class JobRegistry(object):
+
+    """Registry of the conversion jobs, used to skip duplicate requests
+
+    A job is kept for *ttl* seconds after it is registered, and for as long
+    as it is in flight. Expired jobs are removed from a heap ordered on the
+    expiry time whenever the registry is used, so no timer threads are needed.
+    A failed job is replaced by the next request for the same key.
+
+    """
+
+    def __init__(self, ttl=300, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._jobs = {}
+        self._expiry = []
+        self._seq = count()
+
+    def __len__(self):
+        self._expire()
+        return len(self._jobs)
+
+    def __contains__(self, key):
+        self._expire()
+        return key in self._jobs
+
+    def register(self, key):
+        """Register a job, unless there is one already for *key*
+
+        Return the job and whether it is new. A duplicate request is counted
+        in the existing job.
+
+        """
+
+        self._expire()
+        job = self._jobs.get(key)
+        if job is not None and not job.failed:
+            job.duplicates += 1
+            LOG.debug("Job %s already registered. Count duplicate request", key)
+            return job, False
+
+        job = Job(key, self.clock() + self.ttl)
+        self._jobs[key] = job
+        heapq.heappush(self._expiry, (job.expires, next(self._seq), job))
+        return job, True
+
+    def release(self, key):
+        """Remove the job of *key*, so the next request for it is run"""
+        self._jobs.pop(key, None)
+
+    def _expire(self):
+        now = self.clock()
+        while self._expiry and self._expiry[0][0] <= now:
+            dummy, dummy, job = heapq.heappop(self._expiry)
+            if self._jobs.get(job.key) is not job:
+                continue
+            if job.in_flight:
+                job.expires = now + self.ttl
+                heapq.heappush(self._expiry, (job.expires, next(self._seq), job))
+                continue
+            LOG.debug("Release/reset job-key '%s' from job registry", job.key)
+            del self._jobs[job.key]
+
+
+class JobScheduler(object):
+
+    """Bounded queue of the jobs waiting for a worker, served in priority order
+
+    With the "newest" *policy* the job with the latest granule start time is
+    served first, so fresh data are not held up by a backlog. With "fair" the
+    platforms take turns, newest first for each platform. When the queue is
+    full the job with the oldest granule is dropped. Jobs with a granule older
+    than *max_age* seconds are dropped (*stale* = "drop"), or deferred until
+    no fresh jobs are waiting (*stale* = "defer").
+
+    """
+
+    def __init__(
+        self, maxsize=100, policy="newest", max_age=None, stale="drop", now=None
+    ):
+        if policy not in ("newest", "fair"):
+            raise ValueError("Unknown scheduling policy: %s" % policy)
+        if stale not in ("drop", "defer"):
+            raise ValueError("Unknown action for stale jobs: %s" % stale)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.max_age = max_age
+        self.stale = stale
+        self.now = now or datetime.utcnow
+        self.dropped = 0
+        self._queues = {}
+        self._deferred = []
+        self._turns = []
+        self._seq = count()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values()) + len(self._deferred)
+
+    def put(self, item, start_time, platform_name):
+        """Queue an item. Return the items dropped to make room for it"""
+        queue = self._queues.setdefault(platform_name, [])
+        heapq.heappush(
+            queue, (-start_time.timestamp(), next(self._seq), item, start_time)
+        )
+        if platform_name not in self._turns:
+            self._turns.append(platform_name)
+
+        dropped = []
+        while len(self) > self.maxsize:
+            dropped.append(self._drop_oldest())
+        return dropped
+
+    def pop(self):
+        """Get the next item to run, or None if there is none
+
+        Return the item and a list of the stale items dropped on the way.
+
+        """
+
+        dropped = []
+        for platform_name in self._next_platforms():
+            queue = self._queues[platform_name]
+            while queue:
+                entry = heapq.heappop(queue)
+                if not self._is_stale(entry[3]):
+                    self._turns.remove(platform_name)
+                    self._turns.append(platform_name)
+                    return entry[2], dropped
+                if self.stale == "defer":
+                    heapq.heappush(self._deferred, entry)
+                else:
+                    self.dropped += 1
+                    dropped.append(entry[2])
+                    LOG.info("Drop stale job for granule at %s", entry[3])
+
+        if self._deferred:
+            return heapq.heappop(self._deferred)[2], dropped
+        return None, dropped
+
+    def stats(self):
+        """Get the queue depths, for reporting"""
+        return {
+            "queued": len(self),
+            "deferred": len(self._deferred),
+            "dropped": self.dropped,
+            "platforms": {name: len(queue) for name, queue in self._queues.items()},
+        }
+
+    def _next_platforms(self):
+        if self.policy == "fair":
+            return list(self._turns)
+        # Newest first over all platforms:
+        return sorted(
+            (name for name, queue in self._queues.items() if queue),
+            key=lambda name: self._queues[name][0][0:2],
+        )
+
+    def _is_stale(self, start_time):
+        if self.max_age is None:
+            return False
+        return (self.now() - start_time).total_seconds() > self.max_age
+
+    def _drop_oldest(self):
+        # Deferred jobs are stale, so they go first:
+        queues = [self._deferred] if self._deferred else self._queues.values()
+        entry, queue = max(
+            ((entry, queue) for queue in queues for entry in queue),
+            key=lambda pair: pair[0][0:2],
+        )
+        queue.remove(entry)
+        heapq.heapify(queue)
+        self.dropped += 1
+        LOG.warning("Job queue full. Drop job for granule at %s", entry[3])
+        return entry[2]
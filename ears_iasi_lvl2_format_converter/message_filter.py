@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Filtering of the posttroll messages received, without blocking on DNS lookups."""
+import logging
+import socket
+import time
+from urllib.parse import urlparse
+
+LOG = logging.getLogger(__name__)
+
+REQUIRED_FIELDS = ("uri", "platform_name", "start_time")
+
+
+def get_local_ips():
+    """Get the IPv4 addresses of all interfaces of this host"""
+    import netifaces
+
+    inet_addrs = [
+        netifaces.ifaddresses(iface).get(netifaces.AF_INET)
+        for iface in netifaces.interfaces()
+    ]
+    return [ip["addr"] for addrs in inet_addrs if addrs is not None for ip in addrs]
+
+
+class HostResolver(object):
+
+    """Tell if hosts are this one, with the lookups and local addresses cached
+
+    The address of a host name is looked up again every *ttl* seconds, and
+    a failed lookup every *negative_ttl* seconds, by refresh(). It is meant
+    to be called off the receive path (e.g. from a timer), so only the first
+    message of a host waits on a lookup: an expired address is still used
+    until looked up again (unless expired for more than *ttl*, when refresh()
+    is not called). The name and addresses of the local interfaces are read
+    again every *local_ttl* seconds, and the name needs no lookup.
+
+    """
+
+    def __init__(
+        self,
+        ttl=300,
+        negative_ttl=30,
+        local_ttl=60,
+        resolve=socket.gethostbyname,
+        local_ips=get_local_ips,
+        hostname=socket.gethostname,
+        clock=time.monotonic,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.local_ttl = local_ttl
+        self.resolve = resolve
+        self.local_ips = local_ips
+        self.hostname = hostname
+        self.clock = clock
+        self._addresses = {}
+        self._local = frozenset()
+        self._local_expires = None
+
+    def refresh(self, force=False):
+        """Read the local addresses again, and look up the hosts again, if expired"""
+        now = self.clock()
+        self._refresh_local(now, force)
+        for host, (dummy, expires) in list(self._addresses.items()):
+            if force or now >= expires:
+                self._lookup(host, now)
+
+    def address(self, host):
+        """Get the address of the host, or None if it can't be resolved"""
+        now = self.clock()
+        cached = self._addresses.get(host)
+        if cached is not None and now < cached[1] + self.ttl:
+            return cached[0]
+        return self._lookup(host, now)
+
+    def is_local(self, host):
+        """Tell if the host (a name or an address) is this one"""
+        self._refresh_local(self.clock())
+        if host in self._local:
+            return True
+        return self.address(host) in self._local
+
+    def _refresh_local(self, now, force=False):
+        if force or self._local_expires is None or now >= self._local_expires:
+            self._local = frozenset(self.local_ips()).union([self.hostname()])
+            self._local_expires = now + self.local_ttl
+            LOG.debug("Local names and addresses: %s", ", ".join(sorted(self._local)))
+
+    def _lookup(self, host, now):
+        try:
+            addr = self.resolve(host)
+            expires = now + self.ttl
+        except OSError as err:
+            LOG.warning("Can't resolve %s: %s", host, err)
+            addr = None
+            expires = now + self.negative_ttl
+        self._addresses[host] = (addr, expires)
+        return addr
+
+
+class MessageFilter(object):
+
+    """A predicate telling if a message is relevant, set up once from the options
+
+    A message is relevant if it has the *required* fields, is of one of the
+    *platforms* and *sensors* (any if None), and its file is on this host
+    (see HostResolver). The cheap checks run first.
+
+    """
+
+    def __init__(
+        self, resolver=None, required=REQUIRED_FIELDS, platforms=None, sensors=None
+    ):
+        self.resolver = resolver if resolver is not None else HostResolver()
+        self.required = frozenset(required)
+        self.platforms = frozenset(platforms) if platforms else None
+        self.sensors = frozenset(sensors) if sensors else None
+
+        self._checks = [self._has_required]
+        if self.platforms is not None:
+            self._checks.append(self._platform_allowed)
+        if self.sensors is not None:
+            self._checks.append(self._sensor_allowed)
+        self._checks.append(self._is_local)
+
+    @classmethod
+    def from_options(cls, options):
+        """Set up the filter from the config options"""
+        resolver = HostResolver(
+            ttl=float(options.get("host_cache_ttl_sec", 300)),
+            local_ttl=float(options.get("local_ips_refresh_sec", 60)),
+        )
+        return cls(
+            resolver,
+            platforms=_split_list(options.get("platforms", "")),
+            sensors=_split_list(options.get("sensors", "")),
+        )
+
+    def __call__(self, msg):
+        if not msg:
+            return False
+        for check in self._checks:
+            if not check(msg.data):
+                return False
+        LOG.debug("Ok: message = %s", str(msg))
+        return True
+
+    def _has_required(self, data):
+        if self.required.issubset(data):
+            return True
+        LOG.warning("Message is lacking crucial fields...")
+        return False
+
+    def _platform_allowed(self, data):
+        if data["platform_name"] in self.platforms:
+            return True
+        LOG.debug("Platform %s not converted", data["platform_name"])
+        return False
+
+    def _sensor_allowed(self, data):
+        sensors = data.get("sensor", ())
+        if isinstance(sensors, str):
+            sensors = (sensors,)
+        if self.sensors.intersection(sensors):
+            return True
+        LOG.debug("Sensor %s not converted", data.get("sensor"))
+        return False
+
+    def _is_local(self, data):
+        urlobj = urlparse(data["uri"])
+        if not urlobj.hostname or self.resolver.is_local(urlobj.hostname):
+            return True
+        LOG.warning(
+            "Server %s not the current one: %s", urlobj.netloc, socket.gethostname()
+        )
+        return False
+
+
+def _split_list(value):
+    """Get the items of a comma separated option, None if empty"""
+    items = [item.strip() for item in value.split(",") if item.strip()]
+    return items or None
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""Per-stage timing and resource metrics of the conversion jobs."""
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+LOG = logging.getLogger(__name__)
+
+# ru_maxrss is in bytes on Mac, kilobytes elsewhere:
+MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of the current process to the current one
+
+    Return False if not possible (not Linux), the peak staying that of the
+    process so far.
+
+    """
+
+    try:
+        with open("/proc/self/clear_refs", "w") as fpt:
+            fpt.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_bytes():
+    """Get the peak resident memory of the process since the last reset, in bytes"""
+    try:
+        with open("/proc/self/status") as fpt:
+            for line in fpt:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT
+
+
+def io_bytes():
+    """Get the bytes read and written by the current process so far
+
+    These are the bytes passed through the read and write calls (rchar and
+    wchar of /proc/self/io), cached or not. Zeros if not available (not Linux).
+
+    """
+
+    try:
+        with open("/proc/self/io") as fpt:
+            counters = dict(line.split(":") for line in fpt)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+class JobMetrics(object):
+
+    """The metrics of one conversion job, gathered stage by stage in the worker
+
+    Each stage gets its wall and CPU time (s), the bytes read and written
+    and the peak resident memory of the process during the stage, and the
+    job the peak during the job. The workers are reused, so the peak is
+    reset at the start of each (see reset_peak_rss; where not possible, it
+    is the peak of the process so far). The wait of the job in the queues is
+    the time from *received* (UTC) to the creation of the metrics, when the
+    worker starts the job.
+
+    """
+
+    def __init__(self, name, received=None):
+        self.name = name
+        self.started = time.perf_counter()
+        self.queue_wait = (
+            (datetime.utcnow() - received).total_seconds() if received else 0.0
+        )
+        self.stages = {}
+        self.status = "running"
+        # The peaks of the job and of the stages open, up to the last reset:
+        reset_peak_rss()
+        self._peaks = [0]
+
+    def _reset_peak(self):
+        peak = peak_rss_bytes()
+        self._peaks = [max(open_peak, peak) for open_peak in self._peaks]
+        reset_peak_rss()
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the stage run within the context"""
+        read0, written0 = io_bytes()
+        cpu0 = time.process_time()
+        wall0 = time.perf_counter()
+        self._reset_peak()
+        self._peaks.append(0)
+        try:
+            yield
+        finally:
+            peak = max(self._peaks.pop(), peak_rss_bytes())
+            read1, written1 = io_bytes()
+            self.stages[name] = {
+                "wall": time.perf_counter() - wall0,
+                "cpu": time.process_time() - cpu0,
+                "bytes_read": read1 - read0,
+                "bytes_written": written1 - written0,
+                "peak_rss": peak,
+            }
+
+    def as_dict(self):
+        """Get the metrics as a (json serializable) dict"""
+        return {
+            "job": self.name,
+            "status": self.status,
+            "queue_wait": self.queue_wait,
+            "wall": time.perf_counter() - self.started,
+            "cpu": sum(stage["cpu"] for stage in self.stages.values()),
+            "peak_rss": max(self._peaks[0], peak_rss_bytes()),
+            "stages": self.stages,
+        }
+
+    def log(self):
+        """Log the metrics as one line of json, and return them as a dict"""
+        metrics = self.as_dict()
+        LOG.info("Job metrics: %s", json.dumps(metrics, sort_keys=True))
+        return metrics
+
+
+def measure_stage(metrics, name):
+    """Get the context measuring the stage, doing nothing if *metrics* is None"""
+    if metrics is None:
+        return nullcontext()
+    return metrics.stage(name)
+
+
+class MetricsFile(object):
+
+    """The metrics of the jobs done, summed up and written to a file for scraping
+
+    The file is in the Prometheus text format (as read by the textfile
+    collector of the node exporter) and replaced atomically on each write.
+
+    """
+
+    PREFIX = "ears_iasi_lvl2"
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.jobs = {}
+        self.queue_wait = 0.0
+        self.stages = {}
+        self.last = {}
+
+    def add(self, metrics):
+        """Add the metrics (as_dict) of a job"""
+        self.jobs[metrics["status"]] = self.jobs.get(metrics["status"], 0) + 1
+        self.queue_wait += metrics["queue_wait"]
+        for name, stage in metrics["stages"].items():
+            total = self.stages.setdefault(
+                name, dict(count=0, wall=0.0, cpu=0.0, bytes_read=0, bytes_written=0)
+            )
+            total["count"] += 1
+            for key in ("wall", "cpu", "bytes_read", "bytes_written"):
+                total[key] += stage[key]
+            total["peak_rss"] = max(total.get("peak_rss", 0), stage["peak_rss"])
+        self.last = metrics
+
+    def add_failed(self):
+        """Count a job failed without metrics (e.g. the worker died)"""
+        self.jobs["failed"] = self.jobs.get("failed", 0) + 1
+
+    def lines(self):
+        """Get the lines of the metrics file"""
+        prefix = self.PREFIX
+        lines = [f"# TYPE {prefix}_jobs_total counter"]
+        lines += [
+            f'{prefix}_jobs_total{{status="{status}"}} {count}'
+            for status, count in sorted(self.jobs.items())
+        ]
+        lines += [
+            f"# TYPE {prefix}_queue_wait_seconds_total counter",
+            f"{prefix}_queue_wait_seconds_total {self.queue_wait:.6f}",
+        ]
+        for key, unit, kind in (
+            ("count", "runs_total", "counter"),
+            ("wall", "seconds_total", "counter"),
+            ("cpu", "cpu_seconds_total", "counter"),
+            ("bytes_read", "read_bytes_total", "counter"),
+            ("bytes_written", "written_bytes_total", "counter"),
+            ("peak_rss", "peak_rss_bytes", "gauge"),
+        ):
+            lines.append(f"# TYPE {prefix}_stage_{unit} {kind}")
+            lines += [
+                f'{prefix}_stage_{unit}{{stage="{name}"}} {total[key]}'
+                for name, total in sorted(self.stages.items())
+            ]
+        if self.last:
+            lines += [
+                f"# TYPE {prefix}_last_job_seconds gauge",
+                f"{prefix}_last_job_seconds {self.last['wall']:.6f}",
+                f"# TYPE {prefix}_last_job_queue_wait_seconds gauge",
+                f"{prefix}_last_job_queue_wait_seconds {self.last['queue_wait']:.6f}",
+            ]
+        return lines
+
+    def write(self):
+        """Write the metrics file, replacing the previous one"""
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, "w") as fpt:
+            fpt.write("\n".join(self.lines()) + "\n")
+        os.replace(tmpname, self.filename)
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""A persistent spatio-temporal index of the profiles in the converted (vprof) files."""
+import glob
+import logging
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+from netCDF4 import Dataset
+from pykdtree.kdtree import KDTree
+
+from .utils import EARTH_RADIUS_KM
+
+LOG = logging.getLogger(__name__)
+
+INDEX_FILENAME = "profile_index.npz"
+PENDING_DIR = "pending"
+SECONDS_PER_DAY = 86400
+EPOCH = datetime(1970, 1, 1)
+
+ProfileMatch = namedtuple(
+    "ProfileMatch",
+    ["filename", "index", "distance_km", "latitude", "longitude", "start_time"],
+)
+
+
+class ProfileIndex(object):
+
+    """The positions and times of the profiles of the vprof files, and a KD-tree
+
+    The index is kept in the directory *path*: The profiles of all files in
+    one compact npz file, and the files added since in a directory of
+    pending entries, one small npz file each. Entries are added by any
+    process (e.g. the conversion workers) without locking, and merged into
+    the index by compact(), run by one process only.
+
+    The queries search a KD-tree of the profile positions as unit vectors
+    (so distances are chords on the sphere). There is one tree per day of
+    the granule start times, built when first needed, so a query of the
+    last hours only builds and searches the trees of those days.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending_path = os.path.join(path, PENDING_DIR)
+        self._set_entries([])
+
+    def __len__(self):
+        return self.latitudes.size
+
+    def add(self, filename, start_time=None, end_time=None):
+        """Add the profiles of a vprof file, as a pending entry
+
+        The times are those of the file (time_bnds) unless given.
+
+        """
+
+        with Dataset(filename, "r") as ncf:
+            lats = np.ma.getdata(ncf["latitude"][:]).ravel().astype(np.float32)
+            lons = np.ma.getdata(ncf["longitude"][:]).ravel().astype(np.float32)
+            bounds = ncf["time_bnds"][0, :]
+        start = _epoch_seconds(start_time) if start_time else int(bounds[0])
+        end = _epoch_seconds(end_time) if end_time else int(bounds[1])
+
+        os.makedirs(self.pending_path, exist_ok=True)
+        entry = os.path.join(self.pending_path, os.path.basename(filename) + ".npz")
+        tmpname = entry + ".tmp"
+        with open(tmpname, "wb") as fpt:
+            np.savez(
+                fpt,
+                filename=np.array(os.path.abspath(filename)),
+                times=np.array([start, end], dtype=np.int64),
+                latitudes=lats,
+                longitudes=lons,
+            )
+        os.replace(tmpname, entry)
+        LOG.debug("Added %d profiles of %s to the index", lats.size, filename)
+
+    def pending(self):
+        """Get the pending entries, not yet merged into the index"""
+        return sorted(glob.glob(os.path.join(self.pending_path, "*.npz")))
+
+    def load(self):
+        """Load the index and the pending entries. Return self"""
+        pending = self.pending()
+        entries = self._read_index()
+        for entry in pending:
+            try:
+                with np.load(entry) as npz:
+                    entries.append(
+                        (
+                            str(npz["filename"]),
+                            npz["times"][0],
+                            npz["times"][1],
+                            npz["latitudes"],
+                            npz["longitudes"],
+                        )
+                    )
+            except (OSError, ValueError, KeyError):
+                LOG.warning("Can't read the index entry %s. Skip it", entry)
+        self._set_entries(entries)
+        return self
+
+    def compact(self, prune=True):
+        """Merge the pending entries into the index file
+
+        With *prune* the files no longer existing are dropped from the index.
+        Return the number of entries merged.
+
+        """
+
+        pending = self.pending()
+        self.load()
+        if prune:
+            exists = np.array([os.path.exists(fname) for fname in self.filenames], bool)
+            if not exists.all():
+                LOG.info("Drop %d files no longer existing", np.count_nonzero(~exists))
+                self._set_entries(
+                    [entry for entry, keep in zip(self._entries(), exists) if keep]
+                )
+
+        os.makedirs(self.path, exist_ok=True)
+        index_file = os.path.join(self.path, INDEX_FILENAME)
+        tmpname = index_file + ".tmp"
+        with open(tmpname, "wb") as fpt:
+            np.savez(
+                fpt,
+                filenames=self.filenames,
+                start_times=self.start_times,
+                end_times=self.end_times,
+                offsets=self.offsets,
+                latitudes=self.latitudes,
+                longitudes=self.longitudes,
+            )
+        os.replace(tmpname, index_file)
+        for entry in pending:
+            os.remove(entry)
+        LOG.info(
+            "Profile index of %d files, %d profiles. Merged %d entries",
+            self.filenames.size,
+            len(self),
+            len(pending),
+        )
+        return len(pending)
+
+    def nearest(self, lat, lon, k=1, since=None, until=None):
+        """Get the *k* profiles nearest to (lat, lon), of granules between the times
+
+        Return a list of ProfileMatch, nearest first.
+
+        """
+
+        matches = []
+        for tree, profiles, valid in self._trees_between(since, until):
+            nquery = min(k, profiles.size)
+            while True:
+                dist, idx = _query(tree, lat, lon, nquery)
+                found = np.isfinite(dist)
+                dist, idx = dist[found], profiles[idx[found]]
+                inside = valid[idx]
+                if np.count_nonzero(inside) >= k or nquery == profiles.size:
+                    break
+                nquery = min(4 * nquery, profiles.size)
+            matches.extend(zip(dist[inside], idx[inside]))
+        return self._matches(sorted(matches)[0:k])
+
+    def within(self, lat, lon, radius_km, since=None, until=None):
+        """Get the profiles within *radius_km* of (lat, lon), of granules between times
+
+        Return a list of ProfileMatch, nearest first.
+
+        """
+
+        chord = 2 * np.sin(radius_km / (2 * EARTH_RADIUS_KM))
+        matches = []
+        for tree, profiles, valid in self._trees_between(since, until):
+            nquery = min(64, profiles.size)
+            while True:
+                dist, idx = _query(tree, lat, lon, nquery, chord)
+                if not np.isfinite(dist[-1]) or nquery == profiles.size:
+                    break
+                nquery = min(4 * nquery, profiles.size)
+            found = np.isfinite(dist)
+            dist, idx = dist[found], profiles[idx[found]]
+            inside = valid[idx]
+            matches.extend(zip(dist[inside], idx[inside]))
+        return self._matches(sorted(matches))
+
+    def _read_index(self):
+        """Read the entries of the index file, if any"""
+        index_file = os.path.join(self.path, INDEX_FILENAME)
+        if not os.path.exists(index_file):
+            return []
+        with np.load(index_file) as npz:
+            offsets = npz["offsets"]
+            lats = np.split(npz["latitudes"], offsets[1:-1])
+            lons = np.split(npz["longitudes"], offsets[1:-1])
+            return list(
+                zip(
+                    npz["filenames"].tolist(),
+                    npz["start_times"],
+                    npz["end_times"],
+                    lats,
+                    lons,
+                )
+            )
+
+    def _entries(self):
+        """Get the entries of the index: filename, start, end, latitudes, longitudes"""
+        lats = np.split(self.latitudes, self.offsets[1:-1])
+        lons = np.split(self.longitudes, self.offsets[1:-1])
+        return list(
+            zip(self.filenames.tolist(), self.start_times, self.end_times, lats, lons)
+        )
+
+    def _set_entries(self, entries):
+        """Set the index from the entries. A file added again replaces its entry"""
+        latest = {entry[0]: entry for entry in entries}
+        entries = sorted(latest.values(), key=lambda entry: (entry[1], entry[0]))
+        sizes = [entry[3].size for entry in entries]
+        self.filenames = np.array([entry[0] for entry in entries], dtype=str)
+        self.start_times = np.array([entry[1] for entry in entries], dtype=np.int64)
+        self.end_times = np.array([entry[2] for entry in entries], dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(sizes, dtype=np.int64)))
+        self.latitudes = np.concatenate(
+            [entry[3] for entry in entries] or [np.zeros(0, np.float32)]
+        )
+        self.longitudes = np.concatenate(
+            [entry[4] for entry in entries] or [np.zeros(0, np.float32)]
+        )
+        self._trees = {}
+
+    def _trees_between(self, since=None, until=None):
+        """Get the trees of the days of the granules between the times
+
+        For each tree, give the indices of its profiles in the index, and
+        a mask telling which profiles of the index are between the times.
+
+        """
+
+        file_valid = np.ones(self.filenames.size, dtype=bool)
+        if since is not None:
+            file_valid &= self.end_times >= _epoch_seconds(since)
+        if until is not None:
+            file_valid &= self.start_times <= _epoch_seconds(until)
+        valid = np.repeat(file_valid, np.diff(self.offsets))
+
+        days = self.start_times // SECONDS_PER_DAY
+        for day in np.unique(days[file_valid]):
+            if day not in self._trees:
+                files = np.flatnonzero(days == day)
+                profiles = np.concatenate(
+                    [
+                        np.arange(self.offsets[i], self.offsets[i + 1], dtype=np.int64)
+                        for i in files
+                    ]
+                )
+                vectors = _unit_vectors(
+                    self.latitudes[profiles], self.longitudes[profiles]
+                )
+                self._trees[day] = (KDTree(vectors), profiles)
+            tree, profiles = self._trees[day]
+            if profiles.size:
+                yield tree, profiles, valid
+
+    def _matches(self, matches):
+        """Get the ProfileMatch of the (chord distance, profile) pairs"""
+        result = []
+        for dist, profile in matches:
+            ifile = np.searchsorted(self.offsets, profile, side="right") - 1
+            result.append(
+                ProfileMatch(
+                    str(self.filenames[ifile]),
+                    int(profile - self.offsets[ifile]),
+                    float(2 * EARTH_RADIUS_KM * np.arcsin(min(dist / 2, 1.0))),
+                    float(self.latitudes[profile]),
+                    float(self.longitudes[profile]),
+                    EPOCH + timedelta(seconds=int(self.start_times[ifile])),
+                )
+            )
+        return result
+
+
+def _epoch_seconds(utc_time):
+    """Get the seconds since 1970 of a (naive UTC) datetime"""
+    return int((utc_time - EPOCH).total_seconds())
+
+
+def _unit_vectors(lats, lons):
+    """Get the positions as unit vectors (n, 3) in float32"""
+    lats = np.deg2rad(lats.astype(np.float64))
+    lons = np.deg2rad(lons.astype(np.float64))
+    return np.stack(
+        (np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)), axis=1
+    ).astype(np.float32)
+
+
+def _query(tree, lat, lon, k, chord=None):
+    """Query the tree for the k nearest (within *chord*). Return 1d distances, indices"""
+    point = _unit_vectors(np.array([lat]), np.array([lon]))
+    kwargs = {} if chord is None else {"distance_upper_bound": chord}
+    dist, idx = tree.query(point, k=k, **kwargs)
+    dist = np.atleast_1d(dist.ravel()).astype(np.float64)
+    idx = np.atleast_1d(idx.ravel()).astype(np.int64)
+    # Not found: infinite distance, and an index past the end
+    idx[~np.isfinite(dist)] = 0
+    return dist, idx
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Selective reading of the profiles of the converted (vprof) netCDF files."""
+import logging
+
+import numpy as np
+from netCDF4 import Dataset
+
+from .constants import DTYPE, SURFACE_VAR_NAMES_AND_TYPES, VAR_NAMES_AND_TYPES
+from .iasi_lvl2 import decode_names
+
+LOG = logging.getLogger(__name__)
+
+# Selected profiles at most this far apart are read in the same hyperslab:
+MERGE_GAP = 64
+
+
+class VprofReader(object):
+
+    """Read selected profiles of a vprof netCDF file, without reading it all
+
+    The file is kept open, and the index of the profile names and positions
+    is read once. The profiles are selected by name (see names_index), by
+    position in a lat/lon box (see box_index) or by an index range (a
+    slice), and read with one hyperslab per run of neighbouring profiles.
+    Call close() (or use the instance as a context manager) when done.
+
+    """
+
+    def __init__(self, filename, dtype=DTYPE):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self._ncf = Dataset(filename, "r")
+        self.names = decode_names(self._ncf["vcross_name"][:])
+        self.latitudes = np.ma.getdata(self._ncf["latitude"][0, :])
+        self.longitudes = np.ma.getdata(self._ncf["longitude"][0, :])
+        self._order = np.argsort(self.names, kind="stable")
+        self._sorted_names = self.names[self._order]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.names.size
+
+    def close(self):
+        """Close the netCDF file"""
+        if self._ncf is not None:
+            self._ncf.close()
+            self._ncf = None
+
+    def names_index(self, names):
+        """Get the index of the profiles named *names* (e.g. "N5831;E01605")
+
+        All profiles of a name are selected. Raise a KeyError for a name not
+        in the file.
+
+        """
+
+        # Not converted to the width of the names in the file, which would cut them:
+        names = np.atleast_1d(np.asarray(names, dtype=str))
+        first = np.searchsorted(self._sorted_names, names, side="left")
+        last = np.searchsorted(self._sorted_names, names, side="right")
+        missing = names[first == last]
+        if missing.size:
+            raise KeyError("Profile(s) not found: %s" % ", ".join(missing))
+        return np.sort(np.concatenate([self._order[i:j] for i, j in zip(first, last)]))
+
+    def box_index(self, lat_min, lat_max, lon_min, lon_max):
+        """Get the index of the profiles inside the lat/lon box (degrees, included)
+
+        A box crossing the antimeridian has *lon_min* greater than *lon_max*.
+
+        """
+
+        inside = (self.latitudes >= lat_min) & (self.latitudes <= lat_max)
+        if lon_min <= lon_max:
+            inside &= (self.longitudes >= lon_min) & (self.longitudes <= lon_max)
+        else:
+            inside &= (self.longitudes >= lon_min) | (self.longitudes <= lon_max)
+        return np.flatnonzero(inside)
+
+    def read(self, index=slice(None), params=None, time_index=0):
+        """Read the selected profiles of the parameters
+
+        *index* is a slice or an array of profile indices, and *params* the
+        parameters to read (see VAR_NAMES_AND_TYPES and
+        SURFACE_VAR_NAMES_AND_TYPES), all by default. Return a dict with the
+        masked data of each parameter, (nlevels, nselected) for the profiles
+        and (nselected,) at the surface, and the "latitude", "longitude" and
+        "name" of the profiles.
+
+        """
+
+        if params is None:
+            params = list(VAR_NAMES_AND_TYPES) + list(SURFACE_VAR_NAMES_AND_TYPES)
+        if isinstance(index, slice):
+            index = np.arange(len(self))[index]
+        index = np.asarray(index, dtype=np.int64)
+        runs = hyperslab_runs(index)
+
+        result = {
+            "latitude": self.latitudes[index],
+            "longitude": self.longitudes[index],
+            "name": self.names[index],
+        }
+        for key in params:
+            if key in VAR_NAMES_AND_TYPES:
+                ncvar = self._ncf[VAR_NAMES_AND_TYPES[key][0]]
+                hyperslab = (time_index, slice(None), 0)
+            else:
+                ncvar = self._ncf[SURFACE_VAR_NAMES_AND_TYPES[key][0]]
+                hyperslab = (time_index, 0, 0)
+            pieces = [
+                ncvar[hyperslab + (slice(start, stop),)][..., selected]
+                for start, stop, selected in runs or [(0, 0, slice(None))]
+            ]
+            result[key] = np.ma.concatenate(pieces, axis=-1).astype(self.dtype)
+        LOG.debug("Read %d profiles in %d hyperslabs", index.size, len(runs))
+        return result
+
+
+def hyperslab_runs(index, merge_gap=MERGE_GAP):
+    """Group the profile indices into ranges to read as one hyperslab each
+
+    Indices at most *merge_gap* apart go in the same range. Return a list of
+    (start, stop, selected), with the selected profiles relative to start, so
+    that the profiles in order are those of the ranges in turn.
+
+    """
+
+    if index.size == 0:
+        return []
+    breaks = np.flatnonzero((np.diff(index) > merge_gap) | (np.diff(index) < 0)) + 1
+    runs = []
+    for group in np.split(index, breaks):
+        start = group.min()
+        runs.append((start, group.max() + 1, group - start))
+    return runs
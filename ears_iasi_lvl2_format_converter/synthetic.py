@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Synthetic EARS IASI level-2 granules, for tests and benchmarks off-site."""
+from datetime import datetime, timedelta
+
+import h5py
+import numpy as np
+
+# A scan line of IASI takes 8 seconds, and an EARS granule is about 3 minutes:
+SCANLINE_SEC = 8
+GRANULE_LINES = 23
+NFOV = 120
+NLEVELS = 101
+
+# The fill value of the EUMETSAT files (max float32), well above DATA_UPPER_LIMIT:
+FILL_VALUE = np.float32(3.4028235e38)
+
+EARS_FILENAME = (
+    "W_XX-EUMETSAT-{station},iasi,{platform}+{station}_C_EUMS_{processing:%Y%m%d%H%M%S}"
+    "_IASI_PW3_02_{short_name}_{start:%Y%m%d%H%M%S}Z_{end:%Y%m%d%H%M%S}Z.hdf"
+)
+SHORT_NAMES = {"metopa": "M02", "metopb": "M01", "metopc": "M03"}
+
+
+def synthetic_granule_name(
+    start_time, nlines=GRANULE_LINES, platform="metopb", station="lan"
+):
+    """Get an EARS filename for a granule of *nlines* scan lines from *start_time*"""
+    end_time = start_time + timedelta(seconds=nlines * SCANLINE_SEC)
+    return EARS_FILENAME.format(
+        station=station,
+        platform=platform,
+        short_name=SHORT_NAMES[platform],
+        processing=end_time + timedelta(minutes=5),
+        start=start_time,
+        end=end_time,
+    )
+
+
+def pressure_levels(nlevels=NLEVELS):
+    """Get the pressure levels (hPa) of the retrieval, from 0.005 to 1050 hPa"""
+    return np.geomspace(0.005, 1050.0, nlevels).astype(np.float32)
+
+
+def write_synthetic_granule(
+    path,
+    nlines=GRANULE_LINES,
+    nfov=NFOV,
+    nlevels=NLEVELS,
+    start_time=datetime(2023, 3, 27, 9, 16, 6),
+    lat0=55.0,
+    lon0=15.0,
+    failed_fraction=0.1,
+    seed=1,
+):
+    """Write an hdf5 file with the layout and sizes of an EARS IASI level-2 granule
+
+    The profiles follow a standard atmosphere with some noise, along a swath
+    heading north from (*lat0*, *lon0*). The levels below the surface and a
+    *failed_fraction* of the retrievals are set to the fill value in the
+    datasets masked by the reader (all but the temperature). Return the path.
+
+    """
+
+    rng = np.random.default_rng(seed)
+    shape_2d = (nlines, nfov)
+    shape_3d = (nlines, nfov, nlevels)
+
+    # Geolocation: 30 fields of regard of 2x2 FOV's across a ~2200 km swath
+    line = np.arange(nlines)[:, np.newaxis]
+    fov = np.arange(nfov)[np.newaxis, :]
+    across_km = ((fov // 4) - 14.5) * 73.0 + (fov % 2 - 0.5) * 12.0
+    along_km = np.broadcast_to(line * 53.0 + (fov % 4 // 2 - 0.5) * 12.0, shape_2d)
+    lats = lat0 + along_km / 111.2
+    lons = lon0 + across_km / (111.2 * np.cos(np.deg2rad(lats)))
+
+    topo = np.clip(
+        800 * np.sin(np.deg2rad(lats) * 20) * np.cos(np.deg2rad(lons) * 15), 0, None
+    )
+    topo = topo + rng.uniform(0, 50, shape_2d)
+    surface_pres = 1013.25 * np.exp(-topo / 8000.0)
+
+    plevels = pressure_levels(nlevels)
+    height_km = 44.33 * (1 - (plevels / 1013.25) ** 0.19)
+    temp = np.maximum(288.15 - 6.5 * height_km, 216.65) + 1.2 * np.maximum(
+        height_km - 20, 0
+    )
+    temp = temp + rng.normal(0, 2.0, shape_3d)
+    water = np.maximum(0.01 * (plevels / 1013.25) ** 3, 3e-6)
+    water = water * rng.lognormal(0, 0.3, shape_3d)
+    ozone = 1e-8 + 1.5e-5 * np.exp(-0.5 * np.log(plevels / 10.0) ** 2)
+    ozone = ozone * rng.lognormal(0, 0.1, shape_3d)
+    skin_temp = 275 + rng.normal(0, 5, shape_2d)
+
+    below = plevels > surface_pres[..., np.newaxis]
+    failed = rng.random(shape_2d) < failed_fraction
+    water[below | failed[..., np.newaxis]] = FILL_VALUE
+    ozone[failed] = FILL_VALUE
+    skin_temp[failed] = FILL_VALUE
+    pres = np.broadcast_to(plevels, shape_3d).copy()
+    pres[below] = FILL_VALUE
+
+    seconds = (start_time - datetime(2000, 1, 1)).total_seconds()
+    seconds = seconds + np.arange(nlines) * SCANLINE_SEC
+    with h5py.File(path, "w") as h5f:
+        h5f["PWLR/T"] = temp.astype(np.float32)
+        h5f["PWLR/P"] = pres
+        h5f["PWLR/W"] = water.astype(np.float32)
+        h5f["PWLR/O"] = ozone.astype(np.float32)
+        h5f["PWLR/Ts"] = skin_temp.astype(np.float32)
+        h5f["Maps/Height"] = topo.astype(np.float32)
+        h5f["L1C/Latitude"] = lats.astype(np.float32)
+        h5f["L1C/Longitude"] = lons.astype(np.float32)
+        h5f["L1C/SensingTime_day"] = (seconds // 86400).astype(np.int32)
+        h5f["L1C/SensingTime_msec"] = (seconds % 86400 * 1000).astype(np.int32)
+    return path
@@ -1,11 +1,33 @@
 #!/usr/bin/env python3
 """Utility/helper functions and classes."""
+import logging
+import os
+import resource
+import time
+import tracemalloc
+from datetime import timedelta
 from pathlib import Path
 
+import numpy as np
 from pyorbital import orbital
-from pyresample.spherical_geometry import Coordinate, point_inside
+from pyproj import Transformer
+from pyresample.area_config import AreaNotFound, parse_area_file
+from pyresample.spherical import SphPolygon
 
-from .constants import PLATFORMS
+from .constants import (
+    GRANULE_TRACK_STEP_SEC,
+    IASI_HALF_SWATH_KM,
+    PLATFORMS,
+    TLE_MAX_AGE_DAYS,
+    TLE_RELOAD_INTERVAL_SEC,
+)
+
+LOG = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0
+
+# Process wide cache of orbit predictors, one per platform:
+_ORBITALS = {}
 
 
 def convert_to_path(fpath, check_existence=True):
@@ -16,21 +38,173 @@ def convert_to_path(fpath, check_existence=True):
     return fpath
 
 
+def current_rss_mb():
+    """Get the resident memory of the current process in MB"""
+    try:
+        with open("/proc/self/statm") as fpt:
+            pages = int(fpt.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024.0**2
+    except OSError:
+        # Not Linux: Use the peak resident memory instead (in bytes on Mac)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0**2
+
+
+def traced_peak_bytes(func, *args, **kwargs):
+    """Run func(*args, **kwargs) and get its result and peak traced memory in bytes
+
+    The peak is that of the memory allocated through Python (including the
+    numpy arrays) while running the function, as traced by tracemalloc.
+
+    """
+
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    try:
+        result = func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        if started:
+            tracemalloc.stop()
+    return result, peak
+
+
+class AreaRegistry(object):
+
+    """The area definitions of an areas file (.def or .yaml), parsed once
+
+    The file is parsed again when its modification time changes, so areas
+    can be edited without restarting.
+
+    """
+
+    def __init__(self, areas_file):
+        self.areas_file = Path(areas_file)
+        self._mtime = None
+        self._areas = {}
+
+    def _reload_if_modified(self):
+        mtime = self.areas_file.stat().st_mtime
+        if mtime != self._mtime:
+            LOG.debug("Parse area definitions from %s", self.areas_file)
+            areas = parse_area_file(str(self.areas_file))
+            self._areas = {area.area_id: area for area in areas}
+            self._mtime = mtime
+
+    def get(self, area_id):
+        """Get the area definition of *area_id*"""
+        self._reload_if_modified()
+        try:
+            return self._areas[area_id]
+        except KeyError:
+            raise AreaNotFound("Area '%s' not found in %s" % (area_id, self.areas_file))
+
+    def __contains__(self, area_id):
+        self._reload_if_modified()
+        return area_id in self._areas
+
+
+def get_orbital(platform_name, utc_time):
+    """Get the (cached) orbit predictor of the platform
+
+    The TLE's are read once per platform and process. They are re-read if the
+    cached TLE epoch is more than TLE_MAX_AGE_DAYS away from *utc_time*, but
+    not more often than every TLE_RELOAD_INTERVAL_SEC.
+
+    """
+
+    platform_name = PLATFORMS.get(platform_name, platform_name)
+    if platform_name in _ORBITALS:
+        orb, loaded = _ORBITALS[platform_name]
+        epoch = orb.tle.epoch.astype("datetime64[us]").astype(object)
+        if abs(utc_time - epoch) <= timedelta(days=TLE_MAX_AGE_DAYS):
+            return orb
+        if time.monotonic() - loaded < TLE_RELOAD_INTERVAL_SEC:
+            return orb
+        LOG.debug("TLE epoch %s too far from %s. Reload TLE's", epoch, utc_time)
+
+    orb = orbital.Orbital(platform_name)
+    _ORBITALS[platform_name] = (orb, time.monotonic())
+    return orb
+
+
+def granule_swath_polygon(
+    start_time, end_time, orb, half_swath=IASI_HALF_SWATH_KM, step=GRANULE_TRACK_STEP_SEC
+):
+    """Get the polygon covered by the instrument swath during the granule
+
+    The ground track is sampled every *step* seconds and the swath edges are
+    found *half_swath* km to each side of it. Return a SphPolygon with the
+    vertices in clockwise order.
+
+    """
+
+    nsteps = max(int((end_time - start_time).total_seconds() // step), 1) + 1
+    times = np.datetime64(start_time, "us") + np.linspace(
+        0, (end_time - start_time).total_seconds() * 1e6, nsteps
+    ).astype("timedelta64[us]")
+    lons, lats = np.deg2rad(orb.get_lonlatalt(times)[0:2])
+
+    track = np.stack(
+        (np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)), axis=-1
+    )
+    heading = np.gradient(track, axis=0)
+    left = np.cross(track, heading)
+    left /= np.linalg.norm(left, axis=-1)[:, np.newaxis]
+
+    angle = half_swath / EARTH_RADIUS_KM
+    left_edge = np.cos(angle) * track + np.sin(angle) * left
+    right_edge = np.cos(angle) * track - np.sin(angle) * left
+
+    # Clockwise: Forward along the left edge and back along the right edge
+    vertices = np.concatenate((left_edge, right_edge[::-1]))
+    return SphPolygon(
+        np.stack(
+            (
+                np.arctan2(vertices[:, 1], vertices[:, 0]),
+                np.arcsin(np.clip(vertices[:, 2], -1, 1)),
+            ),
+            axis=-1,
+        )
+    )
+
+
 def granule_inside_area(start_time, end_time, platform_name, area_def):
     """Check if the IASI granule is over area interest, using the times from the
     filename
 
+    The whole swath of the granule is intersected with the area.
+
     """
 
-    metop = orbital.Orbital(PLATFORMS.get(platform_name, platform_name))
-    corners = area_def.corners
+    metop = get_orbital(platform_name, start_time)
+    swath = granule_swath_polygon(start_time, end_time, metop)
+    area = SphPolygon(np.array([(corner.lon, corner.lat) for corner in area_def.corners]))
+
+    return swath.intersection(area) is not None
+
+
+def profiles_inside_area(lons, lats, area_def, margin=0.0):
+    """Flag the profile positions inside the area of interest
+
+    The area extent is extended by *margin*, given in the units of the area
+    projection (normally metres). Return a boolean array of the same shape as
+    the input longitudes and latitudes.
+
+    """
 
-    is_inside = False
-    for dtobj in [start_time, end_time]:
-        lon, lat, dummy = metop.get_lonlatalt(dtobj)
-        point = Coordinate(lon, lat)
-        if point_inside(point, corners):
-            is_inside = True
-            break
+    transformer = Transformer.from_crs("EPSG:4326", area_def.crs, always_xy=True)
+    xcoord, ycoord = transformer.transform(np.asarray(lons), np.asarray(lats))
+    xmin, ymin, xmax, ymax = area_def.area_extent
 
-    return is_inside
+    with np.errstate(invalid="ignore"):
+        return (
+            np.isfinite(xcoord)
+            & np.isfinite(ycoord)
+            & (xcoord >= xmin - margin)
+            & (xcoord <= xmax + margin)
+            & (ycoord >= ymin - margin)
+            & (ycoord <= ymax + margin)
+        )
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""A pool of warm worker processes, recycled after a number of jobs or on memory use."""
+import logging
+import multiprocessing
+import os
+import pickle
+import threading
+from collections import deque
+from concurrent.futures import Future
+from itertools import count
+from multiprocessing.reduction import ForkingPickler
+from queue import Empty
+
+from .utils import current_rss_mb
+
+LOG = logging.getLogger(__name__)
+
+
+class WorkerDied(RuntimeError):
+    """The worker process died with the job sent to it, before giving the result"""
+
+
+def _worker_main(task_conn, result_q, initializer, initargs, max_jobs, max_rss_mb):
+    """Run the jobs sent by the pool until told to stop or it is time to recycle
+
+    The worker tells with each result if it exits to be recycled, so no
+    more jobs are sent to it.
+
+    """
+    if initializer is not None:
+        initializer(*initargs)
+
+    pid = os.getpid()
+    njobs = 0
+    while True:
+        try:
+            task = task_conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+
+        job_id, func, args, kwargs = task
+        try:
+            result = (True, func(*args, **kwargs))
+        except Exception as err:
+            result = (False, err)
+        try:
+            pickle.dumps(result)
+        except Exception as err:
+            result = (False, RuntimeError("Unpicklable job result: %s" % repr(err)))
+
+        njobs = njobs + 1
+        recycle = False
+        rss = current_rss_mb()
+        if max_jobs and njobs >= max_jobs:
+            LOG.debug("Worker %d done %d jobs. Recycle", pid, njobs)
+            recycle = True
+        elif max_rss_mb and rss > max_rss_mb:
+            LOG.info("Worker %d uses %.0f MB > %.0f MB. Recycle", pid, rss, max_rss_mb)
+            recycle = True
+        result_q.put((pid, job_id, result, recycle))
+        if recycle:
+            break
+
+
+class _Worker(object):
+
+    """A worker process, the pipe to send it jobs and the id of the job it was sent"""
+
+    def __init__(self, proc, task_conn):
+        self.proc = proc
+        self.task_conn = task_conn
+        self.job_id = None
+        self.accepting = True
+
+    @property
+    def idle(self):
+        return self.accepting and self.job_id is None
+
+
+class WorkerPool(object):
+
+    """A pool of long lived worker processes
+
+    The workers are started once and run the *initializer* (e.g. to import
+    the heavy modules and fill caches) before taking jobs. A worker is
+    replaced after *max_jobs_per_worker* jobs, or when its resident memory
+    exceeds *max_rss_mb* after a job. Zero disables the limit. Jobs are
+    submitted as with concurrent.futures and a Future is returned.
+
+    A job is sent to an idle worker only, so the pool knows which job each
+    worker has, and fails it with WorkerDied if the worker dies.
+
+    """
+
+    poll_interval = 1.0
+
+    def __init__(
+        self,
+        processes,
+        initializer=None,
+        initargs=(),
+        max_jobs_per_worker=0,
+        max_rss_mb=0,
+        context=None,
+    ):
+        self.processes = processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.max_rss_mb = max_rss_mb
+
+        self._ctx = context or multiprocessing.get_context()
+        self._result_q = self._ctx.Queue()
+        self._job_ids = count()
+        self._futures = {}
+        self._queued = deque()
+        self._workers = {}
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+        with self._lock:
+            self._maintain_pool()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule func(*args, **kwargs) to be run by a worker"""
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit jobs after shutdown")
+            job_id = next(self._job_ids)
+            payload = ForkingPickler.dumps((job_id, func, args, kwargs))
+            self._futures[job_id] = future
+            self._queued.append((job_id, payload))
+            self._dispatch()
+        return future
+
+    @property
+    def pending(self):
+        """The number of jobs submitted but not yet finished"""
+        with self._lock:
+            return len(self._futures)
+
+    def shutdown(self, wait=True):
+        """Stop the workers once all submitted jobs are done"""
+        with self._lock:
+            self._shutdown = True
+            self._dispatch()
+        if wait:
+            self._collector.join()
+
+    def _start_worker(self):
+        task_reader, task_writer = self._ctx.Pipe(duplex=False)
+        proc = self._ctx.Process(
+            target=_worker_main,
+            args=(
+                task_reader,
+                self._result_q,
+                self.initializer,
+                self.initargs,
+                self.max_jobs_per_worker,
+                self.max_rss_mb,
+            ),
+            daemon=True,
+        )
+        proc.start()
+        # Only the worker reads, so sending to it fails once it is dead:
+        task_reader.close()
+        self._workers[proc.pid] = _Worker(proc, task_writer)
+
+    def _dispatch(self):
+        """Send the jobs queued to the idle workers, and stop them when done"""
+        for worker in self._workers.values():
+            if not worker.idle:
+                continue
+            if self._queued:
+                job_id, payload = self._queued.popleft()
+                try:
+                    worker.task_conn.send_bytes(payload)
+                except OSError:
+                    # Dead. The job goes to another worker
+                    self._queued.appendleft((job_id, payload))
+                    worker.accepting = False
+                    continue
+                worker.job_id = job_id
+            elif self._shutdown:
+                worker.accepting = False
+                try:
+                    worker.task_conn.send(None)
+                except OSError:
+                    pass
+
+    def _maintain_pool(self):
+        """Reap the workers that have exited and start new ones as needed"""
+        for pid, worker in list(self._workers.items()):
+            if worker.proc.is_alive():
+                continue
+            worker.proc.join()
+            if worker.job_id is not None:
+                self._drain_results()
+            del self._workers[pid]
+            worker.task_conn.close()
+            if worker.job_id in self._futures:
+                self._futures.pop(worker.job_id).set_exception(
+                    WorkerDied(
+                        "Worker %d died with exit code %d" % (pid, worker.proc.exitcode)
+                    )
+                )
+
+        if self._shutdown and not self._futures:
+            return
+        while len(self._workers) < self.processes:
+            self._start_worker()
+
+    def _drain_results(self):
+        while True:
+            try:
+                self._handle(self._result_q.get_nowait())
+            except Empty:
+                return
+
+    def _handle(self, message):
+        pid, job_id, (success, value), recycle = message
+        worker = self._workers.get(pid)
+        if worker is not None:
+            worker.job_id = None
+            worker.accepting = worker.accepting and not recycle
+        future = self._futures.pop(job_id, None)
+        if future is None or not future.set_running_or_notify_cancel():
+            return
+        if success:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def _collect(self):
+        """Collect the job results, keep the pool populated and send the jobs queued"""
+        while True:
+            try:
+                message = self._result_q.get(timeout=self.poll_interval)
+            except Empty:
+                message = None
+            with self._lock:
+                if message is not None:
+                    self._handle(message)
+                self._maintain_pool()
+                self._dispatch()
+                if self._shutdown and not self._workers:
+                    break
+        self._result_q.close()
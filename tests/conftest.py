@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+"""Fixtures shared by the unit tests."""
+from datetime import datetime
+
+import pytest
+
+from ears_iasi_lvl2_format_converter.synthetic import (
+    synthetic_granule_name,
+    write_synthetic_granule,
+)
+
+
+@pytest.fixture
+def synthetic_granule(tmp_path):
+    """Path to a small synthetic IASI level-2 granule, of 4 scan lines (480 profiles)."""
+    start_time = datetime(2023, 3, 27, 9, 16, 6)
+    fname = synthetic_granule_name(start_time, nlines=4)
+    return str(write_synthetic_granule(tmp_path / fname, nlines=4, start_time=start_time))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Unit tests for the aggregation of granules into passes."""
+import os
+from datetime import datetime
+
+import numpy as np
+from netCDF4 import Dataset
+
+from ears_iasi_lvl2_format_converter.aggregation import PassAggregator
+from ears_iasi_lvl2_format_converter.filenames import granule_info
+from ears_iasi_lvl2_format_converter.iasi_lvl2 import IasiLvl2
+from ears_iasi_lvl2_format_converter.synthetic import (
+    synthetic_granule_name,
+    write_synthetic_granule,
+)
+
+# Two consecutive granules (of 4 and 2 scan lines), and one of the next pass:
+GRANULE_STARTS = [
+    datetime(2023, 3, 27, 9, 16, 6),
+    datetime(2023, 3, 27, 9, 16, 38),
+    datetime(2023, 3, 27, 11, 0, 6),
+]
+
+
+def _convert(tmp_path, start_time, nlines):
+    fname = synthetic_granule_name(start_time, nlines)
+    granule = str(
+        write_synthetic_granule(tmp_path / fname, nlines=nlines, start_time=start_time)
+    )
+    l2p = IasiLvl2(granule)
+    return (
+        l2p,
+        l2p.ncwrite_products(granule.replace(".hdf", ".nc")),
+        granule_info(granule),
+    )
+
+
+def test_pass_aggregator(tmp_path):
+    output_path = tmp_path / "passes"
+    output_path.mkdir()
+    aggregator = PassAggregator(str(output_path), gap=60, chunk_profiles=100)
+
+    granules = []
+    for start_time, nlines in zip(GRANULE_STARTS, (4, 2, 2)):
+        l2p, files, (platform_name, start_time, end_time) = _convert(
+            tmp_path, start_time, nlines
+        )
+        granules.append(l2p)
+        closed = aggregator.add(files, platform_name, start_time, end_time, "mda")
+        assert not any(os.path.exists(fname) for fname in files)
+
+    assert len(closed) == 1 and len(aggregator) == 1
+    first_pass = closed[0]
+    assert first_pass.ngranules == 2
+    assert first_pass.metadata == "mda"
+    assert (first_pass.start_time, first_pass.end_time) == (
+        granules[0].start_time,
+        granules[1].end_time,
+    )
+    vprof, vcross = first_pass.filenames
+    assert vprof.endswith("20230327091606Z_20230327091654Z_vprof.nc")
+
+    with Dataset(vprof) as nc_vprof, Dataset(vcross) as nc_vcross:
+        assert nc_vprof.dimensions["x"].size == 720
+        assert nc_vprof.dimensions["nvcross"].size == 720
+        assert nc_vcross.dimensions["nvcross"].size == 12
+        assert nc_vprof.id == vprof
+        np.testing.assert_array_equal(
+            nc_vprof["air_temperature_ml"][0, :, 0, :],
+            np.concatenate([l2p.temp.data[:, 0, :] for l2p in granules[0:2]], axis=-1),
+        )
+        np.testing.assert_array_equal(
+            nc_vprof["dew_point_temperature"][:].mask[0, :, 0, :],
+            np.concatenate(
+                [l2p.tdew.data.mask[:, 0, :] for l2p in granules[0:2]], axis=-1
+            ),
+        )
+        np.testing.assert_array_equal(nc_vprof["x"][:], np.arange(720))
+        np.testing.assert_array_equal(
+            nc_vcross["vcross_bnds"][:, 0], np.arange(0, 720, 60)
+        )
+        names = granules[1].make_position_names()
+        assert nc_vprof["vcross_name"][480].tobytes().decode().strip("\x00") == names[0]
+        assert nc_vprof["air_temperature_ml"].chunking() == [1, 101, 1, 100]
+        # The time is stored as float32 seconds since 1970:
+        time_bnds = nc_vprof["time_bnds"][0]
+        assert abs(time_bnds[1] - time_bnds[0] - 48) <= 256
+
+    last_pass = aggregator.close_all()[0]
+    assert last_pass.ngranules == 1
+    assert sorted(os.listdir(output_path)) == sorted(
+        os.path.basename(fname) for fname in first_pass.filenames + last_pass.filenames
+    )
+
+
+def test_pass_aggregator_packed(tmp_path):
+    """The granules packed with different scale factors and offsets are unpacked"""
+    output_path = tmp_path / "passes"
+    output_path.mkdir()
+    aggregator = PassAggregator(str(output_path), gap=120)
+
+    expected = []
+    start_time = datetime(2023, 3, 27, 9, 16, 6)
+    for seed, lat0 in ((1, 55.0), (7, 65.0)):
+        granule = str(
+            write_synthetic_granule(
+                tmp_path / synthetic_granule_name(start_time, 4),
+                nlines=4,
+                start_time=start_time,
+                lat0=lat0,
+                seed=seed,
+            )
+        )
+        files = IasiLvl2(granule).ncwrite_products(
+            granule.replace(".hdf", ".nc"), packing="auto"
+        )
+        with Dataset(files[0]) as ncf:
+            assert ncf["air_temperature_ml"].dtype == np.int16
+            expected.append(ncf["air_temperature_ml"][:])
+        platform_name, start, end = granule_info(granule)
+        closed = aggregator.add(files, platform_name, start, end)
+        start_time = end
+    assert closed == []
+
+    vprof = aggregator.close_all()[0].filenames[0]
+    with Dataset(vprof) as ncf:
+        assert "scale_factor" not in ncf["air_temperature_ml"].ncattrs()
+        np.testing.assert_array_equal(
+            ncf["air_temperature_ml"][:], np.ma.concatenate(expected, axis=-1)
+        )
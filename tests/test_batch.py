@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Unit tests for the batch conversion."""
+import os
+import time
+from datetime import datetime
+
+import pytest
+from netCDF4 import Dataset
+
+from ears_iasi_lvl2_format_converter import conversion
+from ears_iasi_lvl2_format_converter.batch import find_granules, is_converted, run_batch
+from ears_iasi_lvl2_format_converter.synthetic import (
+    synthetic_granule_name,
+    write_synthetic_granule,
+)
+
+GRANULE_START = datetime(2023, 3, 27, 9, 16, 6)
+OTHER_START = datetime(2023, 3, 27, 9, 28, 6)
+GRANULE_FNAME = synthetic_granule_name(GRANULE_START, nlines=4)
+OTHER_FNAME = synthetic_granule_name(OTHER_START, nlines=2)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    """Directory with two synthetic granules, and an empty output directory."""
+    indir = tmp_path / "archive"
+    indir.mkdir()
+    (tmp_path / "output").mkdir()
+    write_synthetic_granule(indir / GRANULE_FNAME, nlines=4, start_time=GRANULE_START)
+    write_synthetic_granule(indir / OTHER_FNAME, nlines=2, start_time=OTHER_START)
+    (indir / "IASI_PW3_02_M01_20160418132052Z.txt").write_text("not a granule")
+    return indir
+
+
+def test_find_granules(archive):
+    expected = [str(archive / GRANULE_FNAME), str(archive / OTHER_FNAME)]
+    assert find_granules([str(archive)]) == expected
+    assert find_granules([str(archive / "*092806Z*"), str(archive / OTHER_FNAME)]) == [
+        expected[1]
+    ]
+    assert find_granules([str(archive / "missing")]) == []
+
+
+def test_run_batch(archive, tmp_path):
+    output_path = str(tmp_path / "output")
+    filenames = find_granules([str(archive)])
+
+    stats = run_batch(filenames, output_path, workers=2, nc_format="NETCDF4_CLASSIC")
+    assert stats["converted"] == 2 and stats["bytes"] > 0
+    assert all(is_converted(fname, output_path) for fname in filenames)
+    vprof = conversion.output_filenames(filenames[1], output_path)[0]
+    with Dataset(vprof) as nc_vprof:
+        assert nc_vprof.dimensions["x"].size == 240
+        assert nc_vprof.data_model == "NETCDF4_CLASSIC"
+    assert sorted(os.listdir(output_path)) == sorted(
+        os.path.basename(fname)
+        for filename in filenames
+        for fname in conversion.output_filenames(filename, output_path)
+    )
+
+    # Resume: Only the granule newer than its output is converted again
+    future = time.time() + 10
+    os.utime(filenames[0], (future, future))
+    stats = run_batch(filenames, output_path, workers=2)
+    assert (stats["converted"], stats["skipped"]) == (1, 1)
+    stats = run_batch(filenames, output_path, workers=2, force=True)
+    assert (stats["converted"], stats["skipped"]) == (2, 0)
+
+
+def test_run_batch_area_and_failures(archive, tmp_path, monkeypatch):
+    output_path = str(tmp_path / "output")
+    broken = archive / GRANULE_FNAME.replace("lan", "kan")
+    broken.write_bytes(b"not hdf5")
+    # The workers are forked, so they see the patched area check:
+    monkeypatch.setattr(conversion, "granule_inside_area", lambda *args: False)
+
+    stats = run_batch(
+        [str(broken), str(archive / GRANULE_FNAME)], output_path, area_def=object()
+    )
+    assert (stats["converted"], stats["outside"], stats["failed"]) == (0, 2, 0)
+
+    stats = run_batch([str(broken), str(archive / GRANULE_FNAME)], output_path)
+    assert (stats["converted"], stats["failed"]) == (1, 1)
+    assert len(os.listdir(output_path)) == 2
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Unit tests for the conversion of one granule."""
+import os
+import stat
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+from ears_iasi_lvl2_format_converter.conversion import (
+    atomic_output,
+    convert_granule,
+    output_filenames,
+)
+from ears_iasi_lvl2_format_converter.iasi_lvl2 import IasiLvl2
+
+
+@pytest.mark.parametrize("nc_format", ["NETCDF3_CLASSIC", "NETCDF4_CLASSIC"])
+@pytest.mark.parametrize("products", [("vprof",), ("vprof", "vcross")])
+def test_convert_granule_in_memory_or_scratch(
+    synthetic_granule, tmp_path, nc_format, products
+):
+    """Test the files built in memory and in a scratch directory are the same"""
+    granule = synthetic_granule
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    results = {}
+    for mode, scratch_path in (("memory", "memory"), ("scratch", str(scratch))):
+        output_path = tmp_path / ("output_" + mode)
+        output_path.mkdir()
+        results[mode] = convert_granule(
+            granule,
+            str(output_path),
+            products=products,
+            scratch_path=scratch_path,
+            nc_format=nc_format,
+        )
+        assert results[mode] == output_filenames(granule, str(output_path), products)
+        # No temporary files left behind, and the files readable as usual:
+        assert sorted(os.listdir(output_path)) == sorted(
+            os.path.basename(fname) for fname in results[mode]
+        )
+        assert os.stat(results[mode][0]).st_mode & stat.S_IRUSR
+        assert not os.stat(results[mode][0]).st_mode & stat.S_IXUSR
+    assert os.listdir(scratch) == []
+
+    for in_memory, in_scratch in zip(results["memory"], results["scratch"]):
+        with Dataset(in_memory) as mem, Dataset(in_scratch) as scr:
+            assert mem.file_format == nc_format
+            assert mem.id == in_memory
+            assert set(mem.variables) == set(scr.variables)
+            for name in mem.variables:
+                np.testing.assert_array_equal(mem[name][:], scr[name][:])
+
+
+def test_atomic_output(tmp_path):
+    """Test the file is only in place when complete, and nothing left on failure"""
+    target = str(tmp_path / "file.nc")
+    with atomic_output(target) as fpt:
+        fpt.write(b"complete")
+        assert not os.path.exists(target)
+    with pytest.raises(RuntimeError):
+        with atomic_output(target) as fpt:
+            fpt.write(b"partial")
+            raise RuntimeError("Failed")
+    assert os.listdir(tmp_path) == ["file.nc"]
+    with open(target, "rb") as fpt:
+        assert fpt.read() == b"complete"
+
+
+def test_convert_granule_in_memory_all_products(synthetic_granule, tmp_path, monkeypatch):
+    """Test all the products are built in memory when configured, without scratch files"""
+    granule = synthetic_granule
+
+    def not_on_disk(*args, **kwargs):
+        raise AssertionError("Built in a scratch directory")
+
+    monkeypatch.setattr(IasiLvl2, "ncwrite_products", not_on_disk)
+    result_files = convert_granule(granule, str(tmp_path), scratch_path="memory")
+    assert result_files == output_filenames(granule, str(tmp_path))
+    assert all(os.path.exists(fname) for fname in result_files)
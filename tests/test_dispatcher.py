@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Unit tests for the asyncio dispatcher of the conversion jobs."""
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+
+from ears_iasi_lvl2_format_converter.dispatcher import Dispatcher
+from ears_iasi_lvl2_format_converter.jobs import JobRegistry, JobScheduler
+from ears_iasi_lvl2_format_converter.workers import WorkerPool
+
+START = datetime(2023, 3, 27, 9, 16)
+
+
+def _convert(seconds, registered):
+    time.sleep(seconds)
+    return seconds
+
+
+def _converted_at(seconds, registered):
+    return time.time()
+
+
+def _idle(messages, pause=0.01):
+    """Give the messages, then None (no message received) forever"""
+    yield from messages
+    while True:
+        time.sleep(pause)
+        yield None
+
+
+def _dispatcher(pool, finished, workers=1, convert=_convert, finish=None):
+    jobs = JobRegistry(ttl=60)
+    scheduler = JobScheduler(maxsize=10)
+
+    def schedule(msg):
+        key, seconds = msg
+        job, is_new = jobs.register(key)
+        if is_new:
+            job.args = (seconds,)
+            scheduler.put(job, START + timedelta(minutes=len(jobs)), "metopb")
+
+    return Dispatcher(
+        pool,
+        scheduler,
+        jobs,
+        schedule=schedule,
+        convert=convert,
+        finish=finish or (lambda job: finished.append((job.key, job.future.result()))),
+        workers=workers,
+        tick_interval=0.05,
+    )
+
+
+def test_dispatcher_runs_jobs_until_messages_end():
+    pool = WorkerPool(1)
+    finished = []
+    dispatcher = _dispatcher(pool, finished)
+    messages = [("a", 0), None, ("b", 0.01), ("a", 0), ("c", 0)]
+    asyncio.run(dispatcher.run(iter(messages)))
+    pool.shutdown()
+
+    # The duplicate is ignored, and the jobs queued when the messages end are run:
+    assert sorted(finished) == [("a", 0), ("b", 0.01), ("c", 0)]
+    assert dispatcher.running == 0
+
+
+def test_dispatcher_stop_waits_for_running_jobs():
+    pool = WorkerPool(1)
+    finished = []
+    dispatcher = _dispatcher(pool, finished)
+    timer = threading.Timer(0.3, dispatcher.stop)
+    timer.start()
+    started = time.monotonic()
+    asyncio.run(dispatcher.run(_idle([("slow", 0.5)])))
+    pool.shutdown()
+    timer.join()
+
+    assert finished == [("slow", 0.5)]
+    assert time.monotonic() - started < 5
+
+
+def test_dispatcher_joins_receiver():
+    pool = WorkerPool(1)
+    dispatcher = _dispatcher(pool, [])
+    timer = threading.Timer(0.1, dispatcher.stop)
+    timer.start()
+    asyncio.run(dispatcher.run(_idle([], pause=0.5)))
+    # No thread is left taking the messages:
+    receivers = [t for t in threading.enumerate() if t.name.startswith("receiver")]
+    pool.shutdown()
+    timer.join()
+
+    assert receivers == []
+
+
+def test_dispatcher_finishes_off_the_loop():
+    """Test a slow finish doesn't hold up the next job, and the finishes are in order"""
+    pool = WorkerPool(1)
+    finished = []
+
+    def finish(job):
+        if not finished:
+            time.sleep(0.5)
+        finished.append((job.future.result(), time.time(), threading.current_thread()))
+
+    dispatcher = _dispatcher(pool, finished, convert=_converted_at, finish=finish)
+    asyncio.run(dispatcher.run(iter([("a", 0), ("b", 0)])))
+    pool.shutdown()
+
+    (first_converted, first_finished, first_thread), second = finished
+    assert second[0] < first_finished
+    assert second[2] is first_thread is not threading.main_thread()
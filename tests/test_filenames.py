@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Unit tests for the parsing of the IASI level-2 filenames."""
+from datetime import datetime
+
+import pytest
+
+from ears_iasi_lvl2_format_converter.conversion import output_filenames
+from ears_iasi_lvl2_format_converter.filenames import (
+    FilenameParser,
+    granule_info,
+    granule_stem,
+    parse_filename,
+)
+
+EARS_FNAME = (
+    "W_XX-EUMETSAT-kan,iasi,metopb+kan_C_EUMS_20170419171127_IASI_PW3_02_M01_"
+    "20170419164952Z_20170419170214Z.hdf"
+)
+START_TIME = datetime(2017, 4, 19, 16, 49, 52)
+END_TIME = datetime(2017, 4, 19, 17, 2, 14)
+
+
+@pytest.mark.parametrize(
+    "filename",
+    [
+        EARS_FNAME,
+        "/data/" + EARS_FNAME,
+        EARS_FNAME.replace(".hdf", ".nc"),
+        EARS_FNAME.replace(".hdf", "_vprof.nc"),
+        "IASI_PW3_02_M01_20170419164952Z_20170419170214Z_N_O_20170419171127Z.h5",
+        "IASI_PW3_02_M01_20170419164952Z_20170419170214Z_N_O_20170419171127Z_vcross.nc",
+    ],
+)
+def test_parse_filename(filename):
+    assert granule_info(filename) == ("M01", START_TIME, END_TIME)
+
+
+def test_parse_filename_converted():
+    for result_file in output_filenames(EARS_FNAME, "/output"):
+        granule = parse_filename(result_file)
+        assert granule[0:3] == ("M01", START_TIME, END_TIME)
+        assert granule.items["ears_station"] == "kan"
+
+
+def test_parse_filename_without_end_time():
+    granule = parse_filename(
+        "W_XX-EUMETSAT-mos,IASI,DBNet+metopb+mos_C_EUMS_20161110084055_IASI_PW3_02.hdf"
+    )
+    assert granule.platform_name == "metopb"
+    assert granule.end_time == datetime(2016, 11, 10, 8, 55, 55)
+
+
+def test_parse_filename_unknown():
+    with pytest.raises(ValueError, match="Unknown"):
+        parse_filename("/data/avhrr_20170419.hdf")
+
+
+def test_filename_parser_memoized():
+    filename_parser = FilenameParser()
+    for dummy in range(3):
+        filename_parser.parse(EARS_FNAME)
+    assert filename_parser.parse.cache_info().hits == 2
+
+
+def test_granule_stem():
+    # The suffixes are removed, not the characters of them:
+    assert granule_stem("fh5.h5") == "fh5"
+    assert granule_stem("scan_vprof_vprof.nc") == "scan_vprof"
+    assert granule_stem("notes.txt") == "notes.txt"
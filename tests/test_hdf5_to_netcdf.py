@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Unit tests for the posttroll runner."""
+import json
+import os
+import pickle
+import subprocess
+import sys
+from datetime import datetime
+
+from posttroll.message import Message
+
+from ears_iasi_lvl2_format_converter.hdf5_to_netcdf import RunnerSettings, make_scene
+
+CONFIGS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "configs"
+)
+HEAVY_MODULES = (
+    "h5py",
+    "netCDF4",
+    "netifaces",
+    "numpy",
+    "posttroll",
+    "pykdtree",
+    "pyorbital",
+    "pyresample",
+)
+# Seconds. Importing the runner takes well under 0.1 s without the heavy modules:
+IMPORT_BUDGET = 1.0
+
+IMPORT_CODE = """
+import json, sys, time
+started = time.perf_counter()
+import ears_iasi_lvl2_format_converter.hdf5_to_netcdf
+elapsed = time.perf_counter() - started
+heavy = [name for name in sys.argv[1:] if name in sys.modules]
+print(json.dumps({"elapsed": elapsed, "heavy": heavy}))
+"""
+
+
+def test_import_is_fast_and_without_side_effects():
+    """Importing the runner reads no arguments or config, and loads no heavy modules"""
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_CODE] + list(HEAVY_MODULES),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imported = json.loads(result.stdout)
+    assert imported["heavy"] == []
+    assert imported["elapsed"] < IMPORT_BUDGET
+
+
+def test_runner_settings():
+    settings = RunnerSettings.from_config(
+        os.path.join(CONFIGS, "iasi_level2_config.cfg"),
+        os.path.join(CONFIGS, "areas.def"),
+        mode="offline",
+    )
+    assert settings.workers == 6
+    assert settings.conversion_options["dtype"] == "float32"
+    assert not settings.aggregate_passes
+
+    # The settings are sent to the workers with the jobs:
+    settings = pickle.loads(pickle.dumps(settings))
+    assert settings.area_def().area_id == settings.area_of_interest
+
+
+def test_make_scene_times_from_filename():
+    fname = (
+        "W_XX-EUMETSAT-kan,iasi,metopb+kan_C_EUMS_20170419171127_IASI_PW3_02_M01_"
+        "20170419164952Z_20170419170214Z.hdf"
+    )
+    msg = Message(
+        "/2/iasi/ears",
+        "file",
+        {"uri": "/data/" + fname, "platform_name": "Metop-B", "sensor": "iasi"},
+    )
+    scene = make_scene(msg)
+    assert scene["starttime"] == datetime(2017, 4, 19, 16, 49, 52)
+    assert scene["endtime"] == datetime(2017, 4, 19, 17, 2, 14)
+    assert scene["filename"] == "/data/" + fname
@@ -1,10 +1,328 @@
 #!/usr/bin/env python3
 """Unit tests for the iasi_lcl2 file code."""
-from iasi_level2.iasi_lvl2 import IasiLvl2
+import os
 
+import h5py
+import numpy as np
+import pytest
+from netCDF4 import Dataset
 
+from ears_iasi_lvl2_format_converter.constants import DATA_UPPER_LIMIT
+from ears_iasi_lvl2_format_converter.iasi_lvl2 import (
+    IasiLvl2,
+    dew_point_temperature,
+    encode_position_names,
+    fov_reorder_index,
+    pack_data,
+    pad_char_array,
+    qair2tdew,
+    unpack_data,
+)
+from ears_iasi_lvl2_format_converter.utils import traced_peak_bytes
+
+SYSTEM_TEST_DIR = "/data/lang/satellit2/polar/system_test_cases/iasi_l2"
+
+
+def _legacy_reorder_index(nlines, nfov):
+    """The reorder index as it was originally built in IasiLvl2._load."""
+    index1 = np.arange(3, nfov * nlines, 4)
+    index2 = np.arange(0, nfov * nlines, 4)
+    index3 = np.arange(2, nfov * nlines, 4)
+    index4 = np.arange(1, nfov * nlines, 4)
+    idx_a = np.empty((index1.size + index2.size,), dtype=index1.dtype)
+    idx_b = np.empty((index3.size + index4.size,), dtype=index3.dtype)
+    idx_a[0::2] = index1
+    idx_a[1::2] = index2
+    idx_b[0::2] = index3
+    idx_b[1::2] = index4
+    idx = np.empty((nlines * 2, nfov // 2), dtype=index1.dtype)
+    idx[0::2, :] = idx_a.reshape((nlines, nfov // 2))
+    idx[1::2, :] = idx_b.reshape((nlines, nfov // 2))
+    return idx.ravel()
+
+
+def _legacy_position_name(lon, lat):
+    """The location name as it was originally built in make_position_names."""
+    if lat > 0:
+        latname = "N%.4d" % int(lat * 100)
+    else:
+        latname = "S%.4d" % int(abs(lat * 100))
+    if lon > 0:
+        lonname = "E%.5d" % int(lon * 100)
+    else:
+        lonname = "W%.5d" % int(abs(lon * 100))
+    return "%s;%s" % (latname, lonname)
+
+
+def test_fov_reorder_index():
+    idx = fov_reorder_index(23, 120)
+    np.testing.assert_array_equal(idx, _legacy_reorder_index(23, 120))
+    assert fov_reorder_index(23, 120) is idx
+    assert not idx.flags.writeable
+
+
+def test_encode_position_names():
+    lats = np.array([73.3, -0.004, 0.0, -89.999, 12.345678], dtype=np.float32)
+    lons = np.array([5.0, -179.99, 0.0, 180.0, -0.5], dtype=np.float32)
+    names = encode_position_names(lats[np.newaxis, :], lons[np.newaxis, :])
+
+    assert names.shape == (5, 12)
+    expected = [_legacy_position_name(lon, lat) for lon, lat in zip(lons, lats)]
+    assert [name.tobytes().decode() for name in names] == expected
+
+    chars = pad_char_array(names, 80)
+    assert chars.shape == (5, 80)
+    assert chars.dtype == np.dtype("S1")
+    assert chars[0].tobytes() == b"N7330;E00500" + b"\x00" * 68
+
+
+def test_dew_point_temperature():
+    rng = np.random.default_rng(2)
+    shape = (101, 1, 240)
+    temp = rng.uniform(190, 310, shape).astype(np.float32)
+    pres = np.broadcast_to(
+        np.linspace(0.5, 105000.0, 101, dtype=np.float32)[:, np.newaxis, np.newaxis],
+        shape,
+    )
+    qspec = np.ma.masked_greater(
+        rng.uniform(1e-7, 2e-2, shape).astype(np.float32), 1000000
+    )
+    qspec[-1, 0, 0:3] = [3.4e38, 0.0, 1.0]
+    qspec[-1, 0, 0] = np.ma.masked
+    pres = np.ma.masked_greater(pres, 1000000)
+
+    with np.errstate(divide="ignore"):
+        expected = qair2tdew(qspec, temp - 273.15, pres / 100.0) + 273.15
+    out = np.empty(shape, dtype=np.float32)
+    tdew = dew_point_temperature(qspec, temp, pres, out=out)
+
+    assert tdew.dtype == np.float32
+    assert np.shares_memory(tdew, out)
+    np.testing.assert_array_equal(tdew.mask, np.ma.getmaskarray(expected))
+    assert tdew.mask[-1, 0, 0:2].all()
+    # Saturated (rh clipped to 100 %), the dew point is the temperature:
+    np.testing.assert_allclose(tdew[-1, 0, 2], temp[-1, 0, 2], atol=1e-3)
+    np.testing.assert_allclose(tdew.compressed(), expected.compressed(), atol=2e-3)
+
+
+def test_load_reorders_all_variables(synthetic_granule):
+    l2p = IasiLvl2(synthetic_granule)
+    idx = _legacy_reorder_index(4, 120)
+
+    with h5py.File(synthetic_granule, "r") as h5f:
+        temp = h5f["PWLR/T"][:].reshape(4 * 120, 101).transpose()[:, idx]
+        ozone = h5f["PWLR/O"][:].reshape(4 * 120, 101).transpose()[:, idx]
+        pres = h5f["PWLR/P"][:].reshape(4 * 120, 101).transpose()[:, idx]
+        water = h5f["PWLR/W"][:].reshape(4 * 120, 101).transpose()[:, idx]
+        lats = h5f["L1C/Latitude"][:].ravel()[idx]
+        tskin = h5f["PWLR/Ts"][:].ravel()[idx]
+
+    assert l2p.shape == (101, 1, 480)
+    assert l2p.shape_2d == (1, 480)
+    np.testing.assert_array_equal(l2p.temp.data[:, 0, :], temp)
+    np.testing.assert_array_equal(l2p.ozone.data[:, 0, :], ozone)
+    np.testing.assert_array_equal(l2p.latitudes[0], lats)
+    np.testing.assert_array_equal(
+        l2p.skin_temp.data[0, 0].compressed(), tskin[tskin < 1e6]
+    )
+    np.testing.assert_array_equal(l2p.pres.data.mask[:, 0, :], pres > DATA_UPPER_LIMIT)
+    np.testing.assert_array_equal(
+        l2p.tdew.data.mask[:, 0, :],
+        (pres > DATA_UPPER_LIMIT) | (water > DATA_UPPER_LIMIT),
+    )
+
+
+def test_dtype_policy_and_peak_memory(synthetic_granule, tmp_path):
+    # The size of one profile variable of the granule in float32:
+    cube = 101 * 480 * 4
+    l2p, peak = traced_peak_bytes(IasiLvl2, synthetic_granule)
+    l2p64, peak64 = traced_peak_bytes(IasiLvl2, synthetic_granule, dtype="float64")
+
+    for key in ("temp", "tdew", "pres", "qspec", "ozone", "skin_temp", "topo"):
+        assert getattr(l2p, key).data.dtype == np.float32
+        assert getattr(l2p64, key).data.dtype == np.float64
+    assert l2p.latitudes.dtype == np.float32
+    np.testing.assert_allclose(l2p.tdew.data, l2p64.tdew.data, atol=2e-3)
+
+    # The five profile variables and their masks (all but the temperature) are
+    # kept, with the surface fields, and the peak while reading and deriving
+    # them stays below eight variables:
+    surface = 480 * 4 * (4 + 1)
+    assert 5 * cube < l2p.nbytes < 6 * cube + surface
+    assert peak < 8 * cube
+    assert peak < 0.55 * peak64
+
+    nc_fname = os.path.basename(synthetic_granule).replace(".hdf", ".nc")
+    nc_l2p = IasiLvl2(l2p.ncwrite(str(tmp_path / nc_fname)))
+    assert nc_l2p.temp.data.dtype == np.float32
+
+
+def test_lazy_load(synthetic_granule):
+    eager = IasiLvl2(synthetic_granule)
+    with IasiLvl2(synthetic_granule, lazy=True) as l2p:
+        np.testing.assert_array_equal(l2p.latitudes, eager.latitudes)
+        assert l2p.shape == eager.shape
+        assert not any(
+            param.loaded
+            for param in (l2p.temp, l2p.pres, l2p.tdew, l2p.qspec, l2p.ozone, l2p.topo)
+        )
+
+        np.testing.assert_array_equal(l2p.tdew.data, eager.tdew.data)
+        assert l2p.temp.loaded and l2p.pres.loaded and l2p.qspec.loaded
+        assert not l2p.ozone.loaded and not l2p.skin_temp.loaded
+
+        np.testing.assert_array_equal(l2p.skin_temp.data, eager.skin_temp.data)
+        np.testing.assert_array_equal(l2p.skin_temp.data.mask, eager.skin_temp.data.mask)
+    assert l2p._h5f is None
+
+
+@pytest.mark.parametrize("lazy", [True, False])
+def test_load_failure_closes_file(synthetic_granule, lazy):
+    with h5py.File(synthetic_granule, "r+") as h5f:
+        del h5f["L1C/Longitude"]
+    with pytest.raises(KeyError):
+        IasiLvl2(synthetic_granule, lazy=lazy)
+    # The file would still be open read-only:
+    h5py.File(synthetic_granule, "r+").close()
+
+
+@pytest.mark.parametrize("lazy", [True, False])
+def test_crop(synthetic_granule, tmp_path, lazy):
+    eager = IasiLvl2(synthetic_granule)
+    inside = np.zeros((480,), dtype=bool)
+    inside[[65, 300]] = True
+    keep = np.zeros((480,), dtype=bool)
+    keep[60:120] = keep[300:360] = True
+
+    with IasiLvl2(synthetic_granule, lazy=lazy) as l2p:
+        assert l2p.crop(inside) == 120
+        assert l2p.shape == (101, 1, 120)
+        assert l2p.shape_2d == (1, 120)
+        np.testing.assert_array_equal(l2p.longitudes, eager.longitudes[:, keep])
+        np.testing.assert_array_equal(l2p.tdew.data, eager.tdew.data[..., keep])
+        np.testing.assert_array_equal(l2p.topo.data, eager.topo.data[..., keep])
+        vprof, vcross = l2p.ncwrite_products(str(tmp_path / "granule.nc"))
+
+    with Dataset(vcross) as nc_vcross:
+        assert nc_vcross.dimensions["x"].size == 120
+        assert nc_vcross.dimensions["nvcross"].size == 2
+
+
+def test_ncwrite_products(synthetic_granule, tmp_path):
+    l2p = IasiLvl2(synthetic_granule)
+    prefix = str(tmp_path / os.path.basename(synthetic_granule).replace(".hdf", ""))
+    vprof, vcross = l2p.ncwrite_products(prefix + ".nc")
+
+    assert vprof == prefix + "_vprof.nc"
+    assert vcross == prefix + "_vcross.nc"
+    with Dataset(vprof) as nc_vprof, Dataset(vcross) as nc_vcross:
+        assert nc_vprof.dimensions["nvcross"].size == 480
+        assert nc_vcross.dimensions["nvcross"].size == 8
+        assert nc_vprof.id == vprof
+        assert nc_vcross.id == vcross
+        np.testing.assert_array_equal(
+            nc_vprof["air_temperature_ml"][:], nc_vcross["air_temperature_ml"][:]
+        )
+        np.testing.assert_array_equal(
+            nc_vcross["vcross_bnds"][:, 0], np.arange(0, 480, 60)
+        )
+        locnames = l2p.make_position_names()
+        assert nc_vprof["vcross_name"][1].tobytes().decode().strip("\x00") == locnames[1]
+        assert nc_vcross["vcross_name"][1].tobytes().decode().strip("\x00") == (
+            locnames[60] + " " + locnames[119]
+        )
+
+    assert IasiLvl2(vprof).locations.shape == (480,)
+    with IasiLvl2(vcross, lazy=True) as nc_l2p:
+        assert not nc_l2p.temp.loaded
+        np.testing.assert_array_equal(nc_l2p.temp.data, l2p.temp.data)
+
+
+def test_ncwrite_single_product(synthetic_granule, tmp_path):
+    l2p = IasiLvl2(synthetic_granule)
+    assert l2p.ncwrite(str(tmp_path / "granule.nc"), vprof=False) == str(
+        tmp_path / "granule_vcross.nc"
+    )
+    assert not (tmp_path / "granule_vprof.nc").exists()
+    with pytest.raises(ValueError):
+        l2p.ncwrite_products(str(tmp_path / "granule.nc"), products=("vprofile",))
+
+
+@pytest.mark.parametrize("nc_format", ["NETCDF4_CLASSIC", "NETCDF4"])
+def test_ncwrite_netcdf4(synthetic_granule, tmp_path, nc_format):
+    l2p = IasiLvl2(synthetic_granule)
+    classic = l2p.ncwrite(str(tmp_path / "classic.nc"))
+    nc4 = l2p.ncwrite(
+        str(tmp_path / "granule.nc"),
+        nc_format=nc_format,
+        complevel=4,
+        chunk_profiles=100,
+    )
+
+    with Dataset(classic) as nc_classic, Dataset(nc4) as nc_nc4:
+        assert nc_classic.data_model == "NETCDF3_CLASSIC"
+        assert nc_nc4.data_model == nc_format
+        temp = nc_nc4["air_temperature_ml"]
+        assert temp.chunking() == [1, 101, 1, 100]
+        assert temp.filters()["zlib"] and temp.filters()["shuffle"]
+        assert temp.filters()["complevel"] == 4
+        assert nc_nc4["surface_temperature"].chunking() == [1, 1, 1, 100]
+        for name in nc_classic.variables:
+            np.testing.assert_array_equal(nc_nc4[name][:], nc_classic[name][:])
+
+    uncompressed = l2p.ncwrite(
+        str(tmp_path / "raw.nc"), nc_format=nc_format, compression=None
+    )
+    with Dataset(uncompressed) as nc_raw:
+        assert not nc_raw["air_temperature_ml"].filters()["zlib"]
+
+
+def test_pack_data():
+    data = np.ma.masked_array([250.0, 250.0051, -9.0, 1000.0, 0.0], mask=[0, 0, 0, 0, 1])
+    packed = pack_data(data, 0.005, 250.0)
+    assert packed.dtype == np.int16
+    np.testing.assert_array_equal(packed, [0, 1, -32768, 32767, -32768])
+    unpacked = unpack_data(packed, 0.005, 250.0)
+    np.testing.assert_array_equal(unpacked.mask, [0, 0, 1, 0, 1])
+    np.testing.assert_allclose(unpacked[0:2], [250.0, 250.005])
+
+
+@pytest.mark.parametrize("packing", ["fixed", "auto"])
+def test_ncwrite_packed(synthetic_granule, tmp_path, packing):
+    l2p = IasiLvl2(synthetic_granule)
+    report = l2p.packing_report(packing)
+    assert set(report) == {"temp", "tdew", "skin_temp", "topo"}
+    for key, accuracy in report.items():
+        assert accuracy["clipped"] == 0
+        assert accuracy["max_abs_error"] <= 0.51 * accuracy["scale_factor"]
+    for key in ("temp", "tdew", "skin_temp"):
+        assert report[key]["max_rel_error"] < 1e-4
+
+    prefix = str(tmp_path / os.path.basename(synthetic_granule).replace(".hdf", ""))
+    packed = l2p.ncwrite(prefix + ".nc", packing=packing)
+    with Dataset(packed) as nc_packed:
+        temp = nc_packed["air_temperature_ml"]
+        assert temp.dtype == np.int16
+        assert temp._FillValue == -32768
+        assert temp.scale_factor == np.float32(report["temp"]["scale_factor"])
+
+    with IasiLvl2(packed) as nc_l2p:
+        for key in ("temp", "tdew", "pres", "qspec", "ozone"):
+            data = getattr(nc_l2p, key).data
+            expected = np.ma.asarray(getattr(l2p, key).data)
+            np.testing.assert_array_equal(
+                np.ma.getmaskarray(data), np.ma.getmaskarray(expected)
+            )
+            # The pressure, humidity and ozone are not packed:
+            atol = 0.51 * report[key]["scale_factor"] if key in report else 0
+            np.testing.assert_allclose(
+                data.compressed(), expected.compressed(), rtol=0, atol=atol
+            )
+
+
+@pytest.mark.skipif(not os.path.isdir(SYSTEM_TEST_DIR), reason="System test data missing")
 def test_iasi_lvl2():
-    directory = "/data/lang/satellit2/polar/system_test_cases/iasi_l2"
+    directory = SYSTEM_TEST_DIR
     fname = "W_XX-EUMETSAT-lan,iasi,metopb+lan_C_EUMS_20230327093536_IASI_PW3_02_M01_"
     fname += "20230327091606Z_20230327092820Z.hdf"
     TESTFILE = f"{directory}/{fname}"
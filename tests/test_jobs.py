@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Unit tests for the job book keeping."""
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+
+import pytest
+
+from ears_iasi_lvl2_format_converter.jobs import JobRegistry, JobScheduler
+
+NOW = datetime(2023, 3, 27, 12, 0)
+
+
+class FakeClock(object):
+    """A clock to be advanced by hand."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _done_future(exception=None):
+    future = Future()
+    if exception is None:
+        future.set_result(None)
+    else:
+        future.set_exception(exception)
+    return future
+
+
+def test_job_registry_deduplicates():
+    clock = FakeClock()
+    jobs = JobRegistry(ttl=300, clock=clock)
+
+    job, is_new = jobs.register("Metop-B_202303270916")
+    assert is_new and job.in_flight
+    job.future = Future()
+
+    clock.now = 10
+    same_job, is_new = jobs.register("Metop-B_202303270916")
+    assert not is_new and same_job is job
+    assert job.duplicates == 1
+    assert jobs.register("Metop-C_202303270916")[1]
+    assert len(jobs) == 2
+
+
+def test_job_registry_expiry():
+    clock = FakeClock()
+    jobs = JobRegistry(ttl=300, clock=clock)
+    job = jobs.register("granule")[0]
+    job.future = Future()
+
+    # Still in flight after the ttl: Kept
+    clock.now = 400
+    assert "granule" in jobs
+
+    job.future.set_result(None)
+    clock.now = 600
+    assert "granule" in jobs
+    clock.now = 701
+    assert "granule" not in jobs
+    assert len(jobs._expiry) == 0
+
+    new_job, is_new = jobs.register("granule")
+    assert is_new and new_job is not job
+
+
+def test_job_registry_replaces_failed_job():
+    jobs = JobRegistry(ttl=300, clock=FakeClock())
+    job = jobs.register("granule")[0]
+    job.future = _done_future(IOError("failed"))
+    assert job.failed
+
+    new_job, is_new = jobs.register("granule")
+    assert is_new and new_job is not job
+    new_job.future = _done_future()
+    assert not jobs.register("granule")[1]
+
+
+def _put(scheduler, name, minutes_ago, platform_name="Metop-B"):
+    return scheduler.put(name, NOW - timedelta(minutes=minutes_ago), platform_name)
+
+
+def _pop_all(scheduler):
+    items = []
+    while len(scheduler):
+        item, dummy = scheduler.pop()
+        if item is None:
+            break
+        items.append(item)
+    return items
+
+
+def test_scheduler_newest_first():
+    scheduler = JobScheduler(maxsize=10, now=lambda: NOW)
+    _put(scheduler, "old", 60)
+    _put(scheduler, "new", 5, "Metop-C")
+    _put(scheduler, "mid", 30)
+    assert scheduler.stats()["platforms"] == {"Metop-B": 2, "Metop-C": 1}
+    assert _pop_all(scheduler) == ["new", "mid", "old"]
+    assert scheduler.pop() == (None, [])
+
+
+def test_scheduler_fair():
+    scheduler = JobScheduler(maxsize=10, policy="fair", now=lambda: NOW)
+    for minutes_ago in (1, 2, 3):
+        _put(scheduler, "B%d" % minutes_ago, minutes_ago, "Metop-B")
+    _put(scheduler, "C10", 10, "Metop-C")
+    _put(scheduler, "C20", 20, "Metop-C")
+    assert _pop_all(scheduler) == ["B1", "C10", "B2", "C20", "B3"]
+
+
+def test_scheduler_bounded():
+    scheduler = JobScheduler(maxsize=2, now=lambda: NOW)
+    assert _put(scheduler, "mid", 30) == []
+    assert _put(scheduler, "old", 60) == []
+    assert _put(scheduler, "new", 5, "Metop-C") == ["old"]
+    assert scheduler.stats()["dropped"] == 1
+    assert _pop_all(scheduler) == ["new", "mid"]
+
+
+@pytest.mark.parametrize("stale", ["drop", "defer"])
+def test_scheduler_stale_jobs(stale):
+    scheduler = JobScheduler(maxsize=10, max_age=3600, stale=stale, now=lambda: NOW)
+    _put(scheduler, "stale", 120)
+    _put(scheduler, "fresh", 30)
+    _put(scheduler, "stale-c", 90, "Metop-C")
+
+    assert scheduler.pop() == ("fresh", [])
+    item, dropped = scheduler.pop()
+    if stale == "drop":
+        assert item is None
+        assert sorted(dropped) == ["stale", "stale-c"]
+        assert len(scheduler) == 0
+    else:
+        assert item == "stale-c" and dropped == []
+        assert scheduler.stats()["deferred"] == 1
+        assert scheduler.pop() == ("stale", [])
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Unit tests for the filtering of the messages received."""
+import socket
+from datetime import datetime
+
+from posttroll.message import Message
+
+from ears_iasi_lvl2_format_converter.message_filter import HostResolver, MessageFilter
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeDNS(object):
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.lookups = []
+
+    def __call__(self, host):
+        self.lookups.append(host)
+        if host not in self.hosts:
+            raise socket.gaierror("Name or service not known")
+        return self.hosts[host]
+
+
+def _message(host="localhost", **data):
+    mda = {
+        "uri": f"ssh://{host}/data/iasi/IASI_SND_02_M01_20230327091606Z.hdf",
+        "platform_name": "Metop-B",
+        "sensor": ["iasi"],
+        "start_time": datetime(2023, 3, 27, 9, 16, 6),
+    }
+    mda.update(data)
+    return Message("/2/iasi/ears", "file", mda)
+
+
+def _resolver(clock, dns, local_ips=("127.0.0.1", "10.0.0.5")):
+    calls = []
+
+    def get_local_ips():
+        calls.append(clock())
+        return list(local_ips)
+
+    resolver = HostResolver(
+        ttl=300,
+        negative_ttl=30,
+        local_ttl=60,
+        resolve=dns,
+        local_ips=get_local_ips,
+        hostname=lambda: "thishost",
+        clock=clock,
+    )
+    return resolver, calls
+
+
+def test_host_resolver_caches_lookups():
+    clock = FakeClock()
+    dns = FakeDNS({"localhost": "127.0.0.1", "here": "10.0.0.5", "there": "10.0.0.9"})
+    resolver, local_calls = _resolver(clock, dns)
+
+    assert resolver.is_local("localhost")
+    assert resolver.is_local("here")
+    assert not resolver.is_local("there")
+    assert not resolver.is_local("nowhere")
+    assert resolver.is_local("10.0.0.5")
+    assert resolver.is_local("thishost")
+    for dummy in range(10):
+        resolver.is_local("there")
+        resolver.is_local("nowhere")
+    assert dns.lookups == ["localhost", "here", "there", "nowhere"]
+    assert len(local_calls) == 1
+
+    # The expired entries are used until refreshed, and the failed lookup is
+    # retried sooner than the others:
+    clock.now = 31
+    assert not resolver.is_local("nowhere")
+    assert dns.lookups[4:] == []
+    resolver.refresh()
+    assert dns.lookups[4:] == ["nowhere"]
+    assert len(local_calls) == 1
+
+    clock.now = 301
+    dns.hosts["there"] = "10.0.0.5"
+    assert not resolver.is_local("there")
+    assert dns.lookups[5:] == []
+    assert len(local_calls) == 2
+    resolver.refresh()
+    assert sorted(dns.lookups[5:]) == ["here", "localhost", "nowhere", "there"]
+    assert resolver.is_local("there")
+
+    # Without refresh, an entry expired for more than the ttl is looked up again:
+    clock.now = 1000
+    resolver.is_local("there")
+    assert dns.lookups[9:] == ["there"]
+
+
+def test_message_filter():
+    clock = FakeClock()
+    dns = FakeDNS({"localhost": "127.0.0.1", "there": "10.0.0.9"})
+    resolver, dummy = _resolver(clock, dns)
+    message_filter = MessageFilter(resolver)
+
+    assert message_filter(_message())
+    assert message_filter(_message(host=""))
+    assert not message_filter(_message(host="there"))
+    assert not message_filter(None)
+    msg = _message()
+    del msg.data["start_time"]
+    assert not message_filter(msg)
+
+    message_filter = MessageFilter(resolver, platforms=["Metop-C"], sensors=["iasi"])
+    assert not message_filter(_message())
+    assert message_filter(_message(platform_name="Metop-C"))
+    assert message_filter(_message(platform_name="Metop-C", sensor="iasi"))
+    assert not message_filter(_message(platform_name="Metop-C", sensor=["avhrr/3"]))
+
+    # The remote host is not looked up for messages dropped by the allowlists:
+    lookups = len(dns.lookups)
+    assert not message_filter(_message(host="elsewhere"))
+    assert len(dns.lookups) == lookups
+
+
+def test_message_filter_from_options():
+    message_filter = MessageFilter.from_options(
+        {"platforms": "Metop-B, Metop-C", "sensors": "", "host_cache_ttl_sec": "60"}
+    )
+    assert message_filter.platforms == {"Metop-B", "Metop-C"}
+    assert message_filter.sensors is None
+    assert message_filter.resolver.ttl == 60
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Unit tests for the job metrics."""
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from ears_iasi_lvl2_format_converter.conversion import convert_granule
+from ears_iasi_lvl2_format_converter.metrics import (
+    JobMetrics,
+    MetricsFile,
+    reset_peak_rss,
+)
+from ears_iasi_lvl2_format_converter.synthetic import (
+    synthetic_granule_name,
+    write_synthetic_granule,
+)
+
+
+def test_job_metrics(tmp_path):
+    """Test the stages of a conversion are measured and summed up in the metrics file"""
+    fname = synthetic_granule_name(datetime(2023, 3, 27, 9, 16, 6))
+    granule = str(write_synthetic_granule(tmp_path / fname))
+    metrics = JobMetrics(fname, received=datetime.utcnow() - timedelta(seconds=30))
+    assert metrics.queue_wait >= 30
+
+    convert_granule(granule, str(tmp_path), metrics=metrics)
+    metrics.status = "converted"
+    result = json.loads(json.dumps(metrics.as_dict()))
+    assert list(result["stages"]) == ["read", "derive", "ncwrite", "flush"]
+    for stage in result["stages"].values():
+        assert stage["wall"] >= 0
+        assert stage["peak_rss"] > 0
+    if os.path.exists("/proc/self/io"):
+        assert result["stages"]["read"]["bytes_read"] > 0
+        assert result["stages"]["ncwrite"]["bytes_written"] > 0
+    assert result["wall"] >= sum(stage["wall"] for stage in result["stages"].values())
+
+    metrics_file = MetricsFile(str(tmp_path / "iasi_lvl2.prom"))
+    metrics_file.add(result)
+    metrics_file.add(result)
+    metrics_file.add_failed()
+    metrics_file.write()
+    with open(metrics_file.filename) as fpt:
+        lines = fpt.read().splitlines()
+    assert 'ears_iasi_lvl2_jobs_total{status="converted"} 2' in lines
+    assert 'ears_iasi_lvl2_jobs_total{status="failed"} 1' in lines
+    assert 'ears_iasi_lvl2_stage_runs_total{stage="read"} 2' in lines
+    assert not os.path.exists(metrics_file.filename + ".tmp")
+
+
+@pytest.mark.skipif(not reset_peak_rss(), reason="Peak memory can't be reset")
+def test_job_metrics_peak_rss_per_stage():
+    """Test the peak memory is that of each stage, not of the (reused) process"""
+    nbytes = 200 * 1024**2
+    for dummy in range(2):
+        metrics = JobMetrics("job")
+        with metrics.stage("heavy"):
+            data = np.ones(nbytes // 8)
+            del data
+        with metrics.stage("light"):
+            pass
+        result = metrics.as_dict()
+        stages = result["stages"]
+        assert stages["heavy"]["peak_rss"] - stages["light"]["peak_rss"] > nbytes / 2
+        assert result["peak_rss"] >= stages["heavy"]["peak_rss"]
+
+    # A later job without the heavy stage doesn't report its peak:
+    metrics = JobMetrics("job")
+    with metrics.stage("light"):
+        pass
+    assert metrics.as_dict()["peak_rss"] < stages["heavy"]["peak_rss"] - nbytes / 2
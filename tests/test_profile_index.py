@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Unit tests for the spatio-temporal index of the profiles."""
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from ears_iasi_lvl2_format_converter.iasi_lvl2 import IasiLvl2
+from ears_iasi_lvl2_format_converter.profile_index import ProfileIndex
+from ears_iasi_lvl2_format_converter.synthetic import (
+    synthetic_granule_name,
+    write_synthetic_granule,
+)
+from ears_iasi_lvl2_format_converter.utils import EARTH_RADIUS_KM
+
+START_TIMES = [datetime(2023, 3, 27, 9, 16, 6) + timedelta(hours=8 * i) for i in range(3)]
+
+
+@pytest.fixture
+def vprof_files(tmp_path):
+    """Three vprof files of granules 8 hours apart, over overlapping areas."""
+    filenames = []
+    for idx, start_time in enumerate(START_TIMES):
+        fname = synthetic_granule_name(start_time, nlines=4)
+        granule = str(tmp_path / fname)
+        write_synthetic_granule(
+            granule, nlines=4, start_time=start_time, lat0=57 + idx, seed=idx
+        )
+        nc_prefix = str(tmp_path / fname.replace(".hdf", ".nc"))
+        filenames.append(IasiLvl2(granule).ncwrite(nc_prefix))
+    return filenames
+
+
+def _distances_km(filenames, lat, lon):
+    """The distances of all profiles of the files, by brute force"""
+    profiles = []
+    for fname in filenames:
+        l2p = IasiLvl2(fname)
+        lats = np.deg2rad(l2p.latitudes.ravel().astype(float))
+        lons = np.deg2rad(l2p.longitudes.ravel().astype(float))
+        cos_angle = np.sin(np.deg2rad(lat)) * np.sin(lats) + np.cos(
+            np.deg2rad(lat)
+        ) * np.cos(lats) * np.cos(lons - np.deg2rad(lon))
+        dist = EARTH_RADIUS_KM * np.arccos(np.clip(cos_angle, -1, 1))
+        profiles.extend((d, fname, i) for i, d in enumerate(dist))
+    return sorted(profiles)
+
+
+def test_profile_index(vprof_files, tmp_path):
+    """Test the nearest and within radius queries against a brute force search"""
+    index_path = str(tmp_path / "index")
+    index = ProfileIndex(index_path)
+    for fname, start_time in zip(vprof_files, START_TIMES):
+        index.add(fname, start_time, start_time + timedelta(seconds=32))
+    assert len(index.pending()) == 3
+    # Adding a file again replaces its entry:
+    index.add(vprof_files[0], START_TIMES[0], START_TIMES[0] + timedelta(seconds=32))
+    assert index.compact() == 3
+    assert index.pending() == []
+
+    index = ProfileIndex(index_path).load()
+    assert len(index) == 3 * 480
+    expected = _distances_km(vprof_files, 58.2, 15.3)
+    matches = index.nearest(58.2, 15.3, k=5)
+    assert [(m.filename, m.index) for m in matches] == [
+        (fname, idx) for dist, fname, idx in expected[0:5]
+    ]
+    np.testing.assert_allclose(
+        [m.distance_km for m in matches], [e[0] for e in expected[0:5]], rtol=1e-3
+    )
+
+    within = index.within(58.2, 15.3, 100)
+    assert [(m.filename, m.index) for m in within] == [
+        (fname, idx) for dist, fname, idx in expected if dist <= 100
+    ]
+
+    since = START_TIMES[1] + timedelta(minutes=1)
+    matches = index.nearest(58.2, 15.3, k=3, since=since)
+    assert {m.filename for m in matches} == {vprof_files[2]}
+    assert matches[0].start_time == START_TIMES[2]
+    assert index.nearest(58.2, 15.3, until=START_TIMES[0] - timedelta(hours=1)) == []
+
+    # Files removed are dropped from the index when compacted:
+    os.remove(vprof_files[1])
+    index.compact()
+    assert len(ProfileIndex(index_path).load()) == 2 * 480
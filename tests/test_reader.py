@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Unit tests for the selective reading of the vprof netCDF files."""
+import numpy as np
+import pytest
+
+from ears_iasi_lvl2_format_converter.iasi_lvl2 import (
+    IasiLvl2,
+    decode_names,
+    pad_char_array,
+)
+from ears_iasi_lvl2_format_converter.reader import VprofReader, hyperslab_runs
+
+
+@pytest.fixture
+def granule_and_vprof(synthetic_granule):
+    """A synthetic granule, and its vprof netCDF file."""
+    l2p = IasiLvl2(synthetic_granule)
+    nc_prefix = synthetic_granule.replace(".hdf", ".nc")
+    return l2p, l2p.ncwrite(nc_prefix, nc_format="NETCDF4_CLASSIC", chunk_profiles=64)
+
+
+def test_decode_names():
+    names = np.array([list(b"N5831;E01605"), list(b"S0001;W00010")], dtype=np.uint8)
+    chars = pad_char_array(names, 80)
+    assert decode_names(chars).tolist() == ["N5831;E01605", "S0001;W00010"]
+
+
+def test_hyperslab_runs():
+    runs = hyperslab_runs(np.array([3, 5, 200, 201, 7]), merge_gap=10)
+    assert [(start, stop, list(selected)) for start, stop, selected in runs] == [
+        (3, 6, [0, 2]),
+        (200, 202, [0, 1]),
+        (7, 8, [0]),
+    ]
+    assert hyperslab_runs(np.array([], dtype=int)) == []
+
+
+def test_vprof_reader(granule_and_vprof):
+    """Test the profiles read by name, box and range are those of the granule"""
+    l2p, vprof = granule_and_vprof
+    expected_names = np.array(l2p.make_position_names())
+    with VprofReader(vprof) as reader:
+        assert len(reader) == 480
+        np.testing.assert_array_equal(reader.names, expected_names)
+
+        index = reader.names_index([expected_names[400], expected_names[7]])
+        assert 400 in index and 7 in index
+        data = reader.read(index)
+        np.testing.assert_allclose(data["temp"], l2p.temp.data[:, 0, index])
+        np.testing.assert_array_equal(data["name"], expected_names[index])
+        assert data["topo"].shape == (index.size,)
+        with pytest.raises(KeyError):
+            reader.names_index("N0000;E00000")
+        # Not cut to the width of the names stored:
+        with pytest.raises(KeyError, match="XYZ"):
+            reader.names_index([expected_names[7], expected_names[7] + "XYZ"])
+
+        lats = l2p.latitudes.ravel()
+        lons = l2p.longitudes.ravel()
+        index = reader.box_index(55, 60, 10, 20)
+        inside = (lats >= 55) & (lats <= 60) & (lons >= 10) & (lons <= 20)
+        np.testing.assert_array_equal(index, np.flatnonzero(inside))
+        data = reader.read(index, params=["qspec", "skin_temp"])
+        assert set(data) == {"qspec", "skin_temp", "latitude", "longitude", "name"}
+        np.testing.assert_array_equal(
+            np.ma.getmaskarray(data["qspec"]),
+            np.ma.getmaskarray(l2p.qspec.data[:, 0, index]),
+        )
+        np.testing.assert_allclose(
+            data["skin_temp"].compressed(), l2p.skin_temp.data[0, 0, index].compressed()
+        )
+
+        data = reader.read(slice(100, 110), params=["pres"])
+        np.testing.assert_allclose(data["pres"], l2p.pres.data[:, 0, 100:110])
+        assert reader.read([], params=["pres"])["pres"].shape == (101, 0)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""Unit tests for the synthetic IASI level-2 granules."""
+from datetime import datetime
+
+import h5py
+import numpy as np
+
+from ears_iasi_lvl2_format_converter.filenames import granule_info
+from ears_iasi_lvl2_format_converter.iasi_lvl2 import IasiLvl2
+from ears_iasi_lvl2_format_converter.synthetic import (
+    FILL_VALUE,
+    GRANULE_LINES,
+    synthetic_granule_name,
+    write_synthetic_granule,
+)
+
+
+def test_synthetic_granule(tmp_path):
+    """Test the synthetic granule has the size of a real granule, and fill values"""
+    start_time = datetime(2023, 3, 27, 9, 16, 6)
+    fname = synthetic_granule_name(start_time)
+    assert granule_info(fname) == ("M01", start_time, datetime(2023, 3, 27, 9, 19, 10))
+
+    granule = str(write_synthetic_granule(tmp_path / fname))
+    with h5py.File(granule, "r") as h5f:
+        assert h5f["PWLR/T"].shape == (GRANULE_LINES, 120, 101)
+        assert h5f["L1C/Latitude"].shape == (GRANULE_LINES, 120)
+        assert (h5f["PWLR/W"][:] == FILL_VALUE).any()
+        assert (h5f["PWLR/Ts"][:] == FILL_VALUE).any()
+        assert not (h5f["PWLR/T"][:] == FILL_VALUE).any()
+
+    l2p = IasiLvl2(granule)
+    assert l2p.shape == (101, 1, GRANULE_LINES * 120)
+    for param in (l2p.pres, l2p.qspec, l2p.ozone, l2p.skin_temp, l2p.tdew):
+        assert np.ma.count_masked(param.data) > 0
+        assert param.data.max() < 1e6
+    assert 100 < l2p.tdew.data.min() < l2p.tdew.data.max() < 320
+    # Pressure increases downwards, to the surface:
+    assert np.all(np.diff(l2p.pres.data[:, 0, 0].compressed()) > 0)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Unit tests for the utility functions."""
+import functools
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from pyorbital.orbital import Orbital
+from pyresample import create_area_def
+from pyresample.area_config import AreaNotFound, parse_area_file
+
+from ears_iasi_lvl2_format_converter import utils
+from ears_iasi_lvl2_format_converter.utils import (
+    AreaRegistry,
+    get_orbital,
+    granule_inside_area,
+    profiles_inside_area,
+)
+
+AREA_DEF = create_area_def(
+    "test_area",
+    "+proj=stere +ellps=WGS84 +lat_0=90 +lon_0=0 +lat_ts=60",
+    area_extent=(-1000000.0, -4500000.0, 2072000.0, -1428000.0),
+    shape=(100, 100),
+)
+
+METOPB_TLE = (
+    "1 38771U 12049A   23086.36188796  .00000183  00000+0  10393-3 0  9999",
+    "2 38771  98.6852 145.2934 0001571 106.9406 253.1935 14.21499713549405",
+)
+
+
+def test_profiles_inside_area():
+    lons = np.array([[15.0, 15.0, -60.0, 0.0, 15.0]])
+    lats = np.array([[60.0, -30.0, 60.0, 48.2, 90.0]])
+
+    inside = profiles_inside_area(lons, lats, AREA_DEF)
+    np.testing.assert_array_equal(inside, [[True, False, False, False, False]])
+
+    inside = profiles_inside_area(lons, lats, AREA_DEF, margin=100000)
+    np.testing.assert_array_equal(inside, [[True, False, False, True, False]])
+
+
+def test_granule_inside_area(monkeypatch):
+    monkeypatch.setattr(utils, "_ORBITALS", {})
+    monkeypatch.setattr(
+        utils.orbital,
+        "Orbital",
+        functools.partial(Orbital, line1=METOPB_TLE[0], line2=METOPB_TLE[1]),
+    )
+    # Descending over central Europe, the swath east edge passes Finland:
+    start_time = datetime(2023, 3, 27, 9, 16, 6)
+    assert granule_inside_area(
+        start_time, start_time + timedelta(minutes=3), "Metop-B", AREA_DEF
+    )
+    # Over equatorial Africa:
+    start_time = datetime(2023, 3, 27, 9, 30)
+    assert not granule_inside_area(
+        start_time, start_time + timedelta(minutes=3), "Metop-B", AREA_DEF
+    )
+    assert list(utils._ORBITALS) == ["Metop-B"]
+
+
+def test_get_orbital_is_cached(monkeypatch):
+    monkeypatch.setattr(utils, "_ORBITALS", {})
+    created = []
+
+    def _orbital(platform_name):
+        created.append(platform_name)
+        return Orbital(platform_name, line1=METOPB_TLE[0], line2=METOPB_TLE[1])
+
+    monkeypatch.setattr(utils.orbital, "Orbital", _orbital)
+    orb = get_orbital("M01", datetime(2023, 3, 27, 9, 16))
+    assert get_orbital("Metop-B", datetime(2023, 3, 28, 9, 16)) is orb
+    assert created == ["Metop-B"]
+
+    # TLE's too old for the granule, but recently read:
+    assert get_orbital("Metop-B", datetime(2023, 4, 27)) is orb
+    monkeypatch.setattr(utils, "TLE_RELOAD_INTERVAL_SEC", 0)
+    assert get_orbital("Metop-B", datetime(2023, 4, 27)) is not orb
+    assert created == ["Metop-B", "Metop-B"]
+
+
+AREAS_YAML = """
+test_area:
+  description: Test area
+  projection:
+    proj: stere
+    ellps: WGS84
+    lat_0: 90
+    lon_0: 0
+    lat_ts: 60
+  shape:
+    height: 100
+    width: 100
+  area_extent:
+    lower_left_xy: [-1000000.0, -4500000.0]
+    upper_right_xy: [2072000.0, -1428000.0]
+"""
+
+
+def test_area_registry(tmp_path, monkeypatch):
+    areas_file = tmp_path / "areas.yaml"
+    areas_file.write_text(AREAS_YAML)
+    registry = AreaRegistry(areas_file)
+
+    parsed = []
+    monkeypatch.setattr(
+        utils,
+        "parse_area_file",
+        lambda fname: parsed.append(fname) or parse_area_file(fname),
+    )
+    area_def = registry.get("test_area")
+    assert area_def.width == 100
+    assert registry.get("test_area") is area_def
+    assert "test_area" in registry and "euron1" not in registry
+    assert len(parsed) == 1
+    with pytest.raises(AreaNotFound):
+        registry.get("euron1")
+
+    areas_file.write_text(AREAS_YAML.replace("test_area", "other_area"))
+    os.utime(areas_file, (0, 1))
+    assert "other_area" in registry
+    assert len(parsed) == 2
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Unit tests for the worker pool."""
+import os
+
+import pytest
+
+from ears_iasi_lvl2_format_converter.workers import WorkerDied, WorkerPool
+
+
+def _fail(message):
+    raise ValueError(message)
+
+
+class _ExitOnUnpickling(object):
+    def __reduce__(self):
+        return (os._exit, (3,))
+
+
+def test_worker_pool_results():
+    pool = WorkerPool(2)
+    futures = [pool.submit(pow, 2, exp) for exp in range(10)]
+    assert [future.result(timeout=10) for future in futures] == [
+        2**exp for exp in range(10)
+    ]
+
+    with pytest.raises(ValueError, match="boom"):
+        pool.submit(_fail, "boom").result(timeout=10)
+    pool.shutdown()
+    with pytest.raises(RuntimeError):
+        pool.submit(os.getpid)
+
+
+def test_worker_pool_keeps_workers_warm():
+    pool = WorkerPool(1)
+    pids = {pool.submit(os.getpid).result(timeout=10) for _ in range(5)}
+    pool.shutdown()
+    assert len(pids) == 1
+
+
+@pytest.mark.parametrize(
+    "limits", [{"max_jobs_per_worker": 2}, {"max_rss_mb": 1}], ids=["jobs", "rss"]
+)
+def test_worker_pool_recycles_workers(limits):
+    pool = WorkerPool(1, **limits)
+    pids = [pool.submit(os.getpid).result(timeout=10) for _ in range(4)]
+    pool.shutdown()
+    if "max_rss_mb" in limits:
+        assert len(set(pids)) == 4
+    else:
+        assert pids[0] == pids[1] and pids[2] == pids[3] and pids[1] != pids[2]
+
+
+def test_worker_pool_replaces_dead_worker():
+    pool = WorkerPool(1)
+    with pytest.raises(WorkerDied):
+        pool.submit(os._exit, 3).result(timeout=10)
+    assert pool.submit(pow, 2, 3).result(timeout=10) == 8
+    pool.shutdown()
+
+
+def test_worker_pool_fails_job_of_worker_dying_before_it_starts():
+    # The worker dies while unpickling the job, before running it:
+    pool = WorkerPool(1)
+    with pytest.raises(WorkerDied, match="exit code 3"):
+        pool.submit(pow, _ExitOnUnpickling(), 2).result(timeout=10)
+    assert pool.submit(pow, 2, 3).result(timeout=10) == 8
+    pool.shutdown()